@@ -0,0 +1,1404 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Нагрузочный стенд бота без настоящего Telegram.
+
+Поднимает в том же процессе фейковый сервер Bot API на aiohttp (getUpdates
+отдаёт синтетические апдейты, sendMessage/createChatInviteLink/getChatMember
+и прочие вызовы записываются, с настраиваемой задержкой и долей ответов 429),
+запускает бота в режиме polling против него и прогоняет сценарии:
+
+    funnel   — заявители проходят /new → подтверждение
+    approve  — шторм одобрений/отклонений от нескольких админов
+    drain    — разбор накопившихся отложенных ссылок (проход в 8:00)
+    join     — массовые вступления в группу
+    commands — синхронизация меню команд (холодная и повторная)
+    routing  — стоимость маршрутизации одного callback (таблица против цепочки фильтров)
+    export   — /export на --export-rows синтетических заявок (CSV и XLSX)
+    import   — import_data.py на --import-rows строк CSV (с грязными строками и повторами)
+    offhours — вечерняя переписка в группе (ответы о времени с ограничением)
+    webhook  — бот в режиме webhook в --workers процессах, поток POST-запросов
+               и проверка отсева повторов (только если указан явно)
+
+Пример:
+    python bench.py funnel approve --users 200 --latency 0.02 --rate-429 0.01
+
+База и файлы сессий создаются во временном каталоге, рабочая БД не трогается.
+"""
+
+import argparse
+import asyncio
+import itertools
+import logging
+import os
+import multiprocessing
+import random
+import shutil
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import Counter, deque
+from contextlib import closing
+from datetime import datetime, timedelta
+
+import aiohttp
+from aiohttp import web
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+BENCH_TOKEN = "123456:BENCH"
+BENCH_BOT_ID = 123456
+ROOT_ADMIN = 1000
+GROUP_ID = -1001000000000
+FIRST_USER_ID = 100000
+
+# Методы, на которые фейковый сервер может ответить 429
+THROTTLED_METHODS = {"sendMessage", "editMessageText", "createChatInviteLink", "setMyCommands"}
+
+
+# -------------------------------------------------------
+# ФЕЙКОВЫЙ СЕРВЕР BOT API
+# -------------------------------------------------------
+class FakeBotAPI:
+    """Минимальный Bot API: отдаёт апдейты из очереди и записывает вызовы."""
+
+    def __init__(self, latency: float = 0.0, rate_429: float = 0.0, retry_after: int = 1):
+        self.latency = latency
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.updates = deque()
+        self._has_updates = asyncio.Event()
+        self.calls = Counter()
+        self.throttled = 0
+        self.served_at = {}
+        # Чаты, где бот заблокирован или удалён: sendMessage отвечает 403
+        self.blocked_chats = set()
+        self.polling = asyncio.Event()
+        self._message_ids = itertools.count(1_000_000)
+        self._links = itertools.count(1)
+        self._runner = None
+        self.url = None
+
+    def push_update(self, update: dict):
+        self.updates.append(update)
+        self._has_updates.set()
+
+    def reset_stats(self):
+        self.calls.clear()
+        self.throttled = 0
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0):
+        # Документы до 50 МБ, как у настоящего Bot API
+        app = web.Application(client_max_size=50 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self._handle)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+
+    async def _handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        params = dict(await request.post())
+        if method == "getUpdates":
+            return web.json_response({"ok": True, "result": await self._get_updates(params)})
+
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self.rate_429 and method in THROTTLED_METHODS and random.random() < self.rate_429:
+            self.throttled += 1
+            return web.json_response({
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            })
+        if method == "sendMessage" and int(params.get("chat_id", 0)) in self.blocked_chats:
+            return web.json_response({
+                "ok": False,
+                "error_code": 403,
+                "description": "Forbidden: bot was blocked by the user",
+            }, status=403)
+        api_method = getattr(self, f"api_{method}", None)
+        result = api_method(params) if api_method else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def _get_updates(self, params) -> list:
+        self.polling.set()
+        timeout = float(params.get("timeout") or 0)
+        limit = int(params.get("limit") or 100)
+        if not self.updates:
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), timeout or 0.01)
+            except asyncio.TimeoutError:
+                return []
+        batch = [self.updates.popleft() for _ in range(min(limit, len(self.updates)))]
+        if not self.updates:
+            self._has_updates.clear()
+        now = time.perf_counter()
+        for update in batch:
+            self.served_at[update["update_id"]] = now
+        return batch
+
+    # ---- ответы методов ----
+    def _bot_user(self) -> dict:
+        return {"id": BENCH_BOT_ID, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+    def _message(self, params) -> dict:
+        chat_id = int(params.get("chat_id", 0))
+        return {
+            "message_id": int(params.get("message_id") or next(self._message_ids)),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            "from": self._bot_user(),
+            "text": params.get("text", ""),
+        }
+
+    def api_getMe(self, params):
+        return self._bot_user()
+
+    def api_sendMessage(self, params):
+        return self._message(params)
+
+    def api_editMessageText(self, params):
+        return self._message(params)
+
+    def api_sendDocument(self, params):
+        return self._message(params)
+
+    def api_createChatInviteLink(self, params):
+        return {
+            "invite_link": f"https://t.me/+bench{next(self._links)}",
+            "creator": self._bot_user(),
+            "creates_join_request": False,
+            "is_primary": False,
+            "is_revoked": False,
+            "member_limit": int(params.get("member_limit") or 0) or None,
+        }
+
+    def api_getChatMember(self, params):
+        user_id = int(params["user_id"])
+        return {"status": "left", "user": {"id": user_id, "is_bot": False, "first_name": "U"}}
+
+
+# -------------------------------------------------------
+# СИНТЕТИЧЕСКИЕ АПДЕЙТЫ
+# -------------------------------------------------------
+_RU_LETTERS = "абвгдежзиклмнопрстуфхцчшэюя"
+
+
+def ru_name(index: int) -> str:
+    """Уникальное ФИО из русских букв (проходит проверку в enter_fullname)."""
+    suffix = ""
+    index += 1
+    while index:
+        index, rest = divmod(index, len(_RU_LETTERS))
+        suffix += _RU_LETTERS[rest]
+    return f"Тестов Иван {suffix.capitalize()}"
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": "Бенч", "username": f"user{user_id}"}
+
+    def _chat(self, chat_id: int) -> dict:
+        return {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"}
+
+    def message(self, user_id: int, text: str, chat_id: int = None) -> dict:
+        chat_id = chat_id or user_id
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": self._chat(chat_id),
+                "from": self._user(user_id),
+                "text": text,
+            },
+        }
+
+    def callback(self, user_id: int, data: str, message_id: int = None) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "callback_query": {
+                "id": str(next(self._message_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id or next(self._message_ids),
+                    "date": int(time.time()),
+                    "chat": self._chat(user_id),
+                    "from": {"id": BENCH_BOT_ID, "is_bot": True, "first_name": "Bench"},
+                    "text": "…",
+                },
+            },
+        }
+
+    def join(self, chat_id: int, member_ids: list) -> dict:
+        return {
+            "update_id": next(self._update_ids),
+            "message": {
+                "message_id": next(self._message_ids),
+                "date": int(time.time()),
+                "chat": self._chat(chat_id),
+                "from": self._user(member_ids[0]),
+                "new_chat_members": [self._user(member_id) for member_id in member_ids],
+            },
+        }
+
+
+# -------------------------------------------------------
+# ПРОГОН
+# -------------------------------------------------------
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p * (len(ordered) - 1))))]
+
+
+class Harness:
+    """
+    Бот в режиме polling против FakeBotAPI; send() ждёт окончания обработки апдейта.
+    shards > 0 — апдейты идут через UpdateScheduler, иначе dp.start_polling.
+    """
+
+    def __init__(self, hrbot, api: FakeBotAPI, shards: int = 0, queue_size: int = 100):
+        self.hrbot = hrbot
+        self.api = api
+        self.updates = UpdateFactory()
+        self.latencies = []
+        self._waiters = {}
+        self.bot = hrbot.create_bot()
+        self.dp = hrbot.build_dispatcher(self.bot)
+        self.dp.update.outer_middleware(self._completion_middleware)
+        self.scheduler = (
+            hrbot.UpdateScheduler(self.dp, self.bot, shards, queue_size, polling_timeout=1,
+                                 handle_signals=False, close_bot_session=False)
+            if shards else None
+        )
+        self._polling = None
+
+    async def _completion_middleware(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            finished = time.perf_counter()
+            self.latencies.append(finished - self.api.served_at.pop(event.update_id, finished))
+            waiter = self._waiters.pop(event.update_id, None)
+            if waiter and not waiter.done():
+                waiter.set_result(None)
+
+    async def start(self):
+        if self.scheduler:
+            self._polling = asyncio.create_task(self.scheduler.run())
+        else:
+            self._polling = asyncio.create_task(self.dp.start_polling(
+                self.bot, polling_timeout=1, handle_signals=False, close_bot_session=False
+            ))
+        # Ждём первого getUpdates
+        await self.api.polling.wait()
+
+    async def stop(self):
+        if self.scheduler:
+            self.scheduler.stop()
+        else:
+            await self.dp.stop_polling()
+        await self._polling
+        await self.bot.session.close()
+
+    async def send(self, update: dict):
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters[update["update_id"]] = waiter
+        self.api.push_update(update)
+        await waiter
+
+    async def run_scenario(self, name: str, scenario) -> dict:
+        self.latencies = []
+        self.api.reset_stats()
+        started = time.perf_counter()
+        # Сценарии без апдейтов (фоновые проходы) возвращают число обработанных записей
+        items = await scenario(self)
+        elapsed = time.perf_counter() - started
+        calls = sum(self.api.calls.values())
+        updates = items or len(self.latencies)
+        return {
+            "scenario": name,
+            "updates": updates,
+            "elapsed": elapsed,
+            "updates_per_sec": updates / elapsed if elapsed and updates else 0.0,
+            "p50_ms": percentile(self.latencies, 0.5) * 1000,
+            "p99_ms": percentile(self.latencies, 0.99) * 1000,
+            "api_calls": calls,
+            "calls_per_update": calls / updates if updates else float(calls),
+            "throttled": self.api.throttled,
+            "by_method": dict(self.api.calls.most_common()),
+        }
+
+
+# ---- данные ----
+def seed_admins(hrbot, count: int):
+    with hrbot.get_db() as db:
+        for i in range(count):
+            if not db.query(hrbot.AdminUser).filter_by(telegram_id=ROOT_ADMIN + 1 + i).first():
+                db.add(hrbot.AdminUser(telegram_id=ROOT_ADMIN + 1 + i, full_name=f"Админ {i}"))
+        db.commit()
+
+
+def seed_requests(hrbot, count: int, first_user: int, status: str = "pending") -> list:
+    created = time.strftime("%Y-%m-%d %H:%M:%S")
+    with hrbot.get_db() as db:
+        rows = [
+            hrbot.UserRequest(
+                chat_id=first_user + i,
+                person_type="self",
+                full_name=ru_name(first_user + i),
+                phone=f"7{9000000000 + first_user + i}",
+                workplace=f"ООО Компания {i % 20}",
+                position="Менеджер",
+                username=f"user{first_user + i}",
+                status=status,
+                created_at=created,
+                approved_at=created if status == "approved" else None,
+                **hrbot.request_keys(ru_name(first_user + i), f"7{9000000000 + first_user + i}",
+                                     f"user{first_user + i}"),
+            )
+            for i in range(count)
+        ]
+        db.add_all(rows)
+        db.commit()
+        return [row.id for row in rows]
+
+
+def seed_requests_bulk(hrbot, count: int, first_user: int, chunk: int = 10_000, days: int = 1):
+    """
+    Быстрое наполнение для больших объёмов: executemany пачками, без ORM-объектов.
+    Заявки раскладываются по последним days дням; одобренные — с разным временем до одобрения.
+    """
+    from sqlalchemy import insert
+    now = datetime.now()
+    statuses = ("approved", "rejected", "pending")
+
+    def stamp(moment):
+        return moment.strftime("%Y-%m-%d %H:%M:%S")
+
+    with hrbot.engine.begin() as conn:
+        for start in range(0, count, chunk):
+            rows = []
+            for i in range(start, min(count, start + chunk)):
+                created = now - timedelta(days=i % days, minutes=i % 600 + 60)
+                approved = created + timedelta(minutes=(i * 7) % 600 + 1)
+                rows.append({
+                    "chat_id": first_user + i,
+                    "person_type": "self",
+                    "full_name": ru_name(first_user + i),
+                    "phone": f"7{9000000000 + first_user + i}",
+                    "workplace": f"ООО Компания {i % 200}",
+                    "position": "Менеджер",
+                    "username": f"user{first_user + i}",
+                    "status": statuses[i % 3],
+                    "created_at": stamp(created),
+                    "approved_at": stamp(approved) if i % 3 == 0 else None,
+                    "approved_by": ROOT_ADMIN + i % 5 if i % 3 == 0 else None,
+                })
+                rows[-1].update(hrbot.request_keys(rows[-1]["full_name"], rows[-1]["phone"],
+                                                   rows[-1]["username"]))
+            conn.execute(insert(hrbot.UserRequest), rows)
+
+
+# ---- сценарии ----
+def scenario_funnel(users: int):
+    async def run(h: Harness):
+        async def applicant(user_id: int):
+            steps = [
+                h.updates.message(user_id, "/new"),
+                h.updates.callback(user_id, "person_self"),
+                h.updates.message(user_id, ru_name(user_id)),
+                h.updates.message(user_id, f"7{9000000000 + user_id}"),
+                h.updates.message(user_id, "ООО Ромашка"),
+                h.updates.message(user_id, "Менеджер"),
+                h.updates.callback(user_id, "confirm_yes"),
+            ]
+            for update in steps:
+                await h.send(update)
+
+        await asyncio.gather(*(applicant(FIRST_USER_ID + i) for i in range(users)))
+    return run
+
+
+def scenario_approve(requests: int, admins: int):
+    async def run(h: Harness):
+        ids = seed_requests(h.hrbot, requests, FIRST_USER_ID + 200_000)
+        approve_ids, reject_ids = ids[::2], ids[1::2]
+        admin_ids = [ROOT_ADMIN] + [ROOT_ADMIN + 1 + i for i in range(admins - 1)]
+
+        async def reject_flow(admin_id: int, request_ids: list):
+            # Отклонение — диалог (кнопка, затем причина), поэтому по одному на админа
+            for req_id in request_ids:
+                await h.send(h.updates.callback(admin_id, f"reject_{req_id}"))
+                await h.send(h.updates.message(admin_id, "Неполные данные"))
+
+        await asyncio.gather(
+            *(h.send(h.updates.callback(admin_ids[i % len(admin_ids)], f"approve_{req_id}"))
+              for i, req_id in enumerate(approve_ids)),
+            *(reject_flow(admin_id, reject_ids[i::len(admin_ids)])
+              for i, admin_id in enumerate(admin_ids)),
+        )
+    return run
+
+
+def scenario_bulk(requests: int):
+    """
+    Массовое одобрение из /check: выбор всех заявок постранично, одна транзакция,
+    правила уходят фоновой рассылкой с ограничением BULK_SEND_RATE.
+    """
+    async def run(h: Harness):
+        seed_requests(h.hrbot, requests, FIRST_USER_ID + 700_000)
+        admin_message = 1
+        clicks = ["bulk_start"]
+        with h.hrbot.get_db() as db:
+            pending = db.query(h.hrbot.UserRequest).filter_by(status="pending").count()
+        pages = -(-pending // h.hrbot.BULK_PAGE_SIZE)
+        for page in range(pages):
+            clicks += ["bulk_select_page", f"bulk_page_{page + 1}"]
+        for data in clicks:
+            await h.send(h.updates.callback(ROOT_ADMIN, data, message_id=admin_message))
+
+        started = time.perf_counter()
+        await h.send(h.updates.callback(ROOT_ADMIN, "bulk_approve", message_id=admin_message))
+        answered = time.perf_counter() - started
+        await h.dp["bulk_sender"].close(timeout=600)
+        sent = time.perf_counter() - started
+        print(f"bulk       одобрение {pending} заявок: ответ админу {answered * 1000:.0f} ms, "
+              f"рассылка {sent:.1f}s ({pending / sent:.1f} сообщений/с)")
+        return len(clicks) + 1
+    return run
+
+
+def scenario_race(requests: int, admins: int):
+    """
+    Несколько админов одновременно одобряют одни и те же заявки (потоки с отдельными
+    соединениями — как воркеры в разных процессах). У каждой заявки должен быть
+    ровно один победитель; для сравнения — прежняя схема «прочитать статус, проверить, записать».
+    Двойной или пропущенный победитель условного UPDATE, как и лишние правила через
+    обработчики, завершают прогон с AssertionError.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    async def run(h: Harness):
+        hrbot = h.hrbot
+        admin_ids = [ROOT_ADMIN] + [ROOT_ADMIN + 1 + i for i in range(admins - 1)]
+
+        def legacy_approve(req_id: int, admin_id: int) -> bool:
+            with hrbot.get_db() as db:
+                req = db.get(hrbot.UserRequest, req_id)
+                if req.status != "pending":
+                    return False
+                time.sleep(0.001)  # await между проверкой и commit в обработчике
+                req.status = "approved"
+                req.approved_by = admin_id
+                db.commit()
+                return True
+
+        def conditional_approve(req_id: int, admin_id: int) -> bool:
+            return bool(hrbot.approve_requests([req_id], admin_id))
+
+        for name, approve, strict in (
+            ("чтение+запись", legacy_approve, False),
+            ("условный UPDATE", conditional_approve, True),
+        ):
+            ids = seed_requests(hrbot, requests, FIRST_USER_ID + 800_000)
+            attempts = [(req_id, admin_id) for req_id in ids for admin_id in admin_ids]
+            random.shuffle(attempts)
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=len(admin_ids) * 2) as pool:
+                results = list(pool.map(lambda attempt: approve(*attempt), attempts))
+            elapsed = time.perf_counter() - started
+            winners = Counter(req_id for (req_id, _), won in zip(attempts, results) if won)
+            doubled = sum(1 for count in winners.values() if count > 1)
+            print(f"race       {name}: {len(attempts)} попыток за {elapsed:.2f}s, "
+                  f"одобрено дважды и более: {doubled} из {len(ids)}, "
+                  f"без победителя: {len(ids) - len(winners)}")
+            # Прежняя схема — только для сравнения; у условного UPDATE победитель ровно один
+            if strict:
+                assert doubled == 0 and len(winners) == len(ids), \
+                    f"{name}: одобрено дважды {doubled}, без победителя {len(ids) - len(winners)}"
+            with hrbot.get_db() as db:
+                db.query(hrbot.UserRequest).filter(hrbot.UserRequest.id.in_(ids)).delete()
+                db.commit()
+
+        # Через обработчики: двойное нажатие «Одобрить» двумя админами
+        ids = seed_requests(hrbot, requests, FIRST_USER_ID + 900_000)
+        h.api.reset_stats()
+        await asyncio.gather(*(
+            h.send(h.updates.callback(admin_id, f"approve_{req_id}"))
+            for req_id in ids for admin_id in admin_ids[:2]
+        ))
+        rules = h.api.calls["sendMessage"] - len(ids)  # минус «успешно одобрена» админу
+        print(f"race       обработчики: правил отправлено {rules} на {len(ids)} заявок")
+        assert rules <= len(ids), f"обработчики: правил отправлено {rules} на {len(ids)} заявок"
+        return len(ids) * 2
+    return run
+
+
+def scenario_doubletap(users: int):
+    """
+    Двойные нажатия: заявитель дважды жмёт «Подтвердить», админ дважды — «Одобрить»
+    (одно и то же сообщение). Прогон без защиты (CALLBACK_DEDUP_TTL=0) и с ней.
+    """
+    async def run(h: Harness):
+        router = h.dp["callback_router"]
+        ttl = router.dedup_ttl
+        total = 0
+        for offset, (name, dedup_ttl) in enumerate((("без защиты", 0), ("с защитой", ttl))):
+            router.dedup_ttl = dedup_ttl
+            first = FIRST_USER_ID + 1_100_000 + offset * users
+
+            async def applicant(user_id: int):
+                for update in (
+                    h.updates.message(user_id, "/new"),
+                    h.updates.callback(user_id, "person_self"),
+                    h.updates.message(user_id, ru_name(user_id)),
+                    h.updates.message(user_id, f"7{9000000000 + user_id}"),
+                    h.updates.message(user_id, "ООО Ромашка"),
+                    h.updates.message(user_id, "Менеджер"),
+                ):
+                    await h.send(update)
+                confirm = h.updates.callback(user_id, "confirm_yes")
+                repeat = h.updates.callback(user_id, "confirm_yes",
+                                            message_id=confirm["callback_query"]["message"]["message_id"])
+                await asyncio.gather(h.send(confirm), h.send(repeat))
+
+            await asyncio.gather(*(applicant(first + i) for i in range(users)))
+            with h.hrbot.get_db() as db:
+                ids = [req.id for req in db.query(h.hrbot.UserRequest).filter(
+                    h.hrbot.UserRequest.chat_id.between(first, first + users - 1))]
+
+            h.api.reset_stats()
+            message_id = 10_000_000 + offset
+            await asyncio.gather(*(
+                h.send(h.updates.callback(ROOT_ADMIN, f"approve_{req_id}", message_id=message_id))
+                for req_id in ids for _ in range(2)
+            ))
+            print(f"doubletap  {name}: заявок {len(ids)} на {users} заявителей, "
+                  f"после двойного «Одобрить» Bot API: {dict(h.api.calls)}")
+            total += users * 2 + len(ids) * 2
+        router.dedup_ttl = ttl
+
+        # Пустое «Одобрить» не должно расходовать кнопку: выбор и повторное нажатие на том же
+        # сообщении одобряют заявки; новый выбор в этом же сообщении — тоже
+        message_id = 10_000_002
+        for attempt, clicks in enumerate((
+            ["bulk_start", "bulk_approve", "bulk_select_page", "bulk_approve"],
+            ["bulk_start", "bulk_select_page", "bulk_approve"],
+        )):
+            ids = seed_requests(h.hrbot, 3, FIRST_USER_ID + 1_150_000 + attempt * 3)
+            for data in clicks:
+                await h.send(h.updates.callback(ROOT_ADMIN, data, message_id=message_id))
+            await h.dp["bulk_sender"].close()
+            with h.hrbot.get_db() as db:
+                left = db.query(h.hrbot.UserRequest).filter(
+                    h.hrbot.UserRequest.id.in_(ids), h.hrbot.UserRequest.status == "pending").count()
+            print(f"doubletap  массовое одобрение, выбор {attempt + 1}: осталось в ожидании {left} из {len(ids)}")
+            assert left == 0, "нажатие «Одобрить» после пустого или в новом выборе потеряно"
+            total += len(clicks)
+        return total
+    return run
+
+
+def scenario_drain(invites: int):
+    """Утренний проход: отложенные ссылки и приветствия, накопленные за ночь."""
+    async def run(h: Harness):
+        first = FIRST_USER_ID + 400_000
+        ids = seed_requests(h.hrbot, invites, first, status="approved")
+        created = time.strftime("%Y-%m-%d %H:%M:%S")
+        with h.hrbot.get_db() as db:
+            db.add_all([
+                h.hrbot.PendingInvite(request_id=req_id, chat_id=first + i,
+                                      created_at=created, is_third_party=0)
+                for i, req_id in enumerate(ids)
+            ])
+            db.add_all([
+                h.hrbot.PendingJoinNotification(user_id=first + i, chat_id=GROUP_ID,
+                                                full_name=ru_name(first + i), workplace="ООО Ромашка",
+                                                position="Менеджер", created_at=created)
+                for i in range(invites)
+            ])
+            db.commit()
+        await h.hrbot.deliver_pending_invites(h.bot)
+        await h.hrbot.deliver_pending_join_notifications(h.bot)
+        return invites * 2
+    return run
+
+
+def scenario_join(events: int, per_event: int):
+    async def run(h: Harness):
+        first = FIRST_USER_ID + 600_000
+        seed_requests(h.hrbot, events * per_event, first, status="approved")
+        await asyncio.gather(*(
+            h.send(h.updates.join(GROUP_ID, [first + e * per_event + i for i in range(per_event)]))
+            for e in range(events)
+        ))
+        # Приветствия копятся в окне JoinBatcher — дожидаемся отправки
+        await h.dp["join_batcher"].close()
+    return run
+
+
+def scenario_commands():
+    """Меню команд: холодная синхронизация всех областей, затем повторная (должна быть пустой)."""
+    async def run(h: Harness):
+        with h.hrbot.get_db() as db:
+            db.query(h.hrbot.BotCommandState).delete()
+            db.commit()
+        pushed = await h.hrbot.set_bot_commands(h.bot)
+        # Без 429 повторный проход ничего не отправляет; с 429 — только недоставленные области
+        repeated = await h.hrbot.set_bot_commands(h.bot)
+        print(f"commands   первый проход: {pushed} областей, повторный: {repeated}")
+        return pushed + repeated
+    return run
+
+
+# callback_data в той пропорции, в какой их шлют в рабочий день
+ROUTING_SAMPLE = (
+    ["approve_1523"] * 4 + ["reject_1524"] * 2 + ["next_request", "prev_request"] * 2
+    + ["accept_rules_1523"] * 2 + ["decline_rules_1524", "person_self", "person_third",
+                                   "confirm_yes", "edit_phone", "cancel", "deladm_7", "test_zero_div"]
+)
+
+
+def legacy_callback_filters():
+    """Цепочка фильтров в порядке регистрации до CallbackRouter (без фильтров состояния)."""
+    from aiogram import F
+    return [
+        F.data.in_({"person_self", "person_third"}), F.data == "back_to_choice", F.data == "cancel",
+        F.data == "back_to_workplace", F.data == "back_to_position", F.data == "confirm_yes",
+        F.data == "edit_data", F.data.startswith("edit_"), F.data == "back_to_confirmation",
+        F.data == "cancel_setrules", F.data == "cancel_addadmin", F.data == "cancel_addadmin_id",
+        F.data == "prev_deladmin", F.data == "next_deladmin", F.data.startswith("deladm_"),
+        F.data == "next_request", F.data == "prev_request", F.data == "next_approved",
+        F.data == "prev_approved", F.data == "next_rejected", F.data == "prev_rejected",
+        F.data.startswith("approve_"), F.data.startswith("reject_"), F.data.startswith("accept_rules_"),
+        F.data.startswith("decline_rules_"), F.data.startswith("test_"),
+    ]
+
+
+def scenario_routing(iterations: int):
+    """Микробенчмарк: поиск обработчика и разбор аргумента для одного callback."""
+    async def run(h: Harness):
+        from aiogram.types import CallbackQuery
+        router = h.dp["callback_router"]
+        queries = [CallbackQuery.model_validate(h.updates.callback(FIRST_USER_ID, data)["callback_query"])
+                   for data in ROUTING_SAMPLE]
+        filters = legacy_callback_filters()
+        total = iterations * len(queries)
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for query in queries:
+                for magic in filters:
+                    if magic.resolve(query):
+                        # Старые обработчики разбирали id заново
+                        query.data.split("_")
+                        break
+        chain = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for _ in range(iterations):
+            for query in queries:
+                router.resolve(query.data)
+        table = time.perf_counter() - started
+
+        print(f"routing    цепочка фильтров: {chain / total * 1e6:.2f} мкс/callback, "
+              f"таблица: {table / total * 1e6:.2f} мкс/callback ({chain / table:.1f}×)")
+        return total
+    return run
+
+
+def scenario_offhours(users: int, per_user: int):
+    """Вечерний тред: каждый пишет в группу несколько сообщений подряд."""
+    async def run(h: Harness):
+        first = FIRST_USER_ID + 700_000
+        work_time = h.hrbot.is_work_time
+        h.hrbot.is_work_time = lambda: False
+        try:
+            await asyncio.gather(*(
+                h.send(h.updates.message(first + i, f"сообщение {n}", chat_id=GROUP_ID))
+                for n in range(per_user) for i in range(users)
+            ))
+        finally:
+            h.hrbot.is_work_time = work_time
+    return run
+
+
+def scenario_export(rows: int):
+    async def run(h: Harness):
+        seed_requests_bulk(h.hrbot, rows, FIRST_USER_ID + 1_000_000)
+        with h.hrbot.get_db() as db:
+            total = db.query(h.hrbot.UserRequest).count()
+
+        formats = ["csv"] + (["xlsx"] if h.hrbot.openpyxl else [])
+        for fmt in formats:
+            started = time.perf_counter()
+            await h.send(h.updates.message(ROOT_ADMIN, f"/export all {fmt}"))
+            elapsed = time.perf_counter() - started
+            print(f"export     {fmt}: {total} строк за {elapsed:.2f}s ({total / elapsed:.0f} строк/s)")
+
+        # Пиковая память выгрузки не должна зависеть от числа строк
+        path = os.path.join(tempfile.gettempdir(), "bench_export.csv")
+        tracemalloc.start()
+        h.hrbot.write_export(path, "csv")
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        os.remove(path)
+        print(f"export     пик памяти CSV: {peak / 1024 / 1024:.1f} МБ на {total} строк")
+        return total * len(formats)
+    return run
+
+
+def write_import_csv(path: str, rows: int, first_user: int):
+    """Исторические заявки: телефоны в разных форматах, ~1% брака и ~1% повторов."""
+    with open(path, "w", newline="", encoding="utf-8") as f:
+        f.write("chat_id;full_name;phone;workplace;position;username;status;created_at\n")
+        for i in range(rows):
+            user = first_user + i
+            phone = f"8{9000000000 + user}" if i % 2 else f"+7 ({900 + user % 100}) {user % 10_000_000:07d}"
+            name = ru_name(user).lower()
+            created = f"01.0{1 + i % 9}.2023"
+            if i % 100 == 1:
+                phone = "12345"
+            if i % 100 == 2 and i > 2:
+                # Та же заявка ещё раз: телефон в другом формате, те же ФИО и дата подачи
+                phone, name = f"8{9000000000 + user - 2}", ru_name(user - 2).lower()
+                created = f"01.0{1 + (i - 2) % 9}.2023"
+            f.write(f"{user};{name};{phone};ООО Компания {i % 200};Менеджер;user{user};одобрена;{created}\n")
+
+
+def scenario_import(rows: int):
+    async def run(h: Harness):
+        sys.path.insert(0, BASE_DIR)
+        import import_data
+
+        path = os.path.join(tempfile.gettempdir(), "bench_import.csv")
+        write_import_csv(path, rows, FIRST_USER_ID + 2_000_000)
+        try:
+            for attempt in ("первая загрузка", "повторная загрузка"):
+                report = await asyncio.to_thread(import_data.import_requests, path)
+                print(f"import     {attempt}: ", end="")
+                report.print()
+        finally:
+            os.remove(path)
+        return rows * 2
+    return run
+
+
+def scenario_analytics(rows: int):
+    """
+    /analytics по агрегатам против прямого подсчёта по user_requests
+    (тот же отчёт: счётчики и медиана времени до одобрения по админам и местам работы).
+    """
+    async def run(h: Harness):
+        hrbot = h.hrbot
+        seed_requests_bulk(hrbot, rows, FIRST_USER_ID + 3_000_000, days=90)
+
+        started = time.perf_counter()
+        with hrbot.engine.begin() as conn:
+            total = hrbot.backfill_analytics(conn)
+        print(f"analytics  бэкфилл: {total} заявок за {time.perf_counter() - started:.2f}s")
+
+        date_from, date_to = hrbot.parse_analytics_args("/analytics 30")
+
+        def scan():
+            # Что пришлось бы делать без агрегатов: прочитать заявки за период и посчитать в Python
+            durations = {}
+            with hrbot.engine.connect() as conn:
+                for created_at, approved_at, admin, workplace in conn.exec_driver_sql(
+                    "SELECT created_at, approved_at, approved_by, workplace FROM user_requests "
+                    "WHERE created_at >= ? AND created_at < ?", (date_from, date_to + "~"),
+                ):
+                    if approved_at:
+                        seconds = (datetime.fromisoformat(approved_at)
+                                   - datetime.fromisoformat(created_at)).total_seconds()
+                        for key in ("all", f"admin:{admin}", f"workplace:{workplace}"):
+                            durations.setdefault(key, []).append(seconds)
+            return {key: percentile(values, 0.5) for key, values in durations.items()}
+
+        timings = {}
+        for name, call in (("scan", scan),
+                           ("rollup", lambda: hrbot.load_analytics(date_from, date_to))):
+            started = time.perf_counter()
+            for _ in range(5):
+                call()
+            timings[name] = (time.perf_counter() - started) / 5
+            print(f"analytics  {name}: {timings[name] * 1000:.1f} ms на отчёт за 30 дней")
+
+        started = time.perf_counter()
+        await h.send(h.updates.message(ROOT_ADMIN, "/analytics 30"))
+        print(f"analytics  /analytics целиком: {(time.perf_counter() - started) * 1000:.1f} ms")
+        return total
+    return run
+
+
+def scenario_codes(rows: int, lookups: int = 2000):
+    """
+    Поиск заявки по коду /accept: полный просмотр user_requests (как было без индекса)
+    против подписанного кода — подделка отсеивается без БД, настоящий ищется по id.
+    """
+    from sqlalchemy import bindparam
+
+    async def run(h: Harness):
+        hrbot = h.hrbot
+        seed_requests_bulk(hrbot, rows, FIRST_USER_ID + 4_000_000)
+        table = hrbot.UserRequest.__table__
+        with hrbot.engine.begin() as conn:
+            ids = [row.id for row in conn.execute(
+                table.select().where(table.c.status == "approved").limit(lookups))]
+            codes = [{"req_id": req_id, "code": hrbot.make_confirmation_code(req_id)} for req_id in ids]
+            conn.execute(
+                table.update().where(table.c.id == bindparam("req_id"))
+                .values(confirmation_code=bindparam("code")),
+                codes,
+            )
+        valid = [item["code"] for item in codes]
+        forged = [code[:-4] + ("AAAA" if code[-4:] != "AAAA" else "BBBB") for code in valid]
+        expired = hrbot.make_confirmation_code(ids[0], ttl=-7200)
+
+        def scan(code):
+            with hrbot.engine.connect() as conn:
+                return conn.exec_driver_sql(
+                    "SELECT id FROM user_requests NOT INDEXED WHERE confirmation_code = ?", (code,)
+                ).first()
+
+        def signed(code):
+            with hrbot.get_db() as db:
+                try:
+                    return hrbot.load_request_by_code(db, code)
+                except hrbot.ConfirmationCodeError:
+                    return None
+
+        for name, lookup in (("скан", scan), ("подпись", signed)):
+            for kind, sample in (("настоящие", valid), ("поддельные", forged)):
+                sample = sample[:200] if name == "скан" else sample
+                started = time.perf_counter()
+                found = sum(lookup(code) is not None for code in sample)
+                elapsed = time.perf_counter() - started
+                print(f"codes      {name} {kind}: {len(sample)} кодов, найдено {found}, "
+                      f"{elapsed / len(sample) * 1e6:.0f} µs на код")
+        assert signed(expired) is None and signed(valid[0].lower()) is not None
+        return len(valid) * 2
+    return run
+
+
+def scenario_duplicates(rows: int, probes: int = 1000):
+    """
+    Повторная заявка с тем же ФИО, набранным иначе (регистр, пробелы, «ё»): сравнение
+    сырых строк против name_key; затем стоимость нечёткого поиска для карточки админа.
+    """
+    async def run(h: Harness):
+        hrbot = h.hrbot
+        first = FIRST_USER_ID + 5_000_000
+        seed_requests_bulk(hrbot, rows, first)
+        names = [ru_name(first + i) for i in range(0, min(rows, probes * 3), 3)]
+        typed = [f"  {name.upper()} ".replace("Е", "Ё") for name in names]
+
+        with hrbot.get_db() as db:
+            for label, check in (
+                ("full_name", lambda text: db.query(hrbot.UserRequest).filter(
+                    hrbot.UserRequest.full_name == text.strip(),
+                    hrbot.UserRequest.status.in_(["pending", "approved"])).first()),
+                ("name_key", lambda text: hrbot.find_active_duplicate(db, name_key=hrbot.name_key(text))),
+            ):
+                started = time.perf_counter()
+                found = sum(check(text) is not None for text in typed)
+                elapsed = time.perf_counter() - started
+                print(f"duplicates {label}: найдено {found} из {len(typed)}, "
+                      f"{elapsed / len(typed) * 1e6:.0f} µs на проверку")
+
+        ids = list(range(1, min(rows, 200) + 1))
+        started = time.perf_counter()
+        warned = sum(bool(hrbot.duplicates_warning(req_id)) for req_id in ids)
+        elapsed = time.perf_counter() - started
+        print(f"duplicates нечёткий поиск: {elapsed / len(ids) * 1000:.1f} ms на заявку, "
+              f"с предупреждением {warned} из {len(ids)} (все ФИО бенча — «Тестов Иван …»)")
+        return len(typed) * 2 + len(ids)
+    return run
+
+
+def scenario_find(rows: int, lookups: int = 200):
+    """
+    /find: LIKE по всем колонкам (полный просмотр) против FTS5 с bm25 и keyset-страницами,
+    затем команда целиком и листание результатов.
+    """
+    async def run(h: Harness):
+        hrbot = h.hrbot
+        first = FIRST_USER_ID + 6_000_000
+        started = time.perf_counter()
+        seed_requests_bulk(hrbot, rows, first)
+        print(f"find       заполнение с триггерами FTS: {rows} заявок за {time.perf_counter() - started:.2f}s")
+
+        step = max(1, rows // lookups)
+        # Как набрал бы админ; LIKE в SQLite не сравнивает кириллицу без учёта регистра
+        queries = [ru_name(first + i).split()[-1] for i in range(0, rows, step)][:lookups]
+        queries += ["Компания 17 Менеджер", f"7{9000000000 + first + 5}"]
+
+        def like(text):
+            pattern = f"%{text}%"
+            with hrbot.engine.connect() as conn:
+                return conn.exec_driver_sql(
+                    "SELECT id FROM user_requests WHERE full_name LIKE ? OR workplace LIKE ? "
+                    "OR position LIKE ? OR username LIKE ? OR phone LIKE ? ORDER BY id LIMIT ?",
+                    (pattern,) * 5 + (hrbot.FIND_PAGE_SIZE,),
+                ).all()
+
+        def fts(text):
+            return hrbot.search_requests(hrbot.build_search_query(text))
+
+        for name, search, sample in (("LIKE", like, queries[:20]), ("FTS5", fts, queries)):
+            started = time.perf_counter()
+            found = sum(bool(search(text)) for text in sample)
+            elapsed = time.perf_counter() - started
+            print(f"find       {name}: {len(sample)} запросов, с результатом {found}, "
+                  f"{elapsed / len(sample) * 1000:.2f} ms на запрос")
+
+        # Глубокое листание: keyset не перечитывает пропущенные страницы, как OFFSET
+        # (совпадает со всеми заявками — больше SEARCH_RANK_LIMIT, поэтому без bm25)
+        match = hrbot.build_search_query("компания")
+        started = time.perf_counter()
+        total = hrbot.count_search_results(match)
+        print(f"find       подсчёт совпадений «компания»: {total} за "
+              f"{(time.perf_counter() - started) * 1000:.1f} ms")
+        cursor, pages = None, 0
+        started = time.perf_counter()
+        while pages < 50:
+            page = hrbot.search_requests(match, cursor, ranked=total <= hrbot.SEARCH_RANK_LIMIT)
+            if not page:
+                break
+            cursor, pages = [page[-1].rank, page[-1].id], pages + 1
+        print(f"find       {pages} страниц подряд по «компания»: "
+              f"{(time.perf_counter() - started) / max(pages, 1) * 1000:.2f} ms на страницу")
+
+        started = time.perf_counter()
+        await h.send(h.updates.message(ROOT_ADMIN, "/find компания 17"))
+        for _ in range(5):
+            await h.send(h.updates.callback(ROOT_ADMIN, "find_next"))
+        print(f"find       /find и 5 страниц: {(time.perf_counter() - started) * 1000:.1f} ms")
+        return len(queries) + 20 + pages + 6
+    return run
+
+
+def scenario_archive(rows: int):
+    """
+    Архивация заявок за год (старше 90 дней): размер рабочей таблицы, полный просмотр
+    и /approved, /find, /stats до и после — последние теперь читают и архив.
+    """
+    async def run(h: Harness):
+        hrbot = h.hrbot
+        seed_requests_bulk(hrbot, rows, FIRST_USER_ID + 7_000_000, days=365)
+        with hrbot.engine.begin() as conn:
+            # Половина отклонённых — без rejected_at, как в базах до его появления
+            conn.exec_driver_sql("UPDATE user_requests SET rules_accepted_at = approved_at "
+                                 "WHERE status = 'approved'")
+            conn.exec_driver_sql("UPDATE user_requests SET rejected_at = created_at "
+                                 "WHERE status = 'rejected' AND id % 2 = 0")
+
+        def scan():
+            with hrbot.engine.connect() as conn:
+                return conn.exec_driver_sql(
+                    "SELECT COUNT(*) FROM user_requests WHERE workplace LIKE '%17%'").scalar()
+
+        async def measure(label: str):
+            started = time.perf_counter()
+            for _ in range(5):
+                scan()
+            scan_ms = (time.perf_counter() - started) / 5 * 1000
+            timings = []
+            for text in ("/approved", "/find компания 17", "/stats"):
+                started = time.perf_counter()
+                await h.send(h.updates.message(ROOT_ADMIN, text))
+                timings.append(f"{text.split()[0]} {(time.perf_counter() - started) * 1000:.0f} ms")
+            print(f"archive    {label}: полный просмотр user_requests {scan_ms:.1f} ms; " + ", ".join(timings))
+
+        await measure("до")
+        stats = await asyncio.to_thread(hrbot.archive_finished_requests, 90)
+        print(f"archive    {hrbot.format_archive_stats(stats)}")
+        await measure("после")
+        with hrbot.engine.connect() as conn:
+            left = conn.exec_driver_sql(
+                "SELECT COUNT(*) FROM user_requests WHERE status = 'rejected' AND rejected_at IS NULL "
+                "AND created_at < date('now', '-90 day')").scalar()
+        print(f"archive    отклонённых без rejected_at старше 90 дней в рабочей таблице: {left}")
+        return stats["moved"]
+    return run
+
+
+def scenario_retention(invites: int, rows: int):
+    """
+    Очереди, которые не могут уйти: ссылки на удалённые заявки и заблокировавшим бота,
+    приветствия в чат, откуда бота удалили, плюс processed_updates за прошлые сутки.
+    Проходы планировщика до и после пометки мёртвых записей, затем очистка и размер файла.
+    """
+    async def run(h: Harness):
+        hrbot = h.hrbot
+        first = FIRST_USER_ID + 8_000_000
+        ids = seed_requests(hrbot, invites, first, status="approved")
+        now = datetime.now()
+        created = (now - timedelta(days=10)).strftime("%Y-%m-%d %H:%M:%S")
+        dead_group = GROUP_ID - 1
+        with hrbot.get_db() as db:
+            db.add_all([
+                hrbot.PendingInvite(request_id=req_id, chat_id=first + i, created_at=created, is_third_party=0)
+                for i, req_id in enumerate(ids)
+            ])
+            db.add_all([
+                hrbot.PendingJoinNotification(user_id=first + i, chat_id=dead_group, full_name=ru_name(first + i),
+                                              workplace="ООО Ромашка", position="Менеджер", created_at=created)
+                for i in range(invites)
+            ])
+            # Половина ссылок — на удалённые заявки, остальные пользователи заблокировали бота
+            db.query(hrbot.UserRequest).filter(hrbot.UserRequest.id.in_(ids[::2])).delete()
+            db.commit()
+        h.api.blocked_chats.update(first + i for i in range(invites))
+        h.api.blocked_chats.add(dead_group)
+        received_at = time.time() - 2 * hrbot.PROCESSED_UPDATES_TTL
+        with hrbot.engine.begin() as conn:
+            conn.exec_driver_sql(
+                "INSERT INTO processed_updates (update_id, received_at) VALUES (?, ?)",
+                [(10_000_000 + i, received_at) for i in range(rows)],
+            )
+
+        async def drain_pass() -> float:
+            started = time.perf_counter()
+            await hrbot.deliver_pending_invites(h.bot)
+            await hrbot.deliver_pending_join_notifications(h.bot)
+            return (time.perf_counter() - started) * 1000
+
+        def live_rows() -> str:
+            with hrbot.engine.connect() as conn:
+                return ", ".join(
+                    f"{table} {conn.exec_driver_sql(f'SELECT COUNT(*) FROM {table} WHERE dead_at IS NULL').scalar()}"
+                    for table in hrbot.PENDING_TABLES)
+
+        print(f"retention  в очередях: {live_rows()}")
+        timings = [await drain_pass() for _ in range(hrbot.PENDING_MAX_ATTEMPTS)]
+        print(f"retention  проходы 1..{len(timings)}: " + ", ".join(f"{ms:.0f}" for ms in timings)
+              + f" ms; Bot API: {dict(h.api.calls)}")
+        h.api.reset_stats()
+        after_ms = await drain_pass()
+        print(f"retention  после пометки мёртвых: проход {after_ms:.1f} ms, Bot API {sum(h.api.calls.values())} "
+              f"вызовов, в очередях: {live_rows()}")
+
+        # Мёртвые записи удаляются сразу, остальное — по обычным срокам
+        dead_ttl, hrbot.DEAD_LETTER_TTL_DAYS = hrbot.DEAD_LETTER_TTL_DAYS, 0
+        try:
+            stats = await asyncio.to_thread(hrbot.apply_retention)
+        finally:
+            hrbot.DEAD_LETTER_TTL_DAYS = dead_ttl
+        print(f"retention  {hrbot.format_retention_stats(stats)}")
+        return sum(stats["deleted"].values())
+    return run
+
+
+def scenario_backup(rows: int, wave: int = 20):
+    """
+    Задержка обработки апдейтов (анкеты заявителей, с записью в БД) без копирования,
+    во время резервной копии по шагам в потоке (run_backup) и во время копии одним
+    шагом прямо в event loop — как если бы backup API вызывался без to_thread.
+    """
+    async def run(h: Harness):
+        hrbot = h.hrbot
+        seed_requests_bulk(hrbot, rows, FIRST_USER_ID + 9_000_000, days=365)
+        users = itertools.count(FIRST_USER_ID + 9_500_000)
+        directory = tempfile.mkdtemp(prefix="backups-")
+        hrbot.BACKUP_DIR = directory
+
+        async def applicant(user_id: int):
+            for update in (
+                h.updates.message(user_id, "/new"),
+                h.updates.callback(user_id, "person_self"),
+                h.updates.message(user_id, ru_name(user_id)),
+                h.updates.message(user_id, f"7{9000000000 + user_id}"),
+                h.updates.message(user_id, "ООО Ромашка"),
+                h.updates.message(user_id, "Менеджер"),
+                h.updates.callback(user_id, "confirm_yes"),
+            ):
+                await h.send(update)
+
+        async def load(label: str, job=None, waves: int = 3):
+            """Волны заявителей, пока идёт job (или waves волн без него)."""
+            h.latencies = []
+            started = time.perf_counter()
+            task = asyncio.create_task(job()) if job else None
+            done = 0
+            while True:
+                await asyncio.gather(*(applicant(next(users)) for _ in range(wave)))
+                done += 1
+                if task.done() if task else done >= waves:
+                    break
+            result = await task if task else None
+            elapsed = time.perf_counter() - started
+            print(f"backup     {label}: {len(h.latencies)} апдейтов за {elapsed:.1f} с, "
+                  f"p50 {percentile(h.latencies, 0.5) * 1000:.1f} ms, "
+                  f"p99 {percentile(h.latencies, 0.99) * 1000:.1f} ms, "
+                  f"max {max(h.latencies) * 1000:.0f} ms")
+            return result
+
+        async def blocking_backup():
+            await asyncio.sleep(0.05)
+            # Вызов прямо в loop: пока копия не готова, апдейты не обрабатываются
+            return hrbot.create_backup(directory, compress=0, keep=0)
+
+        await load("прогрев", waves=1)
+        await load("без копирования")
+        stats = await load("копия по шагам в потоке", hrbot.run_backup)
+        print(f"backup     {hrbot.format_backup_stats(stats)}")
+        blocking = await load("копия одним шагом в loop", blocking_backup)
+        print(f"backup     одним шагом в loop: {blocking['seconds']:.1f} с, "
+              f"{blocking['bytes'] / 1024 / 1024:.1f} МБ без сжатия")
+        with closing(sqlite3.connect(blocking["path"])) as copy:
+            print(f"backup     заявок в копии: {copy.execute('SELECT COUNT(*) FROM user_requests').fetchone()[0]}")
+        await h.send(h.updates.message(ROOT_ADMIN, "/backup"))
+        print(f"backup     копий после /backup: {len(hrbot.list_backups(directory))}")
+        shutil.rmtree(directory)
+        return stats["pages"]
+    return run
+
+
+SCENARIOS = {
+    "funnel": lambda args: scenario_funnel(args.users),
+    "approve": lambda args: scenario_approve(args.users, args.admins),
+    "drain": lambda args: scenario_drain(args.users),
+    "bulk": lambda args: scenario_bulk(args.users),
+    "race": lambda args: scenario_race(args.users, args.admins),
+    "doubletap": lambda args: scenario_doubletap(args.users),
+    "join": lambda args: scenario_join(max(1, args.users // args.join_size), args.join_size),
+    "commands": lambda args: scenario_commands(),
+    "routing": lambda args: scenario_routing(max(1, args.users * 10)),
+    "offhours": lambda args: scenario_offhours(max(1, args.users // 10), 10),
+    "export": lambda args: scenario_export(args.export_rows),
+    "import": lambda args: scenario_import(args.import_rows),
+    "analytics": lambda args: scenario_analytics(args.export_rows),
+    "codes": lambda args: scenario_codes(args.export_rows),
+    "duplicates": lambda args: scenario_duplicates(args.export_rows),
+    "find": lambda args: scenario_find(args.export_rows),
+    "archive": lambda args: scenario_archive(args.export_rows),
+    "retention": lambda args: scenario_retention(args.users * 10, args.export_rows),
+    "backup": lambda args: scenario_backup(args.export_rows),
+}
+
+
+# -------------------------------------------------------
+# WEBHOOK: НЕСКОЛЬКО ВОРКЕРОВ
+# -------------------------------------------------------
+WEBHOOK_SECRET = "bench-secret"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def webhook_worker(index: int, workers: int, env: dict, workdir: str, verbose: bool):
+    """Процесс-воркер: bot.run_worker без авторизации Telethon."""
+    os.environ.update(env)
+    os.chdir(workdir)
+    sys.path.insert(0, BASE_DIR)
+    logging.basicConfig(level=logging.INFO if verbose else logging.CRITICAL)
+    import bot as hrbot
+
+    async def authorized():
+        return True
+
+    hrbot.authorize_user = authorized
+    hrbot.is_work_time = lambda: True
+    hrbot.run_worker(index, workers)
+
+
+async def wait_for_http(session: aiohttp.ClientSession, url: str, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            async with session.get(url):
+                return
+        except aiohttp.ClientError:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"{url} не поднялся за {timeout:.0f} с")
+            await asyncio.sleep(0.2)
+
+
+async def run_webhook_load(args, api: FakeBotAPI, workdir: str):
+    webhook_port, metrics_port = free_port(), free_port() + 100
+    env = {
+        "BOT_MODE": "webhook",
+        "WEBHOOK_URL": f"http://127.0.0.1:{webhook_port}",
+        "WEBHOOK_HOST": "127.0.0.1",
+        "WEBHOOK_PORT": str(webhook_port),
+        "WEBHOOK_WORKERS": str(args.workers),
+        "WEBHOOK_SECRET": WEBHOOK_SECRET,
+        "METRICS_PORT": str(metrics_port),
+    }
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=webhook_worker, args=(i, args.workers, env, workdir, args.verbose))
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+
+    factory = UpdateFactory()
+    first = FIRST_USER_ID + 800_000
+    updates = [factory.message(first + i, "/new") for i in range(args.users)]
+    url = f"http://127.0.0.1:{webhook_port}/webhook"
+    headers = {"X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET}
+    semaphore = asyncio.Semaphore(args.concurrency)
+    acks = []
+
+    async def post(session, update):
+        async with semaphore:
+            started = time.perf_counter()
+            async with session.post(url, json=update, headers=headers) as response:
+                response.raise_for_status()
+            acks.append(time.perf_counter() - started)
+
+    async def wait_for_replies(expected: int, timeout: float = 120.0):
+        deadline = time.monotonic() + timeout
+        while api.calls["sendMessage"] < expected:
+            if time.monotonic() > deadline:
+                raise RuntimeError(f"ответов {api.calls['sendMessage']} из {expected}")
+            await asyncio.sleep(0.01)
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            for i in range(args.workers):
+                await wait_for_http(session, f"http://127.0.0.1:{metrics_port + i}/metrics")
+            await wait_for_http(session, url)
+            async with session.post(url, json=updates[0], headers={}) as response:
+                if response.status != 401:
+                    raise RuntimeError(f"запрос без секрета получил {response.status}, ожидался 401")
+
+            api.reset_stats()
+            started = time.perf_counter()
+            await asyncio.gather(*(post(session, update) for update in updates))
+            accepted = time.perf_counter() - started
+            await wait_for_replies(args.users)
+            elapsed = time.perf_counter() - started
+
+            # Повторная доставка: ответов быть не должно
+            repeats = updates[: max(1, args.users // 10)]
+            await asyncio.gather(*(post(session, update) for update in repeats))
+            await asyncio.sleep(1.0)
+            extra = api.calls["sendMessage"] - args.users
+
+            dropped = 0.0
+            for i in range(args.workers):
+                async with session.get(f"http://127.0.0.1:{metrics_port + i}/metrics") as response:
+                    for line in (await response.text()).splitlines():
+                        if line.startswith("bot_updates_duplicate_total"):
+                            dropped += float(line.split()[-1])
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            await asyncio.to_thread(process.join)
+
+    print(
+        f"webhook    workers={args.workers} updates={args.users}  "
+        f"приём {args.users / accepted:.0f}/s (p50={percentile(acks, 0.5) * 1000:.1f}ms "
+        f"p99={percentile(acks, 0.99) * 1000:.1f}ms)  "
+        f"до ответа {elapsed:.2f}s, {args.users / elapsed:.0f}/s"
+    )
+    print(f"           повторы: отправлено {len(repeats)}, отброшено {dropped:.0f}, лишних ответов {extra}")
+
+
+def print_report(result: dict):
+    print(
+        f"{result['scenario']:<10} items={result['updates']:<6} "
+        f"time={result['elapsed']:.2f}s  {result['updates_per_sec']:.1f}/s  "
+        f"p50={result['p50_ms']:.1f}ms p99={result['p99_ms']:.1f}ms  "
+        f"api={result['api_calls']} ({result['calls_per_update']:.2f}/item, 429: {result['throttled']})"
+    )
+    print("           " + ", ".join(f"{m}={n}" for m, n in result["by_method"].items()))
+
+
+def prepare_environment(workdir: str, api_url: str):
+    """Окружение для импорта bot.py: временная БД и фейковый Bot API."""
+    os.environ.update({
+        "BOT_TOKEN": BENCH_TOKEN,
+        "ROOT_ADMIN_ID": str(ROOT_ADMIN),
+        "PRIVATE_GROUP_ID": str(GROUP_ID),
+        "DATABASE_URL": f"sqlite:///{os.path.join(workdir, 'bench.db')}",
+        "TELEGRAM_API_URL": api_url,
+    })
+    os.chdir(workdir)
+
+
+async def run_bench(args):
+    api = FakeBotAPI(latency=args.latency, rate_429=args.rate_429)
+    api_url = await api.start()
+    workdir = tempfile.mkdtemp(prefix="hrbot-bench-")
+    prepare_environment(workdir, api_url)
+    sys.path.insert(0, BASE_DIR)
+    import bot as hrbot
+
+    hrbot.init_db()
+    # Рабочее время всегда, чтобы сценарии не зависели от часов запуска
+    hrbot.is_work_time = lambda: not args.off_hours
+    seed_admins(hrbot, args.admins - 1)
+
+    # webhook запускает отдельные процессы — только по явному запросу
+    names = [name for name in args.scenarios if name != "webhook"] if args.scenarios else list(SCENARIOS)
+    harness = Harness(hrbot, api, args.shards, args.queue_size)
+    await harness.start()
+    try:
+        for name in names:
+            print_report(await harness.run_scenario(name, SCENARIOS[name](args)))
+        if "webhook" in args.scenarios:
+            await run_webhook_load(args, api, workdir)
+    finally:
+        await harness.stop()
+        await api.stop()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд бота против фейкового Bot API")
+    parser.add_argument("scenarios", nargs="*", help="funnel, approve, bulk, race, doubletap, drain, join, commands, routing, offhours, export, import, analytics, codes, duplicates, find, archive, retention, backup, webhook (по умолчанию все, кроме webhook)")
+    parser.add_argument("--users", type=int, default=100, help="заявителей / заявок в сценарии")
+    parser.add_argument("--admins", type=int, default=5, help="число админов (с root)")
+    parser.add_argument("--join-size", type=int, default=10, help="участников в одном событии входа")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа Bot API, с")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--export-rows", type=int, default=100_000, help="заявок в сценарии export")
+    parser.add_argument("--import-rows", type=int, default=100_000, help="строк в сценарии import")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="шардов UpdateScheduler (0 — dp.start_polling, задача на апдейт)")
+    parser.add_argument("--queue-size", type=int, default=100, help="ёмкость очереди шарда")
+    parser.add_argument("--workers", type=int, default=2, help="процессов-воркеров в сценарии webhook")
+    parser.add_argument("--concurrency", type=int, default=64, help="одновременных POST в сценарии webhook")
+    parser.add_argument("--off-hours", action="store_true", help="прогон в нерабочее время")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS) - {"webhook"}
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+    asyncio.run(run_bench(args))
@@ -1,23 +1,50 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import time
+# Момент начала импорта — для замера холодного старта
+IMPORT_STARTED = time.perf_counter()
+
 import asyncio
 import logging
 import os
 import re
-import uuid
 from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import partial
+from types import SimpleNamespace
+from typing import Optional
 from datetime import datetime, timedelta
 import traceback
 import json
+import hashlib
+import hmac
+import difflib
+import base64
+import struct
+import inspect
+import random
+import threading
+import cProfile
+import multiprocessing
+import csv
+import glob
+import gzip
+import sqlite3
+import html
+import tempfile
 import aiohttp
+import signal
 import sys
+from bisect import bisect_left
+from aiohttp import web
 from dotenv import load_dotenv
 
 
 from aiogram import Dispatcher, F, types
 from aiogram.filters import Command
 from aiogram.types import (
+    FSInputFile,
     Message,
     CallbackQuery,
     BotCommand,
@@ -25,20 +52,45 @@ from aiogram.types import (
     BotCommandScopeChat,
 )
 from aiogram.client.bot import Bot, DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
 from aiogram.filters.state import StateFilter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from aiogram.dispatcher.middlewares.base import BaseMiddleware
+from aiogram.dispatcher.event.bases import UNHANDLED
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNotFound,
+    TelegramRetryAfter,
+)
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.methods import GetUpdates
+from aiogram.utils.backoff import Backoff
+from aiogram.dispatcher.dispatcher import DEFAULT_BACKOFF_CONFIG
 
 from sqlalchemy import (
     create_engine,
+    event,
     Column,
+    MetaData,
+    Table,
     Integer,
+    Float,
     String,
     Text,
+    bindparam,
+    func,
+    select,
 )
 from sqlalchemy.orm import declarative_base, sessionmaker
+from sqlalchemy.pool import NullPool
 
 from telethon import TelegramClient
 from telethon import events
@@ -46,6 +98,12 @@ from telethon.errors import SessionPasswordNeededError
 from telethon.tl import types as tl_types
 from sqlalchemy.exc import OperationalError          # ← новый импорт
 from telethon import errors
+
+# XLSX-экспорт необязателен: без openpyxl /export умеет только CSV
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
 # Конфигурация Error Monitor Bot
 ERROR_MONITOR_BASE_URL = "http://127.0.0.1:8000"  # Базовый URL
 ERROR_MONITOR_API_URL = f"{ERROR_MONITOR_BASE_URL}/api/v1"  # Базовый URL API
@@ -106,7 +164,9 @@ async def send_error_to_monitor(error: Exception, context: dict = None):
         }
         
         logging.debug(f"Sending error to monitor: {ERROR_MONITOR_API_URL}/log")
-        logging.debug(f"Error data: {json.dumps(error_data, indent=2)}")
+        # json.dumps на больших контекстах заметно держит loop — только при DEBUG
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"Error data: {json.dumps(error_data, indent=2)}")
         
         async with aiohttp.ClientSession() as session:
             async with session.post(
@@ -141,7 +201,8 @@ async def send_heartbeat():
                 "bot_name": "hrclubrtbot",
                 "environment": "production",
                 "python_version": sys.version,
-                "aiogram_version": "3.x"
+                "aiogram_version": "3.x",
+                "event_loop": loop_watchdog.heartbeat_snapshot(),
             }
         }
         
@@ -151,7 +212,8 @@ async def send_heartbeat():
         }
         
         logging.debug(f"Sending heartbeat to: {ERROR_MONITOR_API_URL}/heartbeat")
-        logging.debug(f"Heartbeat data: {json.dumps(heartbeat_data, indent=2)}")
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug(f"Heartbeat data: {json.dumps(heartbeat_data, indent=2)}")
         
         async with aiohttp.ClientSession() as session:
             async with session.post(
@@ -191,34 +253,672 @@ async def heartbeat_task():
                 "bot_token": BOT_TOKEN
             })
         finally:
-           
+
             await asyncio.sleep(3600)
 
+
+# -------------------------------------------------------
+# МЕТРИКИ (формат Prometheus)
+# -------------------------------------------------------
+# Латентность в секундах: от 5 мс до 30 с
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _format_labels(labelnames, labelvalues, extra=None) -> str:
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        for _, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+
+class Counter:
+    """Монотонный счётчик с метками. inc() — одна операция со словарём."""
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def inc(self, *labelvalues, value: float = 1.0):
+        self._values[labelvalues] = self._values.get(labelvalues, 0.0) + value
+
+    def collect(self):
+        for labelvalues, value in self._values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labelvalues)} {value}"
+
+
+class Gauge(Counter):
+    """Текущее значение (глубина очереди и т.п.)."""
+
+    kind = "gauge"
+
+    def set(self, *labelvalues, value: float):
+        self._values[labelvalues] = value
+
+
+class Histogram:
+    """Гистограмма с фиксированными бакетами; observe() — bisect + сложение."""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values = {}
+
+    def observe(self, value: float, *labelvalues):
+        series = self._values.get(labelvalues)
+        if series is None:
+            # [счётчики по бакетам..., +Inf, сумма]
+            series = self._values[labelvalues] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def collect(self):
+        for labelvalues, series in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                cumulative += count
+                labels = _format_labels(self.labelnames, labelvalues, ("le", bound))
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield f"{self.name}_sum{labels} {series[-1]}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """Текстовый формат экспозиции Prometheus (version 0.0.4)."""
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+
+UPDATES_TOTAL = METRICS.counter(
+    "bot_updates_total", "Обработанные апдейты по обработчикам", ["handler", "update_type"])
+HANDLER_LATENCY = METRICS.histogram(
+    "bot_handler_duration_seconds", "Время работы обработчика", ["handler"])
+HANDLER_ERRORS = METRICS.counter(
+    "bot_handler_errors_total", "Исключения в обработчиках", ["handler"])
+BOT_API_LATENCY = METRICS.histogram(
+    "bot_api_request_duration_seconds", "Латентность вызовов Bot API", ["method"])
+BOT_API_ERRORS = METRICS.counter(
+    "bot_api_errors_total", "Ошибки вызовов Bot API", ["method", "error"])
+SQL_LATENCY = METRICS.histogram(
+    "bot_sql_duration_seconds", "Латентность SQL-запросов", ["statement"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0))
+TELETHON_CALLS = METRICS.counter(
+    "bot_telethon_calls_total", "Вызовы Telethon", ["method"])
+TELETHON_LATENCY = METRICS.histogram(
+    "bot_telethon_duration_seconds", "Латентность вызовов Telethon", ["method"])
+TELETHON_FLOOD_WAITS = METRICS.counter(
+    "bot_telethon_flood_waits_total", "FloodWait от Telegram при вызовах Telethon", ["method"])
+SCHEDULER_QUEUE_DEPTH = METRICS.gauge(
+    "bot_scheduler_queue_depth", "Размер очередей фоновых задач", ["queue"])
+
+
+UPDATE_LATENCY = METRICS.histogram(
+    "bot_update_duration_seconds", "Полное время обработки апдейта", ["update_type"])
+HANDLER_CPU = METRICS.histogram(
+    "bot_handler_cpu_seconds", "CPU-время потока за время обработки апдейта", ["handler"])
+SLOW_UPDATES = METRICS.counter(
+    "bot_slow_updates_total", "Апдейты дольше порога SLOW_UPDATE_THRESHOLD", ["handler"])
+
+
+SQL_QUERIES_PER_UPDATE = METRICS.histogram(
+    "bot_sql_queries_per_update", "Число SQL-запросов за один апдейт или проход задачи", ["handler"],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, 89))
+SQL_ROWS = METRICS.counter(
+    "bot_sql_rows_total", "Строки, затронутые запросами (по данным драйвера)", ["statement"])
+SQL_QUERY_STORMS = METRICS.counter(
+    "bot_sql_query_storms_total", "Апдейты с числом запросов выше SQL_QUERY_WARN_THRESHOLD", ["handler"])
+
+
+class UpdateTrace:
+    """Сведения об апдейте (или проходе фоновой задачи), который сейчас обрабатывается."""
+
+    __slots__ = ("update_id", "update_type", "handler", "queries", "query_time", "statements")
+
+    def __init__(self, update_id: Optional[int], update_type: str, handler: str = "unhandled"):
+        self.update_id = update_id
+        self.update_type = update_type
+        self.handler = handler
+        self.queries = 0
+        self.query_time = 0.0
+        self.statements = {}
+
+    def record_query(self, label: str, elapsed: float):
+        self.queries += 1
+        self.query_time += elapsed
+        self.statements[label] = self.statements.get(label, 0) + 1
+
+    def report_queries(self):
+        """Метрики по запросам и предупреждение, если их подозрительно много (N+1)."""
+        SQL_QUERIES_PER_UPDATE.observe(self.queries, self.handler)
+        if self.queries <= SQL_QUERY_WARN_THRESHOLD:
+            return
+        SQL_QUERY_STORMS.inc(self.handler)
+        top = sorted(self.statements.items(), key=lambda item: item[1], reverse=True)[:3]
+        logging.warning(
+            f"{self.handler} (update {self.update_id}) issued {self.queries} SQL queries "
+            f"in {self.query_time * 1000:.1f} ms; most repeated: "
+            + ", ".join(f"{label} ×{count}" for label, count in top)
+        )
+
+
+current_update: ContextVar[Optional[UpdateTrace]] = ContextVar("current_update", default=None)
+
+
+@contextmanager
+def traced_job(name: str):
+    """Привязывает SQL-запросы одного прохода фоновой задачи к её имени."""
+    trace = UpdateTrace(None, "job", name)
+    token = current_update.set(trace)
+    try:
+        yield trace
+    finally:
+        current_update.reset(token)
+        trace.report_queries()
+
+
+class HandlerNameMiddleware(BaseMiddleware):
+    """Внутренний middleware: запоминает имя выбранного обработчика в UpdateTrace."""
+
+    async def __call__(self, handler, event, data):
+        trace = current_update.get()
+        handler_obj = data.get("handler")
+        if trace is not None and handler_obj is not None:
+            trace.handler = handler_obj.callback.__name__
+        return await handler(event, data)
+
+
+class UpdateTimingMiddleware(BaseMiddleware):
+    """
+    Внешний middleware на dp.update: время (wall и CPU) по обработчику и типу апдейта.
+
+    Апдейты дольше slow_threshold логируются. С вероятностью profile_rate апдейт
+    обрабатывается под cProfile; если он оказался медленным, профиль сохраняется
+    в profile_dir (смотреть через `python -m pstats` или snakeviz).
+    CPU-время считается по потоку, поэтому включает и чужие корутины,
+    выполнявшиеся во время await.
+    """
+
+    def __init__(self, slow_threshold: float, profile_rate: float = 0.0, profile_dir: str = "profiles"):
+        self.slow_threshold = slow_threshold
+        self.profile_rate = profile_rate
+        self.profile_dir = profile_dir
+        self._profiling = False
+
+    def _start_profiler(self):
+        # Одновременно может работать только один профилировщик
+        if self._profiling or not self.profile_rate or random.random() >= self.profile_rate:
+            return None
+        self._profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _dump_profile(self, profiler, trace: UpdateTrace, wall: float):
+        os.makedirs(self.profile_dir, exist_ok=True)
+        path = os.path.join(
+            self.profile_dir,
+            f"{datetime.now():%Y%m%d-%H%M%S}_{trace.handler}_{trace.update_id}_{int(wall * 1000)}ms.prof",
+        )
+        profiler.dump_stats(path)
+        return path
+
+    async def __call__(self, handler, event, data):
+        try:
+            update_type = event.event_type
+        except Exception:
+            update_type = "unknown"
+        trace = UpdateTrace(event.update_id, update_type)
+        token = current_update.set(trace)
+        profiler = self._start_profiler()
+        wall_started = time.perf_counter()
+        cpu_started = time.thread_time()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(trace.handler)
+            raise
+        finally:
+            wall = time.perf_counter() - wall_started
+            cpu = time.thread_time() - cpu_started
+            if profiler is not None:
+                profiler.disable()
+                self._profiling = False
+            current_update.reset(token)
+
+            UPDATES_TOTAL.inc(trace.handler, update_type)
+            HANDLER_LATENCY.observe(wall, trace.handler)
+            HANDLER_CPU.observe(cpu, trace.handler)
+            UPDATE_LATENCY.observe(wall, update_type)
+            trace.report_queries()
+
+            if wall >= self.slow_threshold:
+                SLOW_UPDATES.inc(trace.handler)
+                message = (
+                    f"Slow update {trace.update_id} ({update_type}) in {trace.handler}: "
+                    f"wall={wall:.3f}s cpu={cpu:.3f}s "
+                    f"sql={trace.queries} queries/{trace.query_time:.3f}s"
+                )
+                if profiler is not None:
+                    try:
+                        message += f", profile: {self._dump_profile(profiler, trace, wall)}"
+                    except OSError as e:
+                        logging.error(f"Не удалось сохранить профиль: {e}")
+                logging.warning(message)
+
+
+class BotApiMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии aiogram: латентность и ошибки по методам Bot API."""
+
+    async def __call__(self, make_request, bot, method):
+        api_method = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramAPIError as e:
+            BOT_API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            BOT_API_LATENCY.observe(time.perf_counter() - started, api_method)
+
+
+UPDATES_DUPLICATE = METRICS.counter(
+    "bot_updates_duplicate_total", "Повторно доставленные апдейты (отброшены)")
+
+
+def claim_update(update_id: int) -> bool:
+    """Отмечает апдейт как принятый; False, если его уже обработал этот или другой воркер."""
+    with engine.begin() as conn:
+        return conn.exec_driver_sql(
+            "INSERT OR IGNORE INTO processed_updates (update_id, received_at) VALUES (?, ?)",
+            (update_id, time.time()),
+        ).rowcount == 1
+
+
+CALLBACKS_DUPLICATE = METRICS.counter(
+    "bot_callbacks_duplicate_total", "Повторные нажатия кнопок (отвечены без обработки)", ["handler"])
+
+
+def claim_action(key: str) -> bool:
+    """Отмечает нажатие кнопки как выполненное; False, если его уже выполнил этот или другой воркер."""
+    with engine.begin() as conn:
+        return conn.exec_driver_sql(
+            "INSERT OR IGNORE INTO processed_actions (key, created_at) VALUES (?, ?)",
+            (key, time.time()),
+        ).rowcount == 1
+
+
+def release_action(key: str):
+    with engine.begin() as conn:
+        conn.exec_driver_sql("DELETE FROM processed_actions WHERE key = ?", (key,))
+
+
+class UpdateDedupMiddleware(BaseMiddleware):
+    """
+    Внешний middleware для режима webhook: Telegram повторяет доставку, если не
+    получил ответ вовремя, а воркеров несколько — update_id фиксируется в общей БД.
+    """
+
+    async def __call__(self, handler, event, data):
+        if not await asyncio.to_thread(claim_update, event.update_id):
+            UPDATES_DUPLICATE.inc()
+            logging.info(f"Апдейт {event.update_id} уже обработан, пропускаем")
+            return None
+        return await handler(event, data)
+
+
+_SQL_TABLE_RE = re.compile(r"\b(?:FROM|INTO|UPDATE|TABLE)\s+[\"`]?(\w+)", re.IGNORECASE)
+
+
+def sql_statement_label(statement: str) -> str:
+    """Метка запроса без параметров: «SELECT user_requests», «INSERT pending_invites»."""
+    verb = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else "?"
+    match = _SQL_TABLE_RE.search(statement)
+    return f"{verb} {match.group(1)}" if match else verb
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context._query_started = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._query_started
+    label = sql_statement_label(statement)
+    SQL_LATENCY.observe(elapsed, label)
+    # sqlite3 сообщает rowcount только для DML; для SELECT это -1
+    rowcount = cursor.rowcount
+    if rowcount > 0:
+        SQL_ROWS.inc(label, value=rowcount)
+
+    trace = current_update.get()
+    if trace is not None:
+        trace.record_query(label, elapsed)
+    if elapsed >= SQL_SLOW_QUERY_THRESHOLD:
+        logging.warning(
+            f"Slow SQL {elapsed * 1000:.1f} ms in "
+            f"{trace.handler if trace else 'no update'}: {label}, rows={rowcount}"
+        )
+    elif SQL_LOG_QUERIES:
+        logging.debug(
+            f"SQL {label} {elapsed * 1000:.2f} ms rows={rowcount} "
+            f"handler={trace.handler if trace else '—'} update={trace.update_id if trace else '—'}"
+        )
+
+
+async def telethon_call(method: str, coro):
+    """Выполняет вызов Telethon, учитывая его в метриках (в т.ч. FloodWait)."""
+    TELETHON_CALLS.inc(method)
+    started = time.perf_counter()
+    try:
+        return await coro
+    except errors.FloodWaitError:
+        TELETHON_FLOOD_WAITS.inc(method)
+        raise
+    finally:
+        TELETHON_LATENCY.observe(time.perf_counter() - started, method)
+
+
+LOOP_LAG = METRICS.histogram(
+    "bot_event_loop_lag_seconds", "Задержка планирования event loop",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+LOOP_STALLS = METRICS.counter(
+    "bot_event_loop_stalls_total", "Зависания event loop дольше LOOP_STALL_THRESHOLD")
+
+
+class LoopWatchdog:
+    """
+    Следит за задержкой event loop.
+
+    Корутина на loop каждые interval секунд меряет, насколько позже срока она
+    проснулась, и отмечает «тик». Отдельный поток проверяет тики: если loop не
+    отвечает дольше threshold, поток снимает стек главного потока через
+    sys._current_frames() и пишет его в лог — так видно, какой синхронный код
+    (запрос к БД, форматирование traceback и т.п.) держит loop.
+    """
+
+    def __init__(self, interval: float = 0.1, threshold: float = 0.25):
+        self.interval = interval
+        self.threshold = threshold
+        self.max_lag = 0.0
+        self.stalls = 0
+        self._last_tick = time.monotonic()
+        self._loop = None
+        self._main_thread_id = None
+        self._stop = threading.Event()
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._main_thread_id = threading.get_ident()
+        self._last_tick = time.monotonic()
+        self._stop.clear()
+        threading.Thread(target=self._watch, name="loop-watchdog", daemon=True).start()
+        return asyncio.create_task(self._measure())
+
+    def stop(self):
+        self._stop.set()
+
+    def heartbeat_snapshot(self) -> dict:
+        """Максимальная задержка и число зависаний с прошлого heartbeat."""
+        snapshot = {"max_lag_ms": round(self.max_lag * 1000, 1), "stalls": self.stalls}
+        self.max_lag = 0.0
+        self.stalls = 0
+        return snapshot
+
+    async def _measure(self):
+        while not self._stop.is_set():
+            started = time.monotonic()
+            await asyncio.sleep(self.interval)
+            self._last_tick = time.monotonic()
+            lag = max(0.0, self._last_tick - started - self.interval)
+            LOOP_LAG.observe(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+            if lag >= self.threshold:
+                logging.warning(f"Event loop lag {lag * 1000:.0f} ms")
+
+    def _watch(self):
+        reported_tick = None
+        while not self._stop.wait(self.interval):
+            tick = self._last_tick
+            blocked = time.monotonic() - tick - self.interval
+            # Одно зависание — один дамп стека
+            if blocked < self.threshold or tick == reported_tick:
+                continue
+            reported_tick = tick
+            self.stalls += 1
+            LOOP_STALLS.inc()
+            frame = sys._current_frames().get(self._main_thread_id)
+            stack = "".join(traceback.format_stack(frame)) if frame else "<нет фрейма>"
+            task = asyncio.current_task(self._loop)
+            logging.warning(
+                f"Event loop blocked for {blocked * 1000:.0f} ms"
+                f" (task: {task.get_name() if task else '—'}). Stack of the main thread:\n{stack}"
+            )
+
+
+async def start_metrics_server(port: Optional[int] = None):
+    """Поднимает HTTP-сервер с /metrics, если задан METRICS_PORT."""
+    port = METRICS_PORT if port is None else port
+    if not port:
+        return None
+
+    async def metrics_view(request: web.Request) -> web.Response:
+        return web.Response(
+            body=METRICS.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logging.info(f"Metrics server listening on http://{METRICS_HOST}:{port}/metrics")
+    return runner
+
 load_dotenv()
 
+# Обязательные параметры проверяются при запуске (validate_config), а не при импорте
 BOT_TOKEN = os.getenv("BOT_TOKEN")
-ROOT_ADMIN_ID = int(os.getenv("ROOT_ADMIN_ID"))
-PRIVATE_GROUP_ID = int(os.getenv("PRIVATE_GROUP_ID"))
+ROOT_ADMIN_ID = int(os.getenv("ROOT_ADMIN_ID") or 0)
+PRIVATE_GROUP_ID = int(os.getenv("PRIVATE_GROUP_ID") or 0)
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///example7.db")
+# Свой сервер Bot API (локальный telegram-bot-api или фейковый из bench.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
+# Сервер метрик: включается, только если задан порт
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT") or 0)
+
+# Медленные апдейты и выборочное профилирование
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", "1.0"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Контроль задержки event loop
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.1"))
+LOOP_STALL_THRESHOLD = float(os.getenv("LOOP_STALL_THRESHOLD", "0.25"))
+# Режим отладки asyncio: логирует каждый колбэк дольше LOOP_STALL_THRESHOLD (дорого)
+LOOP_DEBUG = os.getenv("LOOP_DEBUG", "").lower() in ("1", "true", "yes")
+
+loop_watchdog = LoopWatchdog(LOOP_LAG_INTERVAL, LOOP_STALL_THRESHOLD)
+
+# Инструментирование SQL
+SQL_QUERY_WARN_THRESHOLD = int(os.getenv("SQL_QUERY_WARN_THRESHOLD", "15"))
+SQL_SLOW_QUERY_THRESHOLD = float(os.getenv("SQL_SLOW_QUERY_THRESHOLD", "0.1"))
+SQL_LOG_QUERIES = os.getenv("SQL_LOG_QUERIES", "").lower() in ("1", "true", "yes")
+
+# Режим приёма апдейтов: polling (по умолчанию) или webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Публичный адрес, на который Telegram шлёт апдейты (https://example.com/webhook)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+# Секрет для заголовка X-Telegram-Bot-Api-Secret-Token; по умолчанию выводится из токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or (
+    hashlib.sha256(BOT_TOKEN.encode("utf-8")).hexdigest()[:32] if BOT_TOKEN else None
+)
+# Число процессов, слушающих порт webhook (SO_REUSEPORT)
+WEBHOOK_WORKERS = max(1, int(os.getenv("WEBHOOK_WORKERS", "1")))
+# Сколько хранить update_id для отсева повторов
+PROCESSED_UPDATES_TTL = float(os.getenv("PROCESSED_UPDATES_TTL", str(24 * 3600)))
+MULTI_WORKER = BOT_MODE == "webhook" and WEBHOOK_WORKERS > 1
+
+# Напоминание о времени в группе: одному пользователю не чаще раза в окно (с);
+# режим reply — ответ на сообщение, batch — одно общее напоминание на чат раз в интервал
+OFF_HOURS_REPLY_WINDOW = float(os.getenv("OFF_HOURS_REPLY_WINDOW", "3600"))
+OFF_HOURS_NOTICE_MODE = os.getenv("OFF_HOURS_NOTICE_MODE", "reply").lower()
+OFF_HOURS_NOTICE_INTERVAL = float(os.getenv("OFF_HOURS_NOTICE_INTERVAL", "600"))
+
+# Вступления в группу обрабатываются пачками: окно накопления (с, 0 — сразу)
+# и сколько приветствий склеивать в одно сообщение
+JOIN_BATCH_WINDOW = float(os.getenv("JOIN_BATCH_WINDOW", "2.0"))
+JOIN_GREETINGS_PER_MESSAGE = int(os.getenv("JOIN_GREETINGS_PER_MESSAGE", "10"))
+
+# Массовые действия в /check: темп фоновой рассылки (сообщений/с), период
+# обновления прогресса (с) и заявок на странице выбора
+BULK_SEND_RATE = float(os.getenv("BULK_SEND_RATE", "20"))
+BULK_PROGRESS_INTERVAL = float(os.getenv("BULK_PROGRESS_INTERVAL", "2.0"))
+BULK_PAGE_SIZE = int(os.getenv("BULK_PAGE_SIZE", "8"))
+
+# Поиск /find: результатов на странице
+FIND_PAGE_SIZE = int(os.getenv("FIND_PAGE_SIZE", "10"))
+
+# Архив: заявки, завершённые больше ARCHIVE_AFTER_DAYS дней назад (0 — не архивировать),
+# переносятся в user_requests_archive раз в ARCHIVE_INTERVAL с транзакциями по ARCHIVE_BATCH_SIZE
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "1000"))
+ARCHIVE_INTERVAL = float(os.getenv("ARCHIVE_INTERVAL", str(24 * 3600)))
+
+# Хранение служебных таблиц: сколько дней держать неотправленные ссылки и приветствия
+# (0 — без срока), после скольких отказов Bot API запись считается мёртвой и больше не
+# рассылается, сколько дней хранить мёртвые записи для разбора. Очистка идёт раз в
+# RETENTION_INTERVAL транзакциями по RETENTION_BATCH_SIZE строк, затем до
+# RETENTION_VACUUM_PAGES свободных страниц возвращаются ОС (PRAGMA incremental_vacuum)
+PENDING_INVITE_TTL_DAYS = int(os.getenv("PENDING_INVITE_TTL_DAYS", "30"))
+PENDING_JOIN_TTL_DAYS = int(os.getenv("PENDING_JOIN_TTL_DAYS", "7"))
+PENDING_MAX_ATTEMPTS = int(os.getenv("PENDING_MAX_ATTEMPTS", "5"))
+DEAD_LETTER_TTL_DAYS = int(os.getenv("DEAD_LETTER_TTL_DAYS", "30"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "1000"))
+RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", "2000"))
+
+# Резервные копии базы: каталог, интервал (с, 0 — только по /backup и `bot.py backup`),
+# сколько последних копий хранить (0 — все), страниц за шаг backup API и пауза между
+# шагами (с), уровень сжатия gzip (0 — без сжатия; 1 вдвое быстрее 6 при копии на ~20% больше)
+BACKUP_DIR = os.getenv("BACKUP_DIR", "backups")
+BACKUP_INTERVAL = float(os.getenv("BACKUP_INTERVAL", str(24 * 3600)))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", "7"))
+BACKUP_PAGES_PER_STEP = int(os.getenv("BACKUP_PAGES_PER_STEP", "256"))
+BACKUP_STEP_PAUSE = float(os.getenv("BACKUP_STEP_PAUSE", "0.005"))
+BACKUP_COMPRESS = int(os.getenv("BACKUP_COMPRESS", "1"))
+
+# Выгрузка /export: строк за одно чтение курсора
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "2000"))
+
+# Polling: число шардов (параллельно обрабатываемых чатов) и ёмкость очереди шарда;
+# 0 — обычный dp.start_polling с задачей на каждый апдейт
+UPDATE_SHARDS = int(os.getenv("UPDATE_SHARDS", "32"))
+UPDATE_SHARD_QUEUE_SIZE = int(os.getenv("UPDATE_SHARD_QUEUE_SIZE", "100"))
+
+# FSM: sqlite (по умолчанию, переживает перезапуск) или memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite").lower()
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "1.0"))
+FSM_IDLE_TTL = float(os.getenv("FSM_IDLE_TTL", "600"))
+FSM_STATE_TTL = float(os.getenv("FSM_STATE_TTL", str(7 * 24 * 3600)))
+
+# Коды подтверждения для третьих лиц (/accept, /decline): ключ подписи и срок действия (с)
+CONFIRMATION_CODE_SECRET = (
+    os.getenv("CONFIRMATION_CODE_SECRET") or f"confirmation-code:{BOT_TOKEN}"
+).encode("utf-8")
+CONFIRMATION_CODE_TTL = float(os.getenv("CONFIRMATION_CODE_TTL", str(14 * 24 * 3600)))
+
+# Похожие заявки в уведомлении админу: порог сходства ФИО (difflib, 0..1) и сколько
+# заявок с тем же началом ФИО сравнивать
+DUPLICATE_NAME_RATIO = float(os.getenv("DUPLICATE_NAME_RATIO", "0.85"))
+DUPLICATE_CANDIDATES = int(os.getenv("DUPLICATE_CANDIDATES", "50"))
+
+# Повторные нажатия кнопок, меняющих данные: сколько помнить нажатие (с, 0 — не отсеивать)
+# и сколько последних нажатий держать в памяти (остальные проверяются по processed_actions)
+CALLBACK_DEDUP_TTL = float(os.getenv("CALLBACK_DEDUP_TTL", str(24 * 3600)))
+CALLBACK_DEDUP_SIZE = int(os.getenv("CALLBACK_DEDUP_SIZE", "10000"))
+
+# Синхронизация меню команд: сколько setMyCommands одновременно и принудительная переотправка
+COMMANDS_SYNC_CONCURRENCY = int(os.getenv("COMMANDS_SYNC_CONCURRENCY", "4"))
+COMMANDS_FORCE_SYNC = os.getenv("COMMANDS_FORCE_SYNC", "").lower() in ("1", "true", "yes")
 
 
 TELETHON_API_ID = "24732270"
 TELETHON_API_HASH = "0e4e8581f1256800d859f7e9490b69d6"
 TELETHON_SESSION = os.path.join(os.getcwd(), "user_session.session")
+# Сессия воркера 0; остальные воркеры webhook подменяют TELETHON_SESSION своей
+TELETHON_MAIN_SESSION = TELETHON_SESSION
 
-engine = create_engine("sqlite:///example7.db", echo=False)
+# Сессии живут через await (рассылки админам внутри `with get_db()`), поэтому
+# при множестве одновременных апдейтов QueuePool исчерпывается и блокирует loop
+# на checkout. Для SQLite новое соединение дешёвое — пул не нужен.
+engine = create_engine(DATABASE_URL, echo=False, poolclass=NullPool)
 Base = declarative_base()
 SessionLocal = sessionmaker(bind=engine)
 
-# Инициализация Telethon клиента
-telethon_client = TelegramClient(
-    TELETHON_SESSION,
-    TELETHON_API_ID,
-    TELETHON_API_HASH,
-    system_version="4.16.30-vxCUSTOM",
-    device_model="Desktop",
-    app_version="1.0.0",
-    lang_code="ru"
-)
+event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+# Telethon-клиент создаётся при первом обращении
+telethon_client: Optional[TelegramClient] = None
+
+
+def get_telethon_client() -> TelegramClient:
+    global telethon_client
+    if telethon_client is None:
+        telethon_client = TelegramClient(
+            TELETHON_SESSION,
+            TELETHON_API_ID,
+            TELETHON_API_HASH,
+            system_version="4.16.30-vxCUSTOM",
+            device_model="Desktop",
+            app_version="1.0.0",
+            lang_code="ru"
+        )
+    return telethon_client
 
 @contextmanager
 def get_db():
@@ -267,39 +967,66 @@ class GroupRules(Base):
     text = Column(Text, nullable=False)
 
 
-class UserRequest(Base):
-    __tablename__ = "user_requests"
+class UserRequestColumns:
+    """Колонки заявки: общие для рабочей таблицы и архива (id при переносе сохраняется)."""
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    chat_id = Column(Integer, nullable=False)
+    chat_id = Column(Integer, nullable=False, index=True)
     third_party_chat_id = Column(Integer, nullable=True)
     person_type = Column(String, nullable=True)
-    full_name = Column(String, nullable=True)
-    phone = Column(String, nullable=True)
+    full_name = Column(String, nullable=True, index=True)
+    phone = Column(String, nullable=True, index=True)
     workplace = Column(String, nullable=True)
     position = Column(String, nullable=True)
     username = Column(String, nullable=True)
-    status = Column(String, default="pending")
+    status = Column(String, default="pending", index=True)
     rejection_reason = Column(String, nullable=True)
-    confirmation_code = Column(String, nullable=True)
+    confirmation_code = Column(String, nullable=True, index=True)
     created_at = Column(String, nullable=True)  
     approved_at = Column(String, nullable=True)  
     rejected_at = Column(String, nullable=True) 
     rules_accepted_at = Column(String, nullable=True)  
+    joined_at = Column(String, nullable=True)
 
     approved_by = Column(Integer, nullable=True)
     rejected_by = Column(Integer, nullable=True)
+    # Ключи для поиска дубликатов (см. request_keys): телефон в E.164,
+    # ФИО в нижнем регистре без лишних пробелов, username без «@»
+    phone_key = Column(String, nullable=True, index=True)
+    name_key = Column(String, nullable=True, index=True)
+    username_key = Column(String, nullable=True, index=True)
+    # Растёт при каждой смене статуса (см. transition_requests)
+    version = Column(Integer, nullable=False, default=0)
+
+
+class UserRequest(UserRequestColumns, Base):
+    __tablename__ = "user_requests"
+
+
+class UserRequestArchive(UserRequestColumns, Base):
+    """Завершённые давно заявки (см. archive_finished_requests); читаются только для истории."""
+    __tablename__ = "user_requests_archive"
+
+    archived_at = Column(String, nullable=True)
+
+
+# Обе таблицы: сначала рабочая, затем архив
+REQUEST_MODELS = (UserRequest, UserRequestArchive)
 
 
 class PendingInvite(Base):
     __tablename__ = "pending_invites"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    request_id = Column(Integer, nullable=False)  
+    request_id = Column(Integer, nullable=False, index=True)
     chat_id = Column(Integer, nullable=False)     
     created_at = Column(String, nullable=False)   
     is_third_party = Column(Integer, default=0)   
     confirmation_code = Column(String, nullable=True)  
+    # Отказы Bot API (см. record_delivery_failure); после PENDING_MAX_ATTEMPTS — dead_at
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String, nullable=True)
+    dead_at = Column(String, nullable=True)
 
 
 
@@ -313,17 +1040,429 @@ class PendingJoinNotification(Base):
     workplace = Column(String, nullable=True)  
     position = Column(String, nullable=True)   
     created_at = Column(String, nullable=False)  
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(String, nullable=True)
+    dead_at = Column(String, nullable=True)
+
+
+# Очереди отложенной отправки, которые каждые 5 минут просматривает планировщик
+PENDING_TABLES = (PendingInvite.__tablename__, PendingJoinNotification.__tablename__)
+
+
+class FSMRecord(Base):
+    """Состояние и данные FSM одного пользователя (см. SQLiteStorage)."""
+    __tablename__ = "fsm_storage"
+
+    key = Column(String, primary_key=True)
+    state = Column(String, nullable=True)
+    data = Column(Text, nullable=False, default="{}")
+    updated_at = Column(Float, nullable=False, index=True)
+
+
+class ProcessedUpdate(Base):
+    """update_id, принятые в режиме webhook (отсев повторных доставок)."""
+    __tablename__ = "processed_updates"
+
+    update_id = Column(Integer, primary_key=True, autoincrement=False)
+    received_at = Column(Float, nullable=False, index=True)
+
+
+class ProcessedAction(Base):
+    """Выполненные нажатия кнопок с once=True: «пользователь:сообщение:callback_data»."""
+    __tablename__ = "processed_actions"
+
+    key = Column(String, primary_key=True)
+    created_at = Column(Float, nullable=False, index=True)
+
+
+class BotCommandState(Base):
+    """Хеш последнего применённого меню команд по области (default, chat:<id>)."""
+    __tablename__ = "bot_command_state"
+
+    scope = Column(String, primary_key=True)
+    digest = Column(String, nullable=False)
+    updated_at = Column(String, nullable=True)
+
+
+class AnalyticsDaily(Base):
+    """Число событий по заявкам за сутки: всего (dimension=all), по админу и месту работы."""
+    __tablename__ = "analytics_daily"
 
-Base.metadata.create_all(engine)
+    day = Column(String, primary_key=True)
+    event = Column(String, primary_key=True)
+    dimension = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
 
-with get_db() as db:
-    root_admin = db.query(AdminUser).filter_by(telegram_id=ROOT_ADMIN_ID).first()
-    if not root_admin:
-        new_root = AdminUser(telegram_id=ROOT_ADMIN_ID, full_name="Root Admin")
-        db.add(new_root)
-        with safe_commit(db):
-            pass
-        logging.info(f"Added root admin with ID {ROOT_ADMIN_ID}")
+
+class AnalyticsLatency(Base):
+    """Гистограмма времени ожидания за сутки; bucket — индекс в ANALYTICS_BUCKETS."""
+    __tablename__ = "analytics_latency"
+
+    day = Column(String, primary_key=True)
+    event = Column(String, primary_key=True)
+    dimension = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    bucket = Column(Integer, primary_key=True, autoincrement=False)
+    count = Column(Integer, nullable=False, default=0)
+    total = Column(Float, nullable=False, default=0.0)
+
+
+# Версия схемы хранится в PRAGMA user_version. При изменении моделей увеличьте
+# SCHEMA_VERSION; если существующим базам нужны ALTER TABLE, добавьте шаг в MIGRATIONS.
+SCHEMA_VERSION = 14
+
+
+def add_column_if_missing(conn, table: str, column: str, ddl: str):
+    """ALTER TABLE ADD COLUMN, если колонки ещё нет (для миграций)."""
+    columns = {row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({table})")}
+    if column not in columns:
+        conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+
+
+def add_user_request_indexes(conn, columns=("chat_id", "full_name", "phone", "status")):
+    # Поиск заявок по чату, ФИО и телефону (дубликаты, импорт) и по статусу (/check, /stats)
+    for column in columns:
+        conn.exec_driver_sql(
+            f"CREATE INDEX IF NOT EXISTS ix_user_requests_{column} ON user_requests ({column})"
+        )
+
+
+def add_analytics(conn):
+    add_column_if_missing(conn, "user_requests", "joined_at", "VARCHAR")
+    # Агрегаты по уже накопленным заявкам (функция определена ниже, к вызову уже есть);
+    # архива и представления user_requests_all на этом шаге ещё нет
+    backfill_analytics(conn, UserRequest.__table__)
+
+
+def add_request_version(conn):
+    add_column_if_missing(conn, "user_requests", "version", "INTEGER NOT NULL DEFAULT 0")
+
+
+def add_request_keys(conn):
+    for column in ("phone_key", "name_key", "username_key"):
+        add_column_if_missing(conn, "user_requests", column, "VARCHAR")
+    backfill_request_keys(conn)
+    add_user_request_indexes(conn, columns=("phone_key", "name_key", "username_key"))
+
+
+def add_request_search(conn):
+    # Таблица FTS5 и триггеры — в разделе «ПОИСК ПО ЗАЯВКАМ»
+    if conn.dialect.name != "sqlite":
+        return
+    try:
+        create_request_search(conn)
+    except OperationalError as e:
+        # SQLite собран без FTS5 — бот работает, /find сообщит, что поиск недоступен
+        logging.warning(f"Полнотекстовый поиск недоступен: {e}")
+
+
+def add_request_archive(conn):
+    # Таблицу архива создал create_all; /find теперь ищет по рабочей таблице и архиву
+    create_requests_view(conn)
+    search_sql = conn.exec_driver_sql(
+        "SELECT sql FROM sqlite_master WHERE name = ?", (SEARCH_TABLE,)
+    ).scalar() if conn.dialect.name == "sqlite" else None
+    if search_sql and ALL_REQUESTS_VIEW not in search_sql:
+        drop_request_search(conn)
+        create_request_search(conn)
+
+
+def rebuild_analytics(conn):
+    # Пересчёт агрегатов: появилось время до отказа (только для отказов с rejected_at)
+    backfill_analytics(conn)
+
+
+def add_pending_retention(conn):
+    for table in PENDING_TABLES:
+        add_column_if_missing(conn, table, "attempts", "INTEGER NOT NULL DEFAULT 0")
+        add_column_if_missing(conn, table, "last_error", "VARCHAR")
+        add_column_if_missing(conn, table, "dead_at", "VARCHAR")
+    # Поиск ссылок по заявке: архивация и удаление ссылок на несуществующие заявки
+    conn.exec_driver_sql(
+        "CREATE INDEX IF NOT EXISTS ix_pending_invites_request_id ON pending_invites (request_id)"
+    )
+
+
+MIGRATIONS = {
+    5: add_user_request_indexes,
+    6: add_analytics,
+    7: add_request_version,
+    # Старые коды /accept без подписи ищутся по confirmation_code
+    9: partial(add_user_request_indexes, columns=("confirmation_code",)),
+    10: add_request_keys,
+    11: add_request_search,
+    12: add_request_archive,
+    13: add_pending_retention,
+    14: rebuild_analytics,
+}
+
+
+def init_db() -> bool:
+    """
+    Готовит базу к работе. Если версия схемы уже актуальна, create_all не
+    вызывается (он делает PRAGMA table_info по каждой таблице).
+    Возвращает True, если схема обновлялась.
+    """
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            # Свободные страницы отдаются ОС по частям (apply_retention). Действует только
+            # для новой базы и только до перехода в WAL; существующую переводит `bot.py vacuum`
+            conn.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+            # WAL: читатели не ждут писателя — важно, когда процессов несколько
+            conn.exec_driver_sql("PRAGMA journal_mode=WAL")
+        current = conn.exec_driver_sql("PRAGMA user_version").scalar()
+        migrated = current != SCHEMA_VERSION
+        if migrated:
+            Base.metadata.create_all(conn)
+            for version in range(current + 1, SCHEMA_VERSION + 1):
+                migration = MIGRATIONS.get(version)
+                if migration:
+                    migration(conn)
+            conn.exec_driver_sql(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            logging.info(f"Схема БД обновлена: {current} -> {SCHEMA_VERSION}")
+
+    if not ROOT_ADMIN_ID:
+        # Например, при запуске import_data.py без полного .env
+        return migrated
+    with get_db() as db:
+        root_admin = db.query(AdminUser).filter_by(telegram_id=ROOT_ADMIN_ID).first()
+        if not root_admin:
+            new_root = AdminUser(telegram_id=ROOT_ADMIN_ID, full_name="Root Admin")
+            db.add(new_root)
+            # Вызывается в отдельном потоке, поэтому без safe_commit (ему нужен loop)
+            db.commit()
+            logging.info(f"Added root admin with ID {ROOT_ADMIN_ID}")
+    return migrated
+
+
+# -------------------------------------------------------
+# FSM-ХРАНИЛИЩЕ
+# -------------------------------------------------------
+FSM_CACHE_SIZE = METRICS.gauge(
+    "bot_fsm_cache_entries", "Записей FSM в памяти")
+FSM_FLUSH_ROWS = METRICS.histogram(
+    "bot_fsm_flush_rows", "Записей FSM за один сброс в БД",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500))
+
+
+class _FSMEntry:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state: Optional[str], data: dict):
+        self.state = state
+        self.data = data
+        self.touched = time.monotonic()
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище в таблице fsm_storage той же БД: незаконченные заявки и
+    листание списков переживают перезапуск.
+
+    Состояние держится в памяти, изменения помечаются «грязными» и раз в
+    flush_interval секунд пишутся в БД одной транзакцией (в отдельном потоке),
+    так что десяток update_data за анкету превращается в одну-две записи.
+    Записи, к которым не обращались idle_ttl секунд, выгружаются из памяти;
+    строки в БД старше state_ttl секунд удаляются.
+
+    С cache=False каждое чтение и запись идёт прямо в БД — для нескольких
+    процессов на одной базе.
+    """
+
+    def __init__(self, flush_interval: float = 1.0, idle_ttl: float = 600.0,
+                 state_ttl: float = 7 * 24 * 3600, cache: bool = True):
+        self.flush_interval = flush_interval
+        self.idle_ttl = idle_ttl
+        self.state_ttl = state_ttl
+        self.cache = cache
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._entries = {}
+        self._dirty = set()
+        self._flusher: Optional[asyncio.Task] = None
+        self._last_cleanup = time.monotonic()
+
+    # ---- работа с БД (синхронно) ----
+    @staticmethod
+    def _load(key: str) -> _FSMEntry:
+        with engine.connect() as conn:
+            row = conn.exec_driver_sql(
+                "SELECT state, data FROM fsm_storage WHERE key = ?", (key,)
+            ).first()
+        if row is None:
+            return _FSMEntry(None, {})
+        return _FSMEntry(row[0], json.loads(row[1]))
+
+    @staticmethod
+    def _write(rows):
+        """rows: [(key, state, data_json)]; пустая запись удаляется."""
+        now = time.time()
+        with engine.begin() as conn:
+            deleted = [(key,) for key, state, data in rows if state is None and data == "{}"]
+            upserts = [(key, state, data, now) for key, state, data in rows
+                       if not (state is None and data == "{}")]
+            if deleted:
+                conn.exec_driver_sql("DELETE FROM fsm_storage WHERE key = ?", deleted)
+            if upserts:
+                conn.exec_driver_sql(
+                    "INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state = excluded.state, "
+                    "data = excluded.data, updated_at = excluded.updated_at",
+                    upserts,
+                )
+
+    @staticmethod
+    def _upsert_column(conn, key: str, column: str, value: str):
+        """Пишет одну колонку (state или data), не трогая другую; пустая запись удаляется."""
+        conn.exec_driver_sql(
+            "INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+            f"ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}, updated_at = excluded.updated_at",
+            (key, value if column == "state" else None, value if column == "data" else "{}", time.time()),
+        )
+        conn.exec_driver_sql(
+            "DELETE FROM fsm_storage WHERE key = ? AND state IS NULL AND data = '{}'", (key,)
+        )
+
+    @classmethod
+    def _write_column(cls, key: str, column: str, value: str):
+        with engine.begin() as conn:
+            cls._upsert_column(conn, key, column, value)
+
+    @classmethod
+    def _merge_data(cls, key: str, data: dict) -> dict:
+        """update_data без кеша: чтение и запись data в одной транзакции."""
+        with engine.connect() as conn:
+            # IMMEDIATE берёт блокировку записи сразу: другой процесс не вклинится
+            # между чтением и записью и не потеряет свои ключи
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+            row = conn.exec_driver_sql("SELECT data FROM fsm_storage WHERE key = ?", (key,)).first()
+            merged = json.loads(row[0]) if row else {}
+            merged.update(data)
+            cls._upsert_column(conn, key, "data", json.dumps(merged, ensure_ascii=False))
+            conn.commit()
+        return merged
+
+    @staticmethod
+    def _delete_older_than(cutoff: float) -> int:
+        with engine.begin() as conn:
+            return conn.exec_driver_sql(
+                "DELETE FROM fsm_storage WHERE updated_at < ?", (cutoff,)
+            ).rowcount
+
+    # ---- кеш ----
+    async def _entry(self, key: str) -> _FSMEntry:
+        entry = self._entries.get(key)
+        if entry is None:
+            loaded = await asyncio.to_thread(self._load, key)
+            # Пока шло чтение, эту запись мог загрузить другой апдейт — берём уже закешированную
+            entry = self._entries.setdefault(key, loaded)
+        entry.touched = time.monotonic()
+        return entry
+
+    async def _save(self, key: str, entry: _FSMEntry):
+        self._dirty.add(key)
+        if self._flusher is None:
+            # Запускается с первой записью, останавливается в close()
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        rows = []
+        for key in keys:
+            entry = self._entries.get(key)
+            if entry is None:
+                continue
+            try:
+                rows.append((key, entry.state, json.dumps(entry.data, ensure_ascii=False)))
+            except (TypeError, ValueError) as e:
+                logging.error(f"FSM: данные {key} не сериализуются в JSON, пропущены: {e}")
+        try:
+            await asyncio.to_thread(self._write, rows)
+            FSM_FLUSH_ROWS.observe(len(rows))
+        except Exception as e:
+            # Вернём ключи в очередь — запишутся при следующем сбросе
+            self._dirty |= keys
+            logging.error(f"FSM: не удалось сохранить {len(rows)} записей: {e}")
+
+    def _evict_idle(self):
+        cutoff = time.monotonic() - self.idle_ttl
+        idle = [key for key, entry in self._entries.items()
+                if entry.touched < cutoff and key not in self._dirty]
+        for key in idle:
+            del self._entries[key]
+        FSM_CACHE_SIZE.set(value=len(self._entries))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                self._evict_idle()
+                if time.monotonic() - self._last_cleanup >= 3600:
+                    self._last_cleanup = time.monotonic()
+                    removed = await asyncio.to_thread(self._delete_older_than, time.time() - self.state_ttl)
+                    if removed:
+                        logging.info(f"FSM: удалено {removed} заброшенных состояний")
+            except Exception as e:
+                logging.error(f"Ошибка в цикле сброса FSM: {e}")
+
+    # ---- интерфейс BaseStorage ----
+    async def _get(self, key: StorageKey) -> _FSMEntry:
+        raw_key = self.key_builder.build(key)
+        if self.cache:
+            return await self._entry(raw_key)
+        return await asyncio.to_thread(self._load, raw_key)
+
+    # Без кеша запись меняет только свою колонку: state и data одной записи могут
+    # одновременно менять апдейты в разных процессах
+    async def set_state(self, key: StorageKey, state=None) -> None:
+        state = state.state if isinstance(state, State) else state
+        raw_key = self.key_builder.build(key)
+        if not self.cache:
+            await asyncio.to_thread(self._write_column, raw_key, "state", state)
+            return
+        entry = await self._entry(raw_key)
+        entry.state = state
+        await self._save(raw_key, entry)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return (await self._get(key)).state
+
+    async def set_data(self, key: StorageKey, data) -> None:
+        raw_key = self.key_builder.build(key)
+        if not self.cache:
+            await asyncio.to_thread(self._write_column, raw_key, "data", json.dumps(dict(data), ensure_ascii=False))
+            return
+        entry = await self._entry(raw_key)
+        entry.data = dict(data)
+        await self._save(raw_key, entry)
+
+    async def get_data(self, key: StorageKey) -> dict:
+        return dict((await self._get(key)).data)
+
+    async def update_data(self, key: StorageKey, data) -> dict:
+        raw_key = self.key_builder.build(key)
+        if not self.cache:
+            return await asyncio.to_thread(self._merge_data, raw_key, dict(data))
+        entry = await self._entry(raw_key)
+        entry.data.update(data)
+        await self._save(raw_key, entry)
+        return dict(entry.data)
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+
+def create_storage() -> BaseStorage:
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    # Несколько воркеров делят одну таблицу — кеш в памяти у каждого разошёлся бы
+    return SQLiteStorage(FSM_FLUSH_INTERVAL, FSM_IDLE_TTL, FSM_STATE_TTL, cache=not MULTI_WORKER)
 
 
 class RequestFSM(StatesGroup):
@@ -350,84 +1489,439 @@ class DeleteAdminFSM(StatesGroup):
     Listing = State()
 
 
+class BulkFSM(StatesGroup):
+    Selecting = State()
+    RejectionReason = State()
+
+
+# -------------------------------------------------------
+# МАРШРУТИЗАЦИЯ CALLBACK
+# -------------------------------------------------------
+class CallbackRoute:
+    __slots__ = ("name", "handler", "states", "arg_type", "wants_state", "once")
+
+    def __init__(self, name, handler, states, arg_type, once=False):
+        self.name = name
+        self.handler = handler
+        # None — любое состояние, иначе множество строк вида "RequestFSM:Confirm"
+        self.states = {s.state for s in states} if states else None
+        self.arg_type = arg_type
+        self.wants_state = "state" in inspect.signature(handler).parameters
+        # Кнопка меняет данные: повторное нажатие на том же сообщении не обрабатывается
+        self.once = once
+
+
+class CallbackRouter:
+    """
+    Таблица маршрутов для callback_data вида "<действие>" или "<действие>_<аргумент>".
+    Вместо цепочки фильтров F.data == ... / F.data.startswith(...) — не больше
+    трёх поисков в словаре: точное совпадение, числовой аргумент после последнего
+    "_" (approve_15, accept_rules_15), строковый после первого (edit_phone).
+    Формат данных прежний, поэтому кнопки в уже отправленных сообщениях работают.
+
+    Маршруты с once=True выполняются один раз на ключ «пользователь:сообщение:данные»:
+    двойное нажатие получает пустой callback.answer(). Недавние ключи хранятся
+    в памяти (повтор не доходит до БД), первое нажатие фиксируется в
+    processed_actions — это работает и между воркерами, и после перезапуска.
+    Если обработчик упал или вернул False (действие не выполнено: не админ,
+    пустой выбор), ключ снимается и кнопку можно нажать снова.
+    """
+
+    MAX_DATA_BYTES = 64  # ограничение Telegram на callback_data
+
+    def __init__(self, dedup_ttl: float = CALLBACK_DEDUP_TTL, dedup_size: int = CALLBACK_DEDUP_SIZE):
+        self._exact = {}
+        self._int_args = {}
+        self._str_args = {}
+        self.dedup_ttl = dedup_ttl
+        self._recent = ExpiringMap(dedup_size)
+
+    @classmethod
+    def pack(cls, action: str, arg=None) -> str:
+        data = action if arg is None else f"{action}_{arg}"
+        if len(data.encode("utf-8")) > cls.MAX_DATA_BYTES:
+            raise ValueError(f"callback_data длиннее {cls.MAX_DATA_BYTES} байт: {data!r}")
+        return data
+
+    def exact(self, *names, states=(), once=False):
+        def decorator(handler):
+            route = CallbackRoute(handler.__name__, handler, states, None, once)
+            for name in names:
+                self._exact[name] = route
+            return handler
+        return decorator
+
+    def prefix(self, action: str, arg_type=int, states=(), once=False):
+        table = self._int_args if arg_type is int else self._str_args
+
+        def decorator(handler):
+            table[action] = CallbackRoute(handler.__name__, handler, states, arg_type, once)
+            return handler
+        return decorator
+
+    def resolve(self, data: str):
+        """Возвращает (маршрут, аргумент) или (None, None)."""
+        route = self._exact.get(data)
+        if route is not None:
+            return route, None
+        action, sep, arg = data.rpartition("_")
+        if sep:
+            route = self._int_args.get(action)
+            if route is not None and arg.isdigit():
+                return route, int(arg)
+        action, sep, arg = data.partition("_")
+        if sep:
+            route = self._str_args.get(action)
+            if route is not None:
+                return route, arg
+        return None, None
+
+    async def dispatch(self, callback: CallbackQuery, state: FSMContext, raw_state: Optional[str] = None):
+        route, arg = self.resolve(callback.data or "")
+        if route is None or (route.states is not None and raw_state not in route.states):
+            return UNHANDLED
+
+        trace = current_update.get()
+        if trace is not None:
+            trace.handler = route.name
+        args = [callback]
+        if route.wants_state:
+            args.append(state)
+        if route.arg_type is not None:
+            args.append(arg)
+        if not route.once or self.dedup_ttl <= 0:
+            return await route.handler(*args)
+
+        key = self.action_key(callback)
+        # Ключ ставится до первого await — второе нажатие, пришедшее пока первое
+        # ещё обрабатывается, тоже отсеивается
+        duplicate = key in self._recent
+        self._recent.set(key, True, self.dedup_ttl)
+        try:
+            claimed = not duplicate and await asyncio.to_thread(claim_action, key)
+        except Exception:
+            self._recent.pop(key)
+            raise
+        if not claimed:
+            CALLBACKS_DUPLICATE.inc(route.name)
+            await callback.answer()
+            return None
+        try:
+            result = await route.handler(*args)
+        except Exception:
+            await self.forget(callback)
+            raise
+        if result is False:
+            await self.forget(callback)
+            return None
+        return result
+
+    @staticmethod
+    def action_key(callback: CallbackQuery, data: Optional[str] = None) -> str:
+        message_id = callback.message.message_id if callback.message else callback.inline_message_id
+        return f"{callback.from_user.id}:{message_id}:{data or callback.data}"
+
+    async def forget(self, callback: CallbackQuery, data: Optional[str] = None):
+        """
+        Разрешает нажать кнопку ещё раз (обработчик не смог выполнить действие).
+        data — другая кнопка того же сообщения, по умолчанию нажатая.
+        """
+        key = self.action_key(callback, data)
+        self._recent.pop(key)
+        await asyncio.to_thread(release_action, key)
+
+
+# -------------------------------------------------------
+# КОНТРОЛЬ ВРЕМЕНИ СООБЩЕНИЙ В ГРУППЕ
+# -------------------------------------------------------
+OFF_HOURS_RULE_TEXT = "Согласно правилам группы - писать только с 8 до 20 часов в будние дни"
+
+OFF_HOURS_REPLIES = METRICS.counter(
+    "bot_off_hours_replies_total", "Сообщения в группе в нерабочее время по исходу", ["result"])
+
+
+_MISSING = object()
+
+
+class ExpiringMap:
+    """
+    Словарь с временем жизни записей. Просроченные удаляются при чтении и
+    периодически при записи; при переполнении вытесняются самые старые.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._items = {}
+        self._writes = 0
+
+    def get(self, key, default=None):
+        item = self._items.get(key)
+        if item is None:
+            return default
+        value, expires_at = item
+        if expires_at <= time.monotonic():
+            del self._items[key]
+            return default
+        return value
+
+    def __contains__(self, key) -> bool:
+        return self.get(key, _MISSING) is not _MISSING
+
+    def set(self, key, value, ttl: float):
+        # Переустановка переносит ключ в конец — порядок словаря = порядок записи
+        self._items.pop(key, None)
+        self._items[key] = (value, time.monotonic() + ttl)
+        self._writes += 1
+        if self._writes % 1000 == 0 or len(self._items) > self.max_size:
+            self.purge()
+
+    def pop(self, key, default=None):
+        item = self._items.pop(key, None)
+        return default if item is None else item[0]
+
+    def purge(self):
+        now = time.monotonic()
+        for key in [key for key, (_, expires_at) in self._items.items() if expires_at <= now]:
+            del self._items[key]
+        while len(self._items) > self.max_size:
+            del self._items[next(iter(self._items))]
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class OffHoursGuard:
+    """
+    Ограничивает ответы на сообщения в группе вне рабочего времени: одному
+    пользователю в чате — не чаще раза в window секунд, остальное подавляется.
+    В режиме batch ответы не отправляются сразу: нарушители копятся и раз в
+    notice_interval секунд по каждому чату уходит одно общее напоминание.
+    """
+
+    def __init__(self, bot: Bot, window: float = 3600, batch: bool = False, notice_interval: float = 600):
+        self.bot = bot
+        self.window = window
+        self.batch = batch
+        self.notice_interval = notice_interval
+        self._warned = ExpiringMap()
+        self._pending = {}
+        self._notifier: Optional[asyncio.Task] = None
+
+    async def handle(self, message: Message):
+        key = (message.chat.id, message.from_user.id if message.from_user else 0)
+        if key in self._warned:
+            OFF_HOURS_REPLIES.inc("suppressed")
+            return
+        self._warned.set(key, True, self.window)
+
+        if not self.batch:
+            OFF_HOURS_REPLIES.inc("replied")
+            await message.reply(OFF_HOURS_RULE_TEXT)
+            return
+
+        OFF_HOURS_REPLIES.inc("batched")
+        mention = message.from_user.mention_html() if message.from_user else ""
+        self._pending.setdefault(message.chat.id, {})[key[1]] = mention
+        if self._notifier is None:
+            self._notifier = asyncio.create_task(self._notify_loop())
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        for chat_id, mentions in pending.items():
+            try:
+                await self.bot.send_message(
+                    chat_id,
+                    f"{OFF_HOURS_RULE_TEXT}\n\nНапоминание: {', '.join(filter(None, mentions.values()))}",
+                )
+            except Exception as e:
+                logging.error(f"Не удалось отправить напоминание о времени в чат {chat_id}: {e}")
+
+    async def _notify_loop(self):
+        while True:
+            await asyncio.sleep(self.notice_interval)
+            await self.flush()
+
+    async def close(self) -> None:
+        """Останавливает цикл напоминаний и отправляет накопленные при остановке бота."""
+        if self._notifier is not None:
+            self._notifier.cancel()
+            self._notifier = None
+        await self.flush()
+
+
 # -------------------------------------------------------
 # УСТАНОВКА КОМАНД
 # -------------------------------------------------------
-async def set_bot_commands(bot: Bot):
-    # --- Команды для обычных пользователей (в личных сообщениях) ---
-    user_commands = [
-        BotCommand(command="new", description="Создать новую заявку"),
-        BotCommand(command="start", description="Начать работу"),
-    ]
-    await bot.set_my_commands(user_commands, scope=BotCommandScopeDefault())
+# --- Команды для обычных пользователей (в личных сообщениях) ---
+USER_COMMANDS = [
+    BotCommand(command="new", description="Создать новую заявку"),
+    BotCommand(command="start", description="Начать работу"),
+]
+
+# Команды для root-админа
+ROOT_ADMIN_COMMANDS = [
+    BotCommand(command="addadmin", description="Добавить админа"),
+    BotCommand(command="deladmin", description="Удалить админа"),
+    BotCommand(command="setrules", description="Изменить правило группы"),
+    BotCommand(command="check", description="Проверить заявки"),
+    BotCommand(command="approved", description="Показать одобренные"),
+    BotCommand(command="rejected", description="Показать отклонённые"),
+    BotCommand(command="find", description="Найти заявку"),
+    BotCommand(command="stats", description="Статистика"),
+    BotCommand(command="analytics", description="Аналитика и сроки обработки"),
+    BotCommand(command="export", description="Выгрузить заявки"),
+    BotCommand(command="backup", description="Резервная копия базы"),
+    BotCommand(command="help", description="Помощь"),
+]
+
+# Команды для обычных админов (без addadmin/deladmin)
+NORMAL_ADMIN_COMMANDS = [
+    BotCommand(command="check", description="Проверить заявки"),
+    BotCommand(command="setrules", description="Изменить правило группы"),
+    BotCommand(command="approved", description="Показать одобренные"),
+    BotCommand(command="rejected", description="Показать отклонённые"),
+    BotCommand(command="find", description="Найти заявку"),
+    BotCommand(command="stats", description="Статистика"),
+    BotCommand(command="analytics", description="Аналитика и сроки обработки"),
+    BotCommand(command="export", description="Выгрузить заявки"),
+    BotCommand(command="help", description="Помощь"),
+]
+
+
+def commands_digest(commands) -> str:
+    payload = json.dumps([(c.command, c.description) for c in commands], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def desired_command_scopes(admin_ids) -> dict:
+    """Ключ области -> (scope, набор команд), которые должны стоять сейчас."""
+    scopes = {
+        "default": (BotCommandScopeDefault(), USER_COMMANDS),
+        # --- Убираем все команды из групп ---
+        f"chat:{PRIVATE_GROUP_ID}": (BotCommandScopeChat(chat_id=PRIVATE_GROUP_ID), []),
+    }
+    for telegram_id in set(admin_ids) | {ROOT_ADMIN_ID}:
+        commands = ROOT_ADMIN_COMMANDS if telegram_id == ROOT_ADMIN_ID else NORMAL_ADMIN_COMMANDS
+        scopes[f"chat:{telegram_id}"] = (BotCommandScopeChat(chat_id=telegram_id), commands)
+    return scopes
+
+
+async def _push_commands(bot: Bot, semaphore: asyncio.Semaphore, scope, commands):
+    async with semaphore:
+        for attempt in range(2):
+            try:
+                if commands is None:
+                    await bot.delete_my_commands(scope=scope)
+                else:
+                    await bot.set_my_commands(commands, scope=scope)
+                return
+            except TelegramRetryAfter as e:
+                if attempt:
+                    raise
+                await asyncio.sleep(e.retry_after)
 
-    # --- Убираем все команды из групп ---
-    await bot.set_my_commands([], scope=BotCommandScopeChat(chat_id=PRIVATE_GROUP_ID))
 
+async def set_bot_commands(bot: Bot, chat_ids=None, force: bool = False):
+    """
+    Синхронизирует меню команд с Telegram. Хеш последнего применённого набора
+    хранится по каждой области в bot_command_state, поэтому отправляются только
+    изменившиеся области — не больше COMMANDS_SYNC_CONCURRENCY запросов сразу.
+    chat_ids ограничивает синхронизацию личными чатами этих пользователей
+    (после /addadmin и /deladmin). Возвращает число отправленных областей.
+    """
     with get_db() as db:
-        all_admins = db.query(AdminUser).all()
-        root_in_db = False
-        for adm in all_admins:
-            if adm.telegram_id == ROOT_ADMIN_ID:
-                root_in_db = True
-                break
-        if not root_in_db:
-            new_root = AdminUser(telegram_id=ROOT_ADMIN_ID, full_name="Root Admin")
-            db.add(new_root)
-            db.commit()
-            all_admins.append(new_root)
-
-        # Формируем команды для root-админа
-        root_admin_commands = [
-            BotCommand(command="addadmin", description="Добавить админа"),
-            BotCommand(command="deladmin", description="Удалить админа"),
-            BotCommand(command="setrules", description="Изменить правило группы"),
-            BotCommand(command="check", description="Проверить заявки"),
-            BotCommand(command="approved", description="Показать одобренные"),
-            BotCommand(command="rejected", description="Показать отклонённые"),
-            BotCommand(command="stats", description="Статистика"),
-            BotCommand(command="help", description="Помощь"),
-        ]
-
-        # Формируем команды для обычных админов (без addadmin/deladmin)
-        normal_admin_commands = [
-            BotCommand(command="check", description="Проверить заявки"),
-            BotCommand(command="setrules", description="Изменить правило группы"),
-            BotCommand(command="approved", description="Показать одобренные"),
-            BotCommand(command="rejected", description="Показать отклонённые"),
-            BotCommand(command="stats", description="Статистика"),
-            BotCommand(command="help", description="Помощь"),
-        ]
-
-        # Проставляем каждому админу нужный набор
-        for adm in all_admins:
-            if adm.telegram_id == ROOT_ADMIN_ID:
-                await bot.set_my_commands(
-                    root_admin_commands,
-                    scope=BotCommandScopeChat(chat_id=adm.telegram_id)
-                )
+        admin_ids = [tid for (tid,) in db.query(AdminUser.telegram_id)]
+        applied = {row.scope: row.digest for row in db.query(BotCommandState)}
+
+    desired = {
+        key: (scope, commands, commands_digest(commands))
+        for key, (scope, commands) in desired_command_scopes(admin_ids).items()
+    }
+    # Бывшие админы: убираем персональное меню, у них остаётся меню по умолчанию
+    group_key = f"chat:{PRIVATE_GROUP_ID}"
+    for key in applied:
+        if key.startswith("chat:") and key != group_key and key not in desired:
+            chat_id = int(key.split(":", 1)[1])
+            desired[key] = (BotCommandScopeChat(chat_id=chat_id), None, None)
+
+    if chat_ids is not None:
+        wanted = {f"chat:{chat_id}" for chat_id in chat_ids}
+        desired = {key: value for key, value in desired.items() if key in wanted}
+        for key in wanted - desired.keys():
+            chat_id = int(key.split(":", 1)[1])
+            desired[key] = (BotCommandScopeChat(chat_id=chat_id), None, None)
+
+    changed = {
+        key: value for key, value in desired.items()
+        if force or applied.get(key) != value[2]
+    }
+    if not changed:
+        logging.info(f"Меню команд актуально ({len(desired)} областей), обновление не требуется")
+        return 0
+
+    semaphore = asyncio.Semaphore(COMMANDS_SYNC_CONCURRENCY)
+    keys = list(changed)
+    results = await asyncio.gather(
+        *(_push_commands(bot, semaphore, changed[key][0], changed[key][1]) for key in keys),
+        return_exceptions=True,
+    )
+
+    pushed = 0
+    with get_db() as db:
+        for key, result in zip(keys, results):
+            if isinstance(result, Exception):
+                # Пользователь мог не начинать диалог с ботом — попробуем при следующей синхронизации
+                logging.warning(f"Не удалось обновить команды для {key}: {result}")
+                continue
+            pushed += 1
+            digest = changed[key][2]
+            state = db.get(BotCommandState, key)
+            if digest is None:
+                if state:
+                    db.delete(state)
+            elif state:
+                state.digest = digest
+                state.updated_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             else:
-                await bot.set_my_commands(
-                    normal_admin_commands,
-                    scope=BotCommandScopeChat(chat_id=adm.telegram_id)
-                )
+                db.add(BotCommandState(
+                    scope=key,
+                    digest=digest,
+                    updated_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                ))
+        db.commit()
+
+    logging.info(f"Меню команд: обновлено {pushed} из {len(changed)} изменившихся областей")
+    return pushed
 
 
 # -------------------------------------------------------
 # TELETHON АВТОРИЗАЦИЯ
 # -------------------------------------------------------
+def telethon_session_file(session: str = None) -> str:
+    """Путь к файлу сессии: Telethon добавляет «.session», только если его нет."""
+    session = session or TELETHON_SESSION
+    return session if session.endswith(".session") else session + ".session"
+
+
+def reset_telethon_client():
+    """Следующий get_telethon_client() создаст клиента заново (с текущей TELETHON_SESSION)."""
+    global telethon_client
+    telethon_client = None
+
+
 async def authorize_user():
     """Авторизация Telethon (если сессия не создана — запросит телефон и код)."""
+    client = get_telethon_client()
     try:
         # Проверяем существование файла сессии
-        if os.path.exists(TELETHON_SESSION + '.session'):
+        if os.path.exists(telethon_session_file()):
             try:
                 # Пробуем использовать существующую сессию
-                if not telethon_client.is_connected():
-                    await telethon_client.connect()
+                if not client.is_connected():
+                    await client.connect()
                 
-                if await telethon_client.is_user_authorized():
-                    me = await telethon_client.get_me()
+                if await client.is_user_authorized():
+                    me = await client.get_me()
                     if me:
                         print(f"Telethon: успешно подключен как {me.first_name} (@{me.username})")
                         return True
@@ -435,30 +1929,33 @@ async def authorize_user():
                 print(f"Ошибка при использовании существующей сессии: {e}")
                 # Если сессия недействительна, удаляем файл
                 if "AUTH_KEY_UNREGISTERED" in str(e).upper():
-                    os.remove(TELETHON_SESSION + '.session')
+                    await client.disconnect()
+                    os.remove(telethon_session_file())
+                    reset_telethon_client()
+                    client = get_telethon_client()
                     print("Сессия удалена, начинаем новую авторизацию")
         
         # Если нет действительной сессии, запрашиваем новую авторизацию
-        if not telethon_client.is_connected():
-            await telethon_client.connect()
+        if not client.is_connected():
+            await client.connect()
         
         print("Начинаем новую авторизацию в Telethon...")
         phone = input("Введите номер телефона (в формате +7XXXXXXXXXX): ")
         
         # Отправляем код подтверждения
-        sent_code = await telethon_client.send_code_request(phone)
+        sent_code = await client.send_code_request(phone)
         code = input("Введите код из Telegram: ")
         
         try:
             # Пытаемся войти с полученным кодом
-            await telethon_client.sign_in(phone, code)
+            await client.sign_in(phone, code)
         except SessionPasswordNeededError:
             # Если включена двухфакторная аутентификация
             password = input("Введите пароль двухфакторной аутентификации: ")
-            await telethon_client.sign_in(password=password)
+            await client.sign_in(password=password)
         
         # Проверяем успешность авторизации
-        me = await telethon_client.get_me()
+        me = await client.get_me()
         if not me:
             raise RuntimeError("Не удалось получить информацию о пользователе после авторизации")
         
@@ -467,8 +1964,8 @@ async def authorize_user():
         
     except Exception as e:
         print(f"❌ Ошибка авторизации Telethon: {e}")
-        if telethon_client.is_connected():
-            await telethon_client.disconnect()
+        if client.is_connected():
+            await client.disconnect()
         raise RuntimeError(f"Telethon авторизация не удалась: {e}")
 
     return False
@@ -485,11 +1982,12 @@ async def send_message_as_user(username: str, message: str, parse_mode: str = 'h
     Returns:
         bool: True если сообщение отправлено успешно, False если произошла ошибка
     """
+    client = get_telethon_client()
     try:
-        if not telethon_client.is_connected():
-            await telethon_client.connect()
+        if not client.is_connected():
+            await client.connect()
             
-        if not await telethon_client.is_user_authorized():
+        if not await client.is_user_authorized():
             logging.error("Telethon не авторизован")
             return False
             
@@ -498,16 +1996,16 @@ async def send_message_as_user(username: str, message: str, parse_mode: str = 'h
         
         try:
             # Получаем сущность пользователя
-            user = await telethon_client.get_entity(clean_username)
+            user = await telethon_call("get_entity", client.get_entity(clean_username))
             
             # Отправляем сообщение
-            await telethon_client.send_message(
+            await telethon_call("send_message", client.send_message(
                 user,
                 message,
                 parse_mode=parse_mode
-            )
+            ))
             
-            me = await telethon_client.get_me()
+            me = await telethon_call("get_me", client.get_me())
             logging.info(f"Сообщение отправлено пользователю {clean_username} от {me.first_name} (@{me.username})")
             return True
             
@@ -536,9 +2034,10 @@ async def check_pending_requests(bot: Bot):
             await asyncio.sleep(delay)
             
             # Проверяем заявки
-            with get_db() as db:
+            with traced_job("check_pending_requests"), get_db() as db:
                 # Получаем все pending заявки
                 pending_requests = db.query(UserRequest).filter_by(status="pending").all()
+                SCHEDULER_QUEUE_DEPTH.set("pending_requests", value=len(pending_requests))
                 day_ago = (datetime.now() - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
                 
                 old_requests = [req for req in pending_requests 
@@ -578,121 +2077,1740 @@ async def check_pending_requests(bot: Bot):
             logging.error(f"Ошибка в check_pending_requests: {e}")
             await asyncio.sleep(300)
 
+# Отказы, которые не пройдут при повторе: бот заблокирован, чат удалён или не найден.
+# Остальные ошибки (сеть, 5xx) прерывают проход и отказом записи не считаются
+PERMANENT_SEND_ERRORS = (TelegramForbiddenError, TelegramBadRequest, TelegramNotFound)
+PENDING_DEAD_LETTERS = METRICS.counter(
+    "bot_pending_dead_letters_total", "Отложенных отправок снято после PENDING_MAX_ATTEMPTS отказов",
+    ["table"])
+
+
+def record_delivery_failure(db, rows: list, error: Exception):
+    """Считает отказ Bot API по записям очереди; после PENDING_MAX_ATTEMPTS помечает их мёртвыми."""
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for row in rows:
+        row.attempts = (row.attempts or 0) + 1
+        row.last_error = str(error)[:200]
+        if row.attempts >= PENDING_MAX_ATTEMPTS:
+            row.dead_at = now
+            PENDING_DEAD_LETTERS.inc(row.__tablename__)
+            logging.warning(f"{row.__tablename__} #{row.id}: {row.attempts} отказов, больше не отправляется ({error})")
+    db.commit()
+
+
+async def deliver_pending_invites(bot: Bot):
+    """Один проход: рассылает ссылки, отложенные до рабочего времени."""
+    with traced_job("check_pending_invites"), get_db() as db:
+        pending_invites = db.query(PendingInvite).filter(PendingInvite.dead_at.is_(None)).all()
+        SCHEDULER_QUEUE_DEPTH.set("pending_invites", value=len(pending_invites))
+
+        for invite in pending_invites:
+            # Получаем данные заявки
+            req = db.query(UserRequest).filter_by(id=invite.request_id).first()
+            if not req:
+                # Если заявка не найдена, удаляем отложенное приглашение
+                db.delete(invite)
+                db.commit()
+                continue
+
+            try:
+                # Создаем ссылку-приглашение
+                link = await bot.create_chat_invite_link(
+                    PRIVATE_GROUP_ID,
+                    member_limit=1
+                )
+            except Exception as e:
+                # Ошибка общая для всех ссылок — прерываем проход, отказом записи не считаем
+                logging.error(f"Ошибка при создании отложенной ссылки: {e}")
+                return
+
+            try:
+                # Отправляем ссылку
+                await bot.send_message(
+                    chat_id=invite.chat_id,
+                    text=(
+                        "🎉 <b>Добрый день!</b>\n\n"
+                        "Вы ранее приняли правила группы в нерабочее время.\n"
+                        f"Вот ваша ссылка для вступления в группу: {link.invite_link}"
+                    ),
+                    parse_mode="HTML"
+                )
+            except PERMANENT_SEND_ERRORS as e:
+                # Пользователь заблокировал бота и т. п. — остальным ссылки отправляем
+                logging.error(f"Отложенная ссылка для {invite.chat_id} не отправлена: {e}")
+                record_delivery_failure(db, [invite], e)
+                continue
+            except Exception as e:
+                # Прерываем проход, остальные ссылки уйдут в следующий раз
+                logging.error(f"Ошибка при отправке отложенной ссылки: {e}")
+                return
+
+            # Уведомляем админов
+            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            admins = db.query(AdminUser).all()
+            for admin in admins:
+                try:
+                    await bot.send_message(
+                        chat_id=admin.telegram_id,
+                        text=f"✅ Пользователь {req.full_name} (заявка #{req.id}) получил отложенную ссылку на группу.\n📅 Дата: {current_time}"
+                    )
+                except Exception as e:
+                    logging.error(f"Ошибка отправки уведомления админу {admin.telegram_id}: {e}")
+
+            # Удаляем запись из отложенных
+            db.delete(invite)
+            db.commit()
+
+
 async def check_pending_invites(bot: Bot):
     while True:
         try:
             # Проверяем каждые 5 минут
             await asyncio.sleep(300)
-            
+
             # Если не рабочее время, пропускаем проверку
             if not is_work_time():
                 continue
-                
-            with get_db() as db:
-                pending_invites = db.query(PendingInvite).all()
-                
-                for invite in pending_invites:
-                    try:
-                        # Создаем ссылку-приглашение
-                        link = await bot.create_chat_invite_link(
-                            PRIVATE_GROUP_ID,
-                            member_limit=1
-                        )
-                        
-                        # Получаем данные заявки
-                        req = db.query(UserRequest).filter_by(id=invite.request_id).first()
-                        if not req:
-                            # Если заявка не найдена, удаляем отложенное приглашение
-                            db.delete(invite)
-                            db.commit()
-                            continue
-                        
-                        # Отправляем ссылку
-                        await bot.send_message(
-                            chat_id=invite.chat_id,
-                            text=(
-                                "🎉 <b>Добрый день!</b>\n\n"
-                                "Вы ранее приняли правила группы в нерабочее время.\n"
-                                f"Вот ваша ссылка для вступления в группу: {link.invite_link}"
-                            ),
-                            parse_mode="HTML"
-                        )
-                        
-                        # Уведомляем админов
-                        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        admins = db.query(AdminUser).all()
-                        for admin in admins:
-                            try:
-                                await bot.send_message(
-                                    chat_id=admin.telegram_id,
-                                    text=f"✅ Пользователь {req.full_name} (заявка #{req.id}) получил отложенную ссылку на группу.\n📅 Дата: {current_time}"
-                                )
-                            except Exception as e:
-                                logging.error(f"Ошибка отправки уведомления админу {admin.telegram_id}: {e}")
-                        
-                        # Удаляем запись из отложенных
-                        db.delete(invite)
-                        db.commit()
-                        
-                    except Exception as e:
-                        logging.error(f"Ошибка при отправке отложенной ссылки: {e}")
-                        await asyncio.sleep(300)
-                        
+
+            await deliver_pending_invites(bot)
+
         except Exception as e:
             logging.error(f"Ошибка в check_pending_invites: {e}")
             await asyncio.sleep(300)
 
-async def check_pending_join_notifications(bot: Bot):
+
+def format_greeting(full_name, workplace, position) -> str:
+    return (
+        f"👋 Добро пожаловать, {full_name}!\n"
+        f"🏢 Место работы: {workplace}\n"
+        f"💼 Должность: {position}\n"
+    )
+
+
+def merge_greetings(greetings: list, per_message: int = 10, max_length: int = 4096) -> list:
+    """Склеивает приветствия в сообщения: не больше per_message штук и max_length символов."""
+    messages, current, length = [], [], 0
+    for greeting in greetings:
+        if current and (len(current) >= per_message or length + len(greeting) + 1 > max_length):
+            messages.append(current)
+            current, length = [], 0
+        current.append(greeting)
+        length += len(greeting) + 1
+    if current:
+        messages.append(current)
+    return messages
+
+
+async def deliver_pending_join_notifications(bot: Bot):
+    """Один проход: публикует приветствия, отложенные до рабочего времени."""
+    with traced_job("check_pending_join_notifications"), get_db() as db:
+        pending_notifications = (
+            db.query(PendingJoinNotification)
+            .filter(PendingJoinNotification.dead_at.is_(None))
+            .order_by(PendingJoinNotification.id)
+            .all()
+        )
+        SCHEDULER_QUEUE_DEPTH.set("pending_join_notifications", value=len(pending_notifications))
+
+        by_chat = {}
+        for notification in pending_notifications:
+            by_chat.setdefault(notification.chat_id, []).append(notification)
+
+        for chat_id, notifications in by_chat.items():
+            greetings = [format_greeting(n.full_name, n.workplace, n.position) for n in notifications]
+            sent = 0
+            for batch in merge_greetings(greetings, JOIN_GREETINGS_PER_MESSAGE):
+                try:
+                    # Одно сообщение в группу на несколько вошедших
+                    await bot.send_message(chat_id=chat_id, text="\n".join(batch))
+
+                    # Удаляем отправленные записи из отложенных
+                    for notification in notifications[sent:sent + len(batch)]:
+                        db.delete(notification)
+                    db.commit()
+                    sent += len(batch)
+
+                except PERMANENT_SEND_ERRORS as e:
+                    # Бота удалили из чата — в этот чат больше не пытаемся, остальным отправляем
+                    logging.error(f"Отложенные уведомления о входе в {chat_id} не отправлены: {e}")
+                    record_delivery_failure(db, notifications[sent:], e)
+                    break
+
+                except Exception as e:
+                    # Прерываем проход, остальные уведомления уйдут в следующий раз
+                    logging.error(f"Ошибка при отправке отложенного уведомления о входе: {e}")
+                    return
+
+
+JOIN_BATCH_SIZE = METRICS.histogram(
+    "bot_join_batch_members", "Вошедших участников в одной пачке JoinBatcher",
+    buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+
+class JoinBatcher:
+    """
+    Копит вступления в группу за window секунд (в том числе из разных апдейтов)
+    и обрабатывает их пачкой: одна выборка заявок по всем участникам, одна
+    транзакция для отложенных приветствий, приветствия склеены в общие сообщения.
+    """
+
+    def __init__(self, bot: Bot, window: float = 2.0, per_message: int = 10):
+        self.bot = bot
+        self.window = window
+        self.per_message = per_message
+        self._pending = {}
+        self._timers = {}
+
+    async def add(self, chat_id: int, member_ids: list):
+        members = self._pending.setdefault(chat_id, [])
+        members.extend(member_id for member_id in member_ids if member_id not in members)
+        if self.window <= 0:
+            await self.flush(chat_id)
+        elif chat_id not in self._timers:
+            self._timers[chat_id] = asyncio.create_task(self._flush_later(chat_id))
+
+    async def _flush_later(self, chat_id: int):
+        await asyncio.sleep(self.window)
+        self._timers.pop(chat_id, None)
+        try:
+            await self.flush(chat_id)
+        except Exception as e:
+            logging.error(f"Ошибка при обработке вступлений в чат {chat_id}: {e}")
+            await send_error_to_monitor(e, {"component": "join_batcher", "chat_id": chat_id})
+
+    @staticmethod
+    def _latest_requests(db, member_ids: list) -> dict:
+        """Самая новая заявка каждого участника — одним запросом."""
+        latest_ids = (
+            db.query(func.max(UserRequest.id))
+            .filter(UserRequest.chat_id.in_(member_ids))
+            .group_by(UserRequest.chat_id)
+        )
+        return {req.chat_id: req for req in db.query(UserRequest).filter(UserRequest.id.in_(latest_ids))}
+
+    async def flush(self, chat_id: int):
+        member_ids = self._pending.pop(chat_id, [])
+        if not member_ids:
+            return
+        JOIN_BATCH_SIZE.observe(len(member_ids))
+
+        with traced_job("join_batch"), get_db() as db:
+            requests_by_member = self._latest_requests(db, member_ids)
+            # Порядок приветствий — порядок вступления
+            requests = [requests_by_member[m] for m in member_ids if m in requests_by_member]
+            if not requests:
+                return
+
+            # Первое вступление по одобренной заявке — событие для аналитики
+            created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+            rollup = AnalyticsRollup()
+            for req in requests:
+                if req.status == "approved" and not req.joined_at:
+                    req.joined_at = created_at
+                    rollup.add_event("joined", created_at, req)
+            rollup.flush(db.connection())
+
+            # Проверяем, рабочее ли сейчас время
+            if not is_work_time():
+                # Сохраняем информацию для отложенной отправки
+                db.add_all([
+                    PendingJoinNotification(
+                        user_id=req.chat_id,
+                        chat_id=chat_id,
+                        full_name=req.full_name,
+                        workplace=req.workplace,
+                        position=req.position,
+                        created_at=created_at,
+                    )
+                    for req in requests
+                ])
+                with safe_commit(db):
+                    pass
+                return
+
+            greetings = [format_greeting(req.full_name, req.workplace, req.position) for req in requests]
+            with safe_commit(db):
+                pass
+
+        # Если рабочее время, отправляем сразу (сессия уже закрыта)
+        for batch in merge_greetings(greetings, self.per_message):
+            await self.bot.send_message(chat_id=chat_id, text="\n".join(batch))
+
+    async def close(self):
+        """Обрабатывает всё накопленное (при остановке бота)."""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for chat_id in list(self._pending):
+            try:
+                await self.flush(chat_id)
+            except Exception as e:
+                logging.error(f"Ошибка при обработке вступлений в чат {chat_id}: {e}")
+
+
+async def check_pending_join_notifications(bot: Bot):
+    while True:
+        try:
+            # Проверяем каждые 5 минут
+            await asyncio.sleep(300)
+
+            # Если не рабочее время, пропускаем проверку
+            if not is_work_time():
+                continue
+
+            await deliver_pending_join_notifications(bot)
+
+        except Exception as e:
+            logging.error(f"Ошибка в check_pending_join_notifications: {e}")
+            await asyncio.sleep(300)
+
+
+# -------------------------------------------------------
+# ХРАНЕНИЕ СЛУЖЕБНЫХ ТАБЛИЦ
+# -------------------------------------------------------
+# Очереди отложенной отправки и таблицы отсева повторов сами не пустеют, если запись
+# не может уйти: ссылка на удалённую заявку, чат, куда бот больше не может писать.
+# apply_retention удаляет такие строки по правилам ниже пачками, каждая — своя
+# транзакция, и возвращает освободившиеся страницы ОС (PRAGMA incremental_vacuum).
+RETENTION_DELETED = METRICS.counter(
+    "bot_retention_deleted_total", "Строк удалено очисткой служебных таблиц", ["table", "reason"])
+DB_FILE_BYTES = METRICS.gauge("bot_db_file_bytes", "Размер файла БД после очистки, байт")
+DB_FREE_PAGES = METRICS.gauge("bot_db_free_pages", "Свободных страниц в файле БД после очистки")
+
+
+def retention_rules(now: datetime = None) -> list:
+    """(таблица, причина, условие WHERE, параметры) — что удаляет apply_retention."""
+    now = now or datetime.now()
+
+    def days_ago(days: int) -> str:
+        return (now - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+
+    rules = [
+        # Заявки нет ни в рабочей таблице, ни в архиве — ссылку отправлять некому
+        ("pending_invites", "orphan",
+         "NOT EXISTS (SELECT 1 FROM user_requests WHERE id = pending_invites.request_id) "
+         "AND NOT EXISTS (SELECT 1 FROM user_requests_archive WHERE id = pending_invites.request_id)", ()),
+    ]
+    if PENDING_INVITE_TTL_DAYS > 0:
+        rules.append(("pending_invites", "expired", "created_at < ?",
+                      (days_ago(PENDING_INVITE_TTL_DAYS),)))
+    if PENDING_JOIN_TTL_DAYS > 0:
+        rules.append(("pending_join_notifications", "expired", "created_at < ?",
+                      (days_ago(PENDING_JOIN_TTL_DAYS),)))
+    for table in PENDING_TABLES:
+        rules.append((table, "dead", "dead_at <= ?", (days_ago(DEAD_LETTER_TTL_DAYS),)))
+    rules += [
+        ("processed_updates", "expired", "received_at < ?", (now.timestamp() - PROCESSED_UPDATES_TTL,)),
+        ("processed_actions", "expired", "created_at < ?", (now.timestamp() - CALLBACK_DEDUP_TTL,)),
+    ]
+    return rules
+
+
+def delete_in_batches(table: str, where: str, params: tuple, batch_size: int) -> int:
+    """DELETE по условию пачками по batch_size строк, каждая в своей транзакции."""
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            count = conn.exec_driver_sql(
+                f"DELETE FROM {table} WHERE rowid IN (SELECT rowid FROM {table} WHERE {where} LIMIT ?)",
+                (*params, batch_size),
+            ).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+
+
+def database_pages(conn) -> dict:
+    """{"pages", "free_pages", "page_size", "auto_vacuum"} файла SQLite."""
+    return {
+        "pages": conn.exec_driver_sql("PRAGMA page_count").scalar(),
+        "free_pages": conn.exec_driver_sql("PRAGMA freelist_count").scalar(),
+        "page_size": conn.exec_driver_sql("PRAGMA page_size").scalar(),
+        # 0 — NONE, 1 — FULL, 2 — INCREMENTAL
+        "auto_vacuum": conn.exec_driver_sql("PRAGMA auto_vacuum").scalar(),
+    }
+
+
+def run_driver_script(sql: str):
+    """
+    Выполняет SQL через sqlite3.executescript. execute() делает один шаг
+    PRAGMA incremental_vacuum (одна страница), а VACUUM нельзя выполнять в транзакции.
+    """
+    raw = engine.raw_connection()
+    try:
+        raw.driver_connection.executescript(sql)
+    finally:
+        raw.close()
+
+
+def apply_retention(batch_size: int = None, vacuum_pages: int = None) -> dict:
+    """
+    Один проход очистки по retention_rules и incremental_vacuum до vacuum_pages
+    страниц (0 — все свободные). Возвращает {"deleted": {(таблица, причина): строк},
+    "vacuumed", "bytes_before", "bytes_after", "free_pages", "auto_vacuum", "seconds"}.
+    """
+    batch_size = batch_size or RETENTION_BATCH_SIZE
+    vacuum_pages = RETENTION_VACUUM_PAGES if vacuum_pages is None else vacuum_pages
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        before = database_pages(conn)
+
+    deleted = {}
+    for table, reason, where, params in retention_rules():
+        count = delete_in_batches(table, where, params, batch_size)
+        if count:
+            deleted[(table, reason)] = deleted.get((table, reason), 0) + count
+            RETENTION_DELETED.inc(table, reason, value=count)
+
+    if before["auto_vacuum"] == 2:
+        run_driver_script(f"PRAGMA incremental_vacuum({int(vacuum_pages)})")
+    with engine.connect() as conn:
+        after = database_pages(conn)
+    stats = {
+        "deleted": deleted,
+        "vacuumed": max(0, before["pages"] - after["pages"]),
+        "bytes_before": before["pages"] * before["page_size"],
+        "bytes_after": after["pages"] * after["page_size"],
+        "free_pages": after["free_pages"],
+        "auto_vacuum": after["auto_vacuum"],
+        "seconds": time.perf_counter() - started,
+    }
+    DB_FILE_BYTES.set(value=stats["bytes_after"])
+    DB_FREE_PAGES.set(value=stats["free_pages"])
+    return stats
+
+
+def format_retention_stats(stats: dict) -> str:
+    deleted = ", ".join(f"{table}/{reason} {count}" for (table, reason), count in stats["deleted"].items())
+    text = (f"Очистка за {stats['seconds']:.1f} с: удалено {deleted or 'ничего'}; "
+            f"файл БД {stats['bytes_before'] / 1024 / 1024:.1f} → {stats['bytes_after'] / 1024 / 1024:.1f} МБ, "
+            f"возвращено страниц {stats['vacuumed']}, свободных {stats['free_pages']}")
+    if stats["auto_vacuum"] != 2 and stats["free_pages"]:
+        text += " (auto_vacuum выключен — однократно выполните `python bot.py vacuum`)"
+    return text
+
+
+def enable_incremental_vacuum() -> dict:
+    """
+    Переводит существующую базу в auto_vacuum=INCREMENTAL: полный VACUUM переписывает
+    файл целиком и держит блокировку, поэтому запускается вручную при остановленном боте.
+    """
+    run_driver_script("PRAGMA auto_vacuum=INCREMENTAL; VACUUM;")
+    with engine.connect() as conn:
+        return database_pages(conn)
+
+
+async def apply_retention_periodically():
+    """Раз в RETENTION_INTERVAL чистит служебные таблицы (раньше — только processed_* раз в час)."""
+    while True:
+        try:
+            await asyncio.sleep(RETENTION_INTERVAL)
+            with traced_job("retention"):
+                stats = await asyncio.to_thread(apply_retention)
+            logging.info(format_retention_stats(stats))
+        except Exception as e:
+            logging.error(f"Ошибка в apply_retention_periodically: {e}")
+
+
+# -------------------------------------------------------
+# РЕЗЕРВНЫЕ КОПИИ БАЗЫ
+# -------------------------------------------------------
+# Копия файла во время записи может оказаться рваной, а остановка бота — это простой.
+# Копия снимается через sqlite3 backup API в отдельном потоке шагами по
+# BACKUP_PAGES_PER_STEP страниц с паузой между ними. Источник держит открытую читающую
+# транзакцию: в WAL это фиксирует снимок, поэтому запись других соединений между шагами
+# не перезапускает копирование и сама не ждёт. До конца копии не проходит checkpoint,
+# и -wal растёт на объём записанного за это время.
+BACKUP_SECONDS = METRICS.histogram(
+    "bot_backup_seconds", "Время резервного копирования БД",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+BACKUP_BYTES = METRICS.gauge("bot_backup_bytes", "Размер последней резервной копии, байт")
+BACKUP_FAILURES = METRICS.counter("bot_backup_failures_total", "Неудачных резервных копирований")
+
+# /backup и копия по расписанию в одном процессе не идут одновременно
+backup_lock = asyncio.Lock()
+
+
+def database_path() -> str:
+    if engine.dialect.name != "sqlite" or not engine.url.database or engine.url.database == ":memory:":
+        raise RuntimeError("Резервное копирование поддерживается только для SQLite в файле")
+    return os.path.abspath(engine.url.database)
+
+
+def backup_database(target_path: str, pages: int = None, pause: float = None) -> dict:
+    """
+    Копирует базу в target_path через sqlite3 backup API. Возвращает
+    {"steps", "pages", "page_size", "wal"}; wal=False — база не в WAL, копия одним шагом.
+    """
+    pages = BACKUP_PAGES_PER_STEP if pages is None else pages
+    pause = BACKUP_STEP_PAUSE if pause is None else pause
+    stats = {"steps": 0, "pages": 0}
+
+    def progress(status, remaining, total):
+        stats["steps"] += 1
+        stats["pages"] = total
+
+    source = sqlite3.connect(database_path(), isolation_level=None)
+    try:
+        stats["page_size"] = source.execute("PRAGMA page_size").fetchone()[0]
+        stats["wal"] = source.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+        if stats["wal"]:
+            # Читающая транзакция фиксирует снимок на всё время копирования
+            source.execute("BEGIN")
+            source.execute("SELECT COUNT(*) FROM sqlite_master").fetchone()
+        else:
+            # Без WAL чужая запись между шагами перезапускает копию с начала
+            pages = -1
+        target = sqlite3.connect(target_path)
+        try:
+            source.backup(target, pages=pages, progress=progress, sleep=pause)
+            check = target.execute("PRAGMA quick_check").fetchone()[0]
+            if check != "ok":
+                raise RuntimeError(f"Копия не прошла quick_check: {check}")
+        finally:
+            target.close()
+    finally:
+        source.close()
+    return stats
+
+
+def compress_file(path: str, target_path: str, level: int, chunk_size: int, pause: float):
+    """gzip кусками по chunk_size с паузой: на одном ядре сжатие иначе отнимает CPU у loop."""
+    with open(path, "rb") as src, gzip.open(target_path, "wb", compresslevel=level) as dst:
+        while chunk := src.read(chunk_size):
+            dst.write(chunk)
+            time.sleep(pause)
+
+
+def list_backups(directory: str = None) -> list:
+    """Готовые копии текущей базы, от старых к новым (в имени — время снятия)."""
+    prefix = os.path.splitext(os.path.basename(database_path()))[0]
+    return sorted(glob.glob(os.path.join(directory or BACKUP_DIR, f"{prefix}-*.db*")))
+
+
+def prune_backups(directory: str = None, keep: int = None) -> list:
+    """Удаляет копии сверх keep последних; возвращает удалённые пути."""
+    keep = BACKUP_KEEP if keep is None else keep
+    backups = list_backups(directory)
+    removed = backups[:-keep] if keep > 0 else []
+    for path in removed:
+        os.remove(path)
+    return removed
+
+
+def create_backup(directory: str = None, compress: int = None, keep: int = None) -> dict:
+    """
+    Снимает копию в directory/<база>-ГГГГММДД-ЧЧММСС.db[.gz] и удаляет старые.
+    Файл появляется под итоговым именем только целиком (os.replace).
+    Возвращает статистику backup_database и {"path", "bytes", "db_bytes", "removed", "seconds"}.
+    """
+    directory = directory or BACKUP_DIR
+    compress = BACKUP_COMPRESS if compress is None else compress
+    started = time.perf_counter()
+    os.makedirs(directory, exist_ok=True)
+    prefix = os.path.splitext(os.path.basename(database_path()))[0]
+    name = f"{prefix}-{datetime.now():%Y%m%d-%H%M%S}.db" + (".gz" if compress else "")
+    path = os.path.join(directory, name)
+    tmp = os.path.join(directory, f".{name}.{os.getpid()}.tmp")
+    try:
+        stats = backup_database(tmp)
+        stats["db_bytes"] = os.path.getsize(tmp)
+        if compress:
+            compress_file(tmp, tmp + ".gz", compress,
+                          max(1, BACKUP_PAGES_PER_STEP) * stats["page_size"], BACKUP_STEP_PAUSE)
+            os.replace(tmp + ".gz", path)
+        else:
+            os.replace(tmp, path)
+    finally:
+        for leftover in (tmp, tmp + ".gz"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+    stats.update(
+        path=path,
+        bytes=os.path.getsize(path),
+        removed=prune_backups(directory, keep),
+        seconds=time.perf_counter() - started,
+    )
+    return stats
+
+
+def format_backup_stats(stats: dict) -> str:
+    text = (f"Резервная копия {os.path.basename(stats['path'])}: "
+            f"{stats['bytes'] / 1024 / 1024:.1f} МБ (база {stats['db_bytes'] / 1024 / 1024:.1f} МБ) "
+            f"за {stats['seconds']:.1f} с, шагов {stats['steps']}")
+    if not stats["wal"]:
+        text += " (база не в WAL — копия одним шагом)"
+    if stats["removed"]:
+        text += f"; удалено старых копий: {len(stats['removed'])}"
+    return text
+
+
+async def run_backup() -> dict:
+    """create_backup в отдельном потоке, не больше одной копии за раз в процессе."""
+    async with backup_lock:
+        try:
+            with traced_job("backup"):
+                stats = await asyncio.to_thread(create_backup)
+        except Exception:
+            BACKUP_FAILURES.inc()
+            raise
+    BACKUP_SECONDS.observe(stats["seconds"])
+    BACKUP_BYTES.set(value=stats["bytes"])
+    return stats
+
+
+async def backup_periodically():
+    """Раз в BACKUP_INTERVAL снимает резервную копию базы."""
+    while True:
+        try:
+            await asyncio.sleep(BACKUP_INTERVAL)
+            logging.info(format_backup_stats(await run_backup()))
+        except Exception as e:
+            logging.error(f"Ошибка в backup_periodically: {e}")
+
+
+# -------------------------------------------------------
+# ЭКСПОРТ ЗАЯВОК
+# -------------------------------------------------------
+EXPORT_COLUMNS = [
+    ("id", "№"),
+    ("status", "Статус"),
+    ("person_type", "Тип"),
+    ("full_name", "ФИО"),
+    ("phone", "Телефон"),
+    ("workplace", "Место работы"),
+    ("position", "Должность"),
+    ("username", "Username"),
+    ("chat_id", "Chat ID"),
+    ("created_at", "Создана"),
+    ("approved_at", "Одобрена"),
+    ("approved_by", "Одобрил"),
+    ("rejected_at", "Отклонена"),
+    ("rejected_by", "Отклонил"),
+    ("rejection_reason", "Причина отказа"),
+    ("rules_accepted_at", "Правила приняты"),
+]
+EXPORT_STATUSES = {"pending", "approved", "rejected"}
+EXPORT_MAX_BYTES = 50 * 1024 * 1024  # лимит Bot API на отправку документа
+
+
+def parse_export_args(text: str) -> dict:
+    """
+    /export [pending|approved|rejected|all] [ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]] [csv|xlsx]
+    Аргументы в любом порядке; первая дата — начало, вторая — конец (включительно).
+    """
+    options = {"status": None, "date_from": None, "date_to": None, "fmt": "csv"}
+    dates = []
+    for token in text.split()[1:]:
+        token = token.lower()
+        if token in EXPORT_STATUSES:
+            options["status"] = token
+        elif token == "all":
+            options["status"] = None
+        elif token in ("csv", "xlsx"):
+            options["fmt"] = token
+        else:
+            dates.append(datetime.strptime(token, "%Y-%m-%d"))
+    if len(dates) > 2:
+        raise ValueError("не больше двух дат")
+    if dates:
+        options["date_from"] = dates[0].strftime("%Y-%m-%d")
+    if len(dates) == 2:
+        # created_at хранится строкой, поэтому конец — начало следующего дня
+        options["date_to"] = (dates[1] + timedelta(days=1)).strftime("%Y-%m-%d")
+    return options
+
+
+def iter_export_rows(status=None, date_from=None, date_to=None):
+    """
+    Строки заявок кусками по EXPORT_CHUNK_SIZE (yield_per: курсор читается
+    по мере записи, ORM-объекты не создаются) — память не растёт с числом строк.
+    """
+    # Вместе с архивом: представление user_requests_all
+    table = ALL_REQUESTS.c
+    columns = [table[name] for name, _ in EXPORT_COLUMNS]
+    with get_db() as db:
+        query = db.query(*columns)
+        if status:
+            query = query.filter(table.status == status)
+        if date_from:
+            query = query.filter(table.created_at >= date_from)
+        if date_to:
+            query = query.filter(table.created_at < date_to)
+        yield from query.order_by(table.id).yield_per(EXPORT_CHUNK_SIZE)
+
+
+def write_export(path: str, fmt: str = "csv", **filters) -> int:
+    """Пишет выгрузку в файл; возвращает число строк. Вызывается в отдельном потоке."""
+    headers = [header for _, header in EXPORT_COLUMNS]
+    count = 0
+    if fmt == "xlsx":
+        # write_only: строки сразу уходят в zip-поток, а не в дерево листа
+        workbook = openpyxl.Workbook(write_only=True)
+        sheet = workbook.create_sheet("Заявки")
+        sheet.append(headers)
+        for row in iter_export_rows(**filters):
+            sheet.append(list(row))
+            count += 1
+        workbook.save(path)
+        return count
+
+    # utf-8-sig и «;» — чтобы Excel с русской локалью открыл файл без мастера импорта
+    with open(path, "w", newline="", encoding="utf-8-sig") as f:
+        writer = csv.writer(f, delimiter=";")
+        writer.writerow(headers)
+        for row in iter_export_rows(**filters):
+            writer.writerow(row)
+            count += 1
+    return count
+
+
+# -------------------------------------------------------
+# АНАЛИТИКА (суточные агрегаты)
+# -------------------------------------------------------
+# Верхние границы бакетов времени ожидания, в секундах: от 5 минут до 30 дней
+ANALYTICS_BUCKETS = (
+    300, 900, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600, 12 * 3600,
+    86400, 2 * 86400, 3 * 86400, 7 * 86400, 14 * 86400, 30 * 86400,
+)
+# Событие -> (поле с админом, поле, от которого считается время ожидания)
+ANALYTICS_EVENT_FIELDS = {
+    "created": (None, None),
+    "approved": ("approved_by", "created_at"),
+    "rejected": ("rejected_by", "created_at"),
+    "rules_accepted": (None, None),
+    "joined": ("approved_by", "approved_at"),
+}
+ANALYTICS_DEFAULT_DAYS = 30
+ANALYTICS_TOP = 10
+ANALYTICS_BACKFILL_CHUNK = 5000
+
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class AnalyticsRollup:
+    """
+    Приращения для analytics_daily / analytics_latency. Обработчик добавляет
+    событие и вызывает flush() в транзакции, которая меняет заявку, — агрегаты
+    не расходятся с user_requests. Бэкфилл и импорт копят приращения по пачке
+    заявок и пишут их одним executemany.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.latencies = {}
+
+    def add(self, event: str, at: str, workplace=None, admin=None, since=None):
+        seconds = None
+        if since:
+            started, finished = _parse_timestamp(since), _parse_timestamp(at)
+            if started and finished:
+                seconds = max(0.0, (finished - started).total_seconds())
+        keys = [("all", "")]
+        if workplace:
+            keys.append(("workplace", workplace))
+        if admin:
+            keys.append(("admin", str(admin)))
+
+        day = at[:10]
+        for dimension, key in keys:
+            count_key = (day, event, dimension, key)
+            self.counts[count_key] = self.counts.get(count_key, 0) + 1
+            if seconds is None:
+                continue
+            latency_key = count_key + (bisect_left(ANALYTICS_BUCKETS, seconds),)
+            series = self.latencies.get(latency_key)
+            if series is None:
+                self.latencies[latency_key] = [1, seconds]
+            else:
+                series[0] += 1
+                series[1] += seconds
+
+    def add_event(self, event: str, at: str, req, latency: bool = True):
+        """
+        req — заявка (ORM-объект, строка запроса или SimpleNamespace с полями user_requests).
+        latency=False — событие учитывается в счётчиках, но не во времени обработки.
+        """
+        admin_field, since_field = ANALYTICS_EVENT_FIELDS[event]
+        workplace = " ".join((getattr(req, "workplace", None) or "").split())
+        self.add(
+            event,
+            at,
+            workplace,
+            getattr(req, admin_field, None) if admin_field else None,
+            getattr(req, since_field, None) if since_field and latency else None,
+        )
+
+    def add_request(self, req):
+        """Все события уже сохранённой заявки — для бэкфилла и импорта."""
+        if req.created_at:
+            self.add_event("created", req.created_at, req)
+        if req.approved_at:
+            self.add_event("approved", req.approved_at, req)
+        if req.status == "rejected":
+            rejected_at = getattr(req, "rejected_at", None)
+            if rejected_at:
+                self.add_event("rejected", rejected_at, req)
+            elif req.created_at:
+                # До появления rejected_at время отказа не сохранялось: отказ считается в день
+                # подачи, но без времени решения — иначе оно вышло бы нулевым
+                self.add_event("rejected", req.created_at, req, latency=False)
+        if req.rules_accepted_at:
+            self.add_event("rules_accepted", req.rules_accepted_at, req)
+        if getattr(req, "joined_at", None):
+            self.add_event("joined", req.joined_at, req)
+
+    def flush(self, conn):
+        """conn — Connection (для сессии ORM — db.connection(), чтобы остаться в её транзакции)."""
+        if self.counts:
+            conn.exec_driver_sql(
+                "INSERT INTO analytics_daily (day, event, dimension, key, count) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(day, event, dimension, key) DO UPDATE SET count = count + excluded.count",
+                [key + (count,) for key, count in self.counts.items()],
+            )
+        if self.latencies:
+            conn.exec_driver_sql(
+                "INSERT INTO analytics_latency (day, event, dimension, key, bucket, count, total) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT(day, event, dimension, key, bucket) DO UPDATE SET "
+                "count = count + excluded.count, total = total + excluded.total",
+                [key + tuple(series) for key, series in self.latencies.items()],
+            )
+        self.counts = {}
+        self.latencies = {}
+
+
+def record_analytics(db, event: str, req, at: str):
+    """Учитывает событие заявки в агрегатах; вызывать до commit той же сессии."""
+    rollup = AnalyticsRollup()
+    rollup.add_event(event, at, req)
+    rollup.flush(db.connection())
+
+
+def backfill_analytics(conn, source=None) -> int:
+    """Пересчитывает агрегаты по всем заявкам (с архивом); возвращает число заявок."""
+    conn.exec_driver_sql("DELETE FROM analytics_daily")
+    conn.exec_driver_sql("DELETE FROM analytics_latency")
+    # Вместе с архивом: агрегаты считаются по всей истории
+    source = ALL_REQUESTS if source is None else source
+    table = source.c
+    columns = [
+        table.workplace, table.status, table.created_at,
+        table.approved_at, table.approved_by, table.rejected_at,
+        table.rejected_by, table.rules_accepted_at, table.joined_at,
+    ]
+    # Агрегаты небольшие (дни × админы × места работы) — копим всё и пишем один раз
+    rollup = AnalyticsRollup()
+    total = 0
+    result = conn.execution_options(yield_per=ANALYTICS_BACKFILL_CHUNK).execute(
+        source.select().with_only_columns(*columns)
+    )
+    for row in result:
+        rollup.add_request(row)
+        total += 1
+    rollup.flush(conn)
+    return total
+
+
+def parse_analytics_args(text: str, today: Optional[datetime] = None) -> tuple:
+    """
+    /analytics [дней] | /analytics ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]
+    Возвращает (первый день, последний день) включительно.
+    """
+    today = (today or datetime.now()).date()
+    args = text.split()[1:]
+    if not args:
+        args = [str(ANALYTICS_DEFAULT_DAYS)]
+    if len(args) == 1 and args[0].isdigit():
+        days = int(args[0])
+        if days < 1:
+            raise ValueError("нужен хотя бы один день")
+        return (today - timedelta(days=days - 1)).isoformat(), today.isoformat()
+    if len(args) > 2:
+        raise ValueError("не больше двух дат")
+    dates = [datetime.strptime(arg, "%Y-%m-%d").date() for arg in args]
+    return dates[0].isoformat(), (dates[1] if len(dates) == 2 else today).isoformat()
+
+
+def bucket_percentile(buckets: dict, q: float) -> Optional[int]:
+    """Верхняя граница бакета, в который попадает q-квантиль; None — дольше последнего бакета."""
+    rank = q * sum(buckets.values())
+    cumulative = 0
+    for index in sorted(buckets):
+        cumulative += buckets[index]
+        if cumulative >= rank:
+            break
+    return ANALYTICS_BUCKETS[index] if index < len(ANALYTICS_BUCKETS) else None
+
+
+def format_duration(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return f"> {ANALYTICS_BUCKETS[-1] // 86400} дн"
+    if seconds < 3600:
+        return f"{seconds / 60:.0f} мин"
+    if seconds < 86400:
+        return f"{seconds / 3600:.1f} ч".replace(".0 ", " ")
+    return f"{seconds / 86400:.1f} дн".replace(".0 ", " ")
+
+
+def load_analytics(date_from: str, date_to: str) -> dict:
+    """
+    Сводка за период из агрегатов: {"counts": {(event, dimension, key): n},
+    "latency": {(event, dimension, key): {bucket: n}}, "latency_total": {...: seconds}}.
+    """
+    with engine.connect() as conn:
+        counts = {
+            (event, dimension, key): count
+            for event, dimension, key, count in conn.exec_driver_sql(
+                "SELECT event, dimension, key, SUM(count) FROM analytics_daily "
+                "WHERE day BETWEEN ? AND ? GROUP BY event, dimension, key",
+                (date_from, date_to),
+            )
+        }
+        latency, latency_total = {}, {}
+        for event, dimension, key, bucket, count, total in conn.exec_driver_sql(
+            "SELECT event, dimension, key, bucket, SUM(count), SUM(total) FROM analytics_latency "
+            "WHERE day BETWEEN ? AND ? GROUP BY event, dimension, key, bucket",
+            (date_from, date_to),
+        ):
+            latency.setdefault((event, dimension, key), {})[bucket] = count
+            latency_total[(event, dimension, key)] = latency_total.get((event, dimension, key), 0.0) + total
+    return {"counts": counts, "latency": latency, "latency_total": latency_total}
+
+
+def format_analytics(summary: dict, date_from: str, date_to: str, admin_names: dict) -> str:
+    counts, latency, latency_total = summary["counts"], summary["latency"], summary["latency_total"]
+
+    def latency_line(event, dimension="all", key=""):
+        buckets = latency.get((event, dimension, key))
+        if not buckets:
+            return "—"
+        mean = latency_total[(event, dimension, key)] / sum(buckets.values())
+        return (
+            f"медиана ≤ {format_duration(bucket_percentile(buckets, 0.5))}, "
+            f"p90 ≤ {format_duration(bucket_percentile(buckets, 0.9))}, "
+            f"среднее {format_duration(mean)}"
+        )
+
+    def top(event, dimension):
+        keys = [(key, n) for (e, d, key), n in counts.items() if e == event and d == dimension]
+        return sorted(keys, key=lambda item: item[1], reverse=True)[:ANALYTICS_TOP]
+
+    total = lambda event: counts.get((event, "all", ""), 0)  # noqa: E731
+    lines = [
+        f"📈 <b>Аналитика за {date_from} — {date_to}</b>\n",
+        f"📂 <b>Создано заявок:</b> {total('created')}",
+        f"✅ <b>Одобрено:</b> {total('approved')}",
+        f"❌ <b>Отклонено:</b> {total('rejected')}",
+        f"📜 <b>Приняли правила:</b> {total('rules_accepted')}",
+        f"🚪 <b>Вступили в группу:</b> {total('joined')}\n",
+        f"⏱ <b>От заявки до одобрения:</b> {latency_line('approved')}",
+        f"⏱ <b>От заявки до отказа:</b> {latency_line('rejected')}",
+        f"⏱ <b>От одобрения до вступления:</b> {latency_line('joined')}",
+    ]
+
+    admins = top("approved", "admin")
+    if admins:
+        lines.append("\n👮 <b>По админам</b> (одобрено · до одобрения):")
+        for key, n in admins:
+            name = html.escape(admin_names.get(int(key)) or key)
+            lines.append(f"• {name} — {n} · {latency_line('approved', 'admin', key)}")
+
+    workplaces = top("created", "workplace")
+    if workplaces:
+        lines.append("\n🏢 <b>По местам работы</b> (заявок / одобрено / вступили · до одобрения):")
+        for key, n in workplaces:
+            lines.append(
+                f"• {html.escape(key)} — {n} / {counts.get(('approved', 'workplace', key), 0)} / "
+                f"{counts.get(('joined', 'workplace', key), 0)} · {latency_line('approved', 'workplace', key)}"
+            )
+    return "\n".join(lines)
+
+
+# -------------------------------------------------------
+# АРХИВ ЗАВЕРШЁННЫХ ЗАЯВОК
+# -------------------------------------------------------
+# Давно завершённые заявки читаются только для истории, а рабочую таблицу
+# сканируют /check, напоминания и VACUUM. Они переносятся в user_requests_archive
+# с тем же id; /approved, /rejected, /find, /stats и /export читают обе таблицы.
+ALL_REQUESTS_VIEW = "user_requests_all"
+ARCHIVE_MOVED = METRICS.counter(
+    "bot_archive_moved_total", "Заявок перенесено в архив")
+HOT_REQUESTS_BYTES = METRICS.gauge(
+    "bot_hot_requests_bytes", "Размер user_requests с индексами после архивации, байт")
+
+# Обе таблицы как одна: колонки перечислены явно, поэтому при добавлении колонки
+# в UserRequestColumns представление пересоздаётся в миграции (create_requests_view)
+ALL_REQUESTS = Table(
+    ALL_REQUESTS_VIEW, MetaData(),
+    *(Column(column.name, column.type, primary_key=column.primary_key)
+      for column in UserRequest.__table__.columns),
+)
+
+
+def create_requests_view(conn):
+    columns = ", ".join(column.name for column in UserRequest.__table__.columns)
+    conn.exec_driver_sql(f"DROP VIEW IF EXISTS {ALL_REQUESTS_VIEW}")
+    conn.exec_driver_sql(
+        f"CREATE VIEW {ALL_REQUESTS_VIEW} AS "
+        f"SELECT {columns} FROM user_requests UNION ALL SELECT {columns} FROM user_requests_archive"
+    )
+
+
+def get_any_request(db, req_id: int):
+    """Заявка по id из рабочей таблицы или архива (у архивной есть archived_at)."""
+    return db.get(UserRequest, req_id) or db.get(UserRequestArchive, req_id)
+
+
+def request_ids_by_status(db, status: str) -> list:
+    """id заявок со статусом из обеих таблиц, по возрастанию, как раньше из одной."""
+    ids = []
+    for model in REQUEST_MODELS:
+        ids += [req_id for (req_id,) in db.query(model.id).filter(model.status == status)]
+    return sorted(ids)
+
+
+def archived_line(req) -> str:
+    archived_at = getattr(req, "archived_at", None)
+    return f"🗄 <b>В архиве с:</b> {archived_at}\n" if archived_at else ""
+
+
+def hot_requests_size(conn) -> Optional[int]:
+    """Байт данных в user_requests и её индексах (dbstat); None, если dbstat недоступен."""
+    try:
+        return conn.exec_driver_sql(
+            "SELECT SUM(pgsize - unused) FROM dbstat WHERE name IN "
+            "(SELECT name FROM sqlite_master WHERE tbl_name = 'user_requests' AND type IN ('table', 'index'))"
+        ).scalar()
+    except OperationalError:
+        return None
+
+
+def archive_finished_requests(days: int = None, batch_size: int = None) -> dict:
+    """
+    Переносит заявки, завершённые раньше чем days дней назад, пачками по batch_size
+    (каждая — своя транзакция, бот между ними не ждёт). Завершённые — отклонённые
+    и одобренные, у которых приняты правила, код использован и нет отложенной ссылки.
+    Возвращает {"moved", "rows_before", "rows_after", "bytes_before", "bytes_after", "seconds"}.
+    """
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    batch_size = batch_size or ARCHIVE_BATCH_SIZE
+    cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    columns = ", ".join(column.name for column in UserRequest.__table__.columns)
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        stats = {
+            "rows_before": conn.exec_driver_sql("SELECT COUNT(*) FROM user_requests").scalar(),
+            "bytes_before": hot_requests_size(conn),
+        }
+
+    moved = 0
+    while True:
+        archived_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with engine.begin() as conn:
+            ids = conn.exec_driver_sql(
+                "SELECT id FROM user_requests WHERE "
+                # До появления rejected_at отклонения его не заполняли — берём время подачи
+                "((status = 'rejected' AND COALESCE(rejected_at, created_at) < ?) OR "
+                " (status = 'approved' AND approved_at < ? AND rules_accepted_at IS NOT NULL "
+                "  AND confirmation_code IS NULL)) "
+                "AND NOT EXISTS (SELECT 1 FROM pending_invites WHERE request_id = user_requests.id) "
+                # Без AUTOINCREMENT SQLite выдаёт новой заявке max(id) + 1: самая новая
+                # остаётся в рабочей таблице, иначе её id достался бы следующей
+                "AND id < (SELECT MAX(id) FROM user_requests) "
+                "ORDER BY id LIMIT ?",
+                (cutoff, cutoff, batch_size),
+            ).scalars().all()
+            if not ids:
+                break
+            placeholders = ", ".join("?" * len(ids))
+            conn.exec_driver_sql(
+                f"INSERT INTO user_requests_archive ({columns}, archived_at) "
+                f"SELECT {columns}, ? FROM user_requests WHERE id IN ({placeholders})",
+                (archived_at, *ids),
+            )
+            conn.exec_driver_sql(f"DELETE FROM user_requests WHERE id IN ({placeholders})", tuple(ids))
+        moved += len(ids)
+        ARCHIVE_MOVED.inc(value=len(ids))
+
+    with engine.connect() as conn:
+        stats.update(
+            moved=moved,
+            rows_after=conn.exec_driver_sql("SELECT COUNT(*) FROM user_requests").scalar(),
+            bytes_after=hot_requests_size(conn),
+            seconds=time.perf_counter() - started,
+        )
+    if stats["bytes_after"] is not None:
+        HOT_REQUESTS_BYTES.set(value=stats["bytes_after"])
+    return stats
+
+
+def format_archive_stats(stats: dict) -> str:
+    text = (f"Архив: перенесено {stats['moved']} заявок за {stats['seconds']:.1f} с, "
+            f"в рабочей таблице {stats['rows_before']} → {stats['rows_after']} строк")
+    if stats["bytes_before"] and stats["bytes_after"] is not None:
+        text += (f", {stats['bytes_before'] / 1024 / 1024:.1f} → {stats['bytes_after'] / 1024 / 1024:.1f} МБ "
+                 f"(−{100 - stats['bytes_after'] * 100 / stats['bytes_before']:.0f}%)")
+    return text
+
+
+async def archive_requests_periodically():
+    """Раз в ARCHIVE_INTERVAL переносит давно завершённые заявки в архив."""
     while True:
         try:
-            # Проверяем каждые 5 минут
-            await asyncio.sleep(300)
-            
-            # Если не рабочее время, пропускаем проверку
-            if not is_work_time():
-                continue
-                
-            with get_db() as db:
-                pending_notifications = db.query(PendingJoinNotification).all()
-                
-                for notification in pending_notifications:
-                    try:
-                        # Отправляем уведомление в группу
-                        await bot.send_message(
-                            chat_id=notification.chat_id,
-                            text=(
-                                f"👋 Добро пожаловать, {notification.full_name}!\n"
-                                f"🏢 Место работы: {notification.workplace}\n"
-                                f"💼 Должность: {notification.position}\n"
-                            )
-                        )
-                        
-                        # Удаляем запись из отложенных
-                        db.delete(notification)
-                        db.commit()
-                        
-                    except Exception as e:
-                        logging.error(f"Ошибка при отправке отложенного уведомления о входе: {e}")
-                        await asyncio.sleep(300)
-                        
+            await asyncio.sleep(ARCHIVE_INTERVAL)
+            with traced_job("archive_requests"):
+                stats = await asyncio.to_thread(archive_finished_requests)
+            logging.info(format_archive_stats(stats))
         except Exception as e:
-            logging.error(f"Ошибка в check_pending_join_notifications: {e}")
-            await asyncio.sleep(300)
+            logging.error(f"Ошибка в archive_requests_periodically: {e}")
 
-async def main():
-    logging.basicConfig(level=logging.INFO)
-    
-    # Авторизуемся в Telethon перед запуском бота
-    if not await authorize_user():
-        logging.error("Не удалось авторизоваться в Telethon. Бот не может быть запущен.")
-        return
 
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode="HTML"))
-    dp = Dispatcher(storage=MemoryStorage())
-    
-    # Запускаем задачу heartbeat
-    asyncio.create_task(heartbeat_task())
-    
+# -------------------------------------------------------
+# КЛЮЧИ ЗАЯВОК И ПОИСК ДУБЛИКАТОВ
+# -------------------------------------------------------
+# Данные нормализуются при вводе: проверки «уже есть заявка» — один поиск по индексу,
+# а не сравнение строк в том виде, как их набрал пользователь
+REQUEST_KEYS_CHUNK = 5000
+# Нечёткое сравнение ФИО — только среди заявок с тем же началом name_key (опечатка
+# в фамилии дальше первых букв всё равно попадёт в кандидаты)
+DUPLICATE_NAME_PREFIX = 3
+DUPLICATE_WARNINGS = METRICS.counter(
+    "bot_duplicate_warnings_total", "Предупреждений о похожих заявках", ["reason"])
+
+
+def normalize_phone(value: str) -> Optional[str]:
+    """Телефон в формате бота 7XXXXXXXXXX (+7, 8XXXXXXXXXX, скобки и дефисы допускаются) или None."""
+    digits = re.sub(r"\D", "", value or "")
+    if len(digits) == 10 and digits.startswith("9"):
+        digits = "7" + digits
+    elif len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    if len(digits) == 11 and digits.startswith("7"):
+        return digits
+    return None
+
+
+def phone_key(value: Optional[str]) -> Optional[str]:
+    digits = normalize_phone(value)
+    return f"+{digits}" if digits else None
+
+
+def name_key(value: Optional[str]) -> Optional[str]:
+    # «Ё» и «Е» пишут вперемешку — для сравнения они одно и то же
+    return " ".join((value or "").casefold().replace("ё", "е").split()) or None
+
+
+def username_key(value: Optional[str]) -> Optional[str]:
+    key = (value or "").strip().lstrip("@").lower()
+    return key if key and key != "—" else None
+
+
+def request_keys(full_name: Optional[str], phone: Optional[str], username: Optional[str]) -> dict:
+    """Значения phone_key, name_key и username_key для новой или изменённой заявки."""
+    return {
+        "phone_key": phone_key(phone),
+        "name_key": name_key(full_name),
+        "username_key": username_key(username),
+    }
+
+
+def backfill_request_keys(conn) -> int:
+    """Заполняет ключи у всех заявок пачками; возвращает число заявок."""
+    table = UserRequest.__table__
+    update = table.update().where(table.c.id == bindparam("req_id")).values(
+        phone_key=bindparam("phone_key"),
+        name_key=bindparam("name_key"),
+        username_key=bindparam("username_key"),
+    )
+    # Ключи пишутся в ту же таблицу, что читается, — сначала забираем id и поля целиком
+    rows = conn.execute(
+        table.select().with_only_columns(table.c.id, table.c.full_name, table.c.phone, table.c.username)
+    ).all()
+    for start in range(0, len(rows), REQUEST_KEYS_CHUNK):
+        conn.execute(update, [
+            {"req_id": row.id, **request_keys(row.full_name, row.phone, row.username)}
+            for row in rows[start:start + REQUEST_KEYS_CHUNK]
+        ])
+    return len(rows)
+
+
+def find_active_duplicate(db, **keys) -> Optional[UserRequest]:
+    """
+    Активная (pending/approved) заявка с тем же ключом, например
+    find_active_duplicate(db, name_key=..., person_type="self").
+    Одобренные могли уйти в архив — он проверяется вторым.
+    """
+    for model in REQUEST_MODELS:
+        req = db.query(model).filter_by(**keys).filter(model.status.in_(["pending", "approved"])).first()
+        if req is not None:
+            return req
+    return None
+
+
+def find_probable_duplicates(db, req: UserRequest) -> list:
+    """
+    Похожие заявки для предупреждения админа: [(строка id/full_name/status, причина)].
+    Тот же телефон или username — точное совпадение по индексу; ФИО сравнивается
+    через difflib с ближайшими по алфавиту заявками с тем же началом name_key.
+    """
+    found = {}
+
+    def add(other, reason):
+        if other.id != req.id and other.id not in found:
+            found[other.id] = (other, reason)
+
+    candidates = []
+    # Рабочая таблица и архив: тот, кому отказали полгода назад, тоже интересен
+    for model in REQUEST_MODELS:
+        # Для предупреждения хватает нескольких колонок — без загрузки ORM-объектов
+        columns = (model.id, model.full_name, model.status, model.name_key)
+        for column, reason in (("phone_key", "тот же телефон"), ("username_key", "тот же username")):
+            value = getattr(req, column)
+            if value:
+                for other in db.query(*columns).filter(getattr(model, column) == value).limit(10):
+                    add(other, reason)
+
+        if req.name_key:
+            # Соседи по алфавиту с обеих сторон — два коротких прохода по индексу name_key,
+            # сколько бы заявок ни начиналось с тех же букв
+            # (у каждого прохода одна пара границ: две нижние SQLite не объединяет и читает весь блок)
+            prefix = req.name_key[:DUPLICATE_NAME_PREFIX]
+            block = db.query(*columns).filter(model.id != req.id)
+            half = DUPLICATE_CANDIDATES // 2
+            candidates += (
+                block.filter(model.name_key >= req.name_key, model.name_key < prefix + "\uffff")
+                .order_by(model.name_key).limit(half).all()
+                + block.filter(model.name_key >= prefix, model.name_key < req.name_key)
+                .order_by(model.name_key.desc()).limit(half).all()
+            )
+
+    if candidates:
+        # SequenceMatcher кеширует разбор второй строки — она у всех сравнений общая
+        matcher = difflib.SequenceMatcher(b=req.name_key)
+        for other in candidates:
+            matcher.set_seq1(other.name_key)
+            if other.name_key == req.name_key:
+                add(other, "то же ФИО")
+            elif (matcher.real_quick_ratio() >= DUPLICATE_NAME_RATIO
+                  and matcher.quick_ratio() >= DUPLICATE_NAME_RATIO
+                  and matcher.ratio() >= DUPLICATE_NAME_RATIO):
+                add(other, "похожее ФИО")
+
+    for _, reason in found.values():
+        DUPLICATE_WARNINGS.inc(reason)
+    return sorted(found.values(), key=lambda item: item[0].id)
+
+
+def format_duplicates(duplicates: list) -> str:
+    """Блок предупреждения для карточки заявки; пустая строка, если похожих нет."""
+    if not duplicates:
+        return ""
+    lines = [
+        f"• #{other.id} {html.escape(other.full_name or '—')} ({other.status}) — {reason}"
+        for other, reason in duplicates[:5]
+    ]
+    if len(duplicates) > 5:
+        lines.append(f"• и ещё {len(duplicates) - 5}")
+    return "\n\n⚠️ <b>Возможные дубликаты:</b>\n" + "\n".join(lines)
+
+
+def duplicates_warning(request_id: int) -> str:
+    """Предупреждение для карточки заявки; вызывается через asyncio.to_thread — difflib не держит loop."""
+    with get_db() as db:
+        req = db.get(UserRequest, request_id)
+        return format_duplicates(find_probable_duplicates(db, req)) if req else ""
+
+
+# -------------------------------------------------------
+# ПОИСК ПО ЗАЯВКАМ (/find, SQLite FTS5)
+# -------------------------------------------------------
+# Индексируются нормализованные ключи (ё→е, регистр, телефон цифрами) и место
+# работы с должностью. Таблица external content поверх user_requests_all (рабочая
+# таблица + архив): текст не дублируется, индекс поддерживают триггеры, смена
+# статуса и перенос в архив его не трогают.
+SEARCH_TABLE = "user_requests_fts"
+SEARCH_COLUMNS = ("name_key", "workplace", "position", "username_key", "phone_key")
+# Веса bm25 в порядке SEARCH_COLUMNS: совпадение в ФИО важнее, чем в должности
+SEARCH_WEIGHTS = (10.0, 2.0, 1.0, 5.0, 5.0)
+SEARCH_TOKEN_RE = re.compile(r"\w+")
+# bm25 считается для каждого совпадения на каждой странице; при слишком общем запросе
+# («ооо») ранжирование бессмысленно — показываем новые заявки, листая по rowid
+SEARCH_RANK_LIMIT = 2000
+FIND_SECONDS = METRICS.histogram("bot_find_seconds", "Время поиска /find (страница)")
+
+
+def create_request_search(conn):
+    columns = ", ".join(SEARCH_COLUMNS)
+    old_values = ", ".join(f"old.{column}" for column in SEARCH_COLUMNS)
+    new_values = ", ".join(f"new.{column}" for column in SEARCH_COLUMNS)
+    create_requests_view(conn)
+    conn.exec_driver_sql(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+        f"{columns}, content='{ALL_REQUESTS_VIEW}', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+    for table, other in (("user_requests", "user_requests_archive"), ("user_requests_archive", "user_requests")):
+        # При переносе строка на миг есть в обеих таблицах — индекс не трогаем
+        moving = "WHEN NOT EXISTS (SELECT 1 FROM {} WHERE id = {}.id)"
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_fts_ai AFTER INSERT ON {table} "
+            f"{moving.format(other, 'new')} BEGIN "
+            f"INSERT INTO {SEARCH_TABLE}(rowid, {columns}) VALUES (new.id, {new_values}); END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_fts_ad AFTER DELETE ON {table} "
+            f"{moving.format(other, 'old')} BEGIN "
+            f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, {columns}) "
+            f"VALUES ('delete', old.id, {old_values}); END"
+        )
+        conn.exec_driver_sql(
+            f"CREATE TRIGGER IF NOT EXISTS {table}_fts_au AFTER UPDATE OF {columns} ON {table} BEGIN "
+            f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}, rowid, {columns}) "
+            f"VALUES ('delete', old.id, {old_values}); "
+            f"INSERT INTO {SEARCH_TABLE}(rowid, {columns}) VALUES (new.id, {new_values}); END"
+        )
+    # Индекс по уже накопленным заявкам
+    conn.exec_driver_sql(f"INSERT INTO {SEARCH_TABLE}({SEARCH_TABLE}) VALUES ('rebuild')")
+
+
+def drop_request_search(conn):
+    triggers = conn.exec_driver_sql(
+        "SELECT name FROM sqlite_master WHERE type = 'trigger' AND sql LIKE ?", (f"%{SEARCH_TABLE}%",)
+    ).scalars().all()
+    for name in triggers:
+        conn.exec_driver_sql(f"DROP TRIGGER IF EXISTS {name}")
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {SEARCH_TABLE}")
+
+
+_search_available = None
+
+
+def search_available() -> bool:
+    global _search_available
+    if _search_available is None:
+        with engine.connect() as conn:
+            _search_available = conn.dialect.name == "sqlite" and conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (SEARCH_TABLE,)
+            ).first() is not None
+    return _search_available
+
+
+def build_search_query(text: str) -> Optional[str]:
+    """
+    Запрос FTS5 из текста админа: каждое слово — префикс, все слова обязательны.
+    Телефон в любом написании ищется целиком; «ё» — в обоих вариантах, т.к. место
+    работы и должность индексируются как введены.
+    """
+    phone = normalize_phone(text)
+    if phone:
+        return f'phone_key : "{phone}"'
+    terms = []
+    for token in SEARCH_TOKEN_RE.findall(text.casefold()):
+        variants = {token, token.replace("ё", "е")}
+        terms.append("(" + " OR ".join(f'"{variant}"*' for variant in sorted(variants)) + ")"
+                     if len(variants) > 1 else f'"{token}"*')
+    return " AND ".join(terms) or None
+
+
+def search_requests(match: str, after: Optional[list] = None, limit: int = FIND_PAGE_SIZE,
+                    ranked: bool = True) -> list:
+    """
+    Страница результатов по релевантности (bm25, меньше — лучше), затем по id;
+    ranked=False — от новых к старым. after — [rank, id] последней строки предыдущей
+    страницы (keyset, без OFFSET).
+    """
+    params = [match]
+    if ranked:
+        weights = ", ".join(str(weight) for weight in SEARCH_WEIGHTS)
+        sql = (
+            f"SELECT rank, id FROM (SELECT rowid AS id, bm25({SEARCH_TABLE}, {weights}) AS rank "
+            f"FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH ?) "
+        )
+        if after:
+            sql += "WHERE (rank, id) > (?, ?) "
+            params += list(after)
+        sql += "ORDER BY rank, id LIMIT ?"
+    else:
+        # Ограничение и порядок по rowid FTS5 выполняет сам, не перебирая все совпадения
+        sql = (
+            f"SELECT 0.0, rowid FROM {SEARCH_TABLE} "
+            f"WHERE {SEARCH_TABLE} MATCH ?{' AND rowid < ?' if after else ''} ORDER BY rowid DESC LIMIT ?"
+        )
+        if after:
+            params.append(after[1])
+    params.append(limit)
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        page = conn.exec_driver_sql(sql, tuple(params)).all()
+        # Строки — отдельно по id из каждой таблицы: JOIN с представлением user_requests_all
+        # SQLite материализует целиком
+        found = {}
+        for model in REQUEST_MODELS:
+            table = model.__table__
+            found.update((row.id, row) for row in conn.execute(
+                select(table.c.id, table.c.full_name, table.c.workplace, table.c.position,
+                       table.c.username, table.c.phone, table.c.status)
+                .where(table.c.id.in_([req_id for _, req_id in page]))
+            ))
+    FIND_SECONDS.observe(time.perf_counter() - started)
+    return [SimpleNamespace(rank=rank, **found[req_id]._mapping) for rank, req_id in page if req_id in found]
+
+
+def count_search_results(match: str) -> int:
+    with engine.connect() as conn:
+        return conn.exec_driver_sql(
+            f"SELECT count(*) FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH ?", (match,)
+        ).scalar()
+
+
+FIND_STATUS_ICONS = {"pending": "⏳", "approved": "✅", "rejected": "❌"}
+
+
+def format_search_results(rows: list, total: int, page: int, query: str) -> str:
+    lines = [f"🔎 <b>Поиск:</b> {html.escape(query)} — найдено {total}, страница {page + 1}"]
+    if total > SEARCH_RANK_LIMIT:
+        lines.append("<i>Запрос слишком общий: сначала новые заявки. Уточните, чтобы отсортировать по совпадению.</i>")
+    lines.append("")
+    for row in rows:
+        details = ", ".join(html.escape(value) for value in (row.workplace, row.position) if value)
+        username = row.username if row.username and row.username != "—" else ""
+        lines.append(
+            f"{FIND_STATUS_ICONS.get(row.status, '•')} <b>#{row.id}</b> {html.escape(row.full_name or '—')}"
+            f"{' ' + html.escape(username) if username else ''}\n"
+            f"    📞 <code>{html.escape(row.phone or '—')}</code>{' · ' + details if details else ''}"
+        )
+    return "\n".join(lines)
+
+
+# -------------------------------------------------------
+# КОДЫ ПОДТВЕРЖДЕНИЯ ДЛЯ ТРЕТЬИХ ЛИЦ
+# -------------------------------------------------------
+# Код — base32 от «id заявки (4 байта) + срок действия в часах от эпохи (4 байта)
+# + HMAC-SHA256 (первые 8 байт)»: 26 символов. Поддельный или просроченный код
+# отсеивается без БД, настоящий ведёт прямо к заявке по первичному ключу.
+_CODE_PAYLOAD = struct.Struct(">II")
+_CODE_TAG_BYTES = 8
+CONFIRMATION_CODE_LENGTH = 26
+# Коды, выданные до подписанных (8 hex-символов), по-прежнему ищутся по индексу confirmation_code
+LEGACY_CODE_RE = re.compile(r"[0-9a-f]{8}")
+INVALID_CODE_TEXT = "Некорректный код. Заявка не найдена."
+
+
+class ConfirmationCodeError(ValueError):
+    """Код не подходит; текст исключения можно показать пользователю."""
+
+
+def _code_tag(payload: bytes) -> bytes:
+    return hmac.new(CONFIRMATION_CODE_SECRET, payload, hashlib.sha256).digest()[:_CODE_TAG_BYTES]
+
+
+def make_confirmation_code(request_id: int, ttl: float = None) -> str:
+    ttl = CONFIRMATION_CODE_TTL if ttl is None else ttl
+    expires_hour = int((time.time() + ttl) // 3600) + 1
+    payload = _CODE_PAYLOAD.pack(request_id, expires_hour)
+    return base64.b32encode(payload + _code_tag(payload)).decode("ascii").rstrip("=")
+
+
+def verify_confirmation_code(code: str) -> int:
+    """id заявки из подписанного кода; ConfirmationCodeError, если подпись неверна или срок истёк."""
+    if len(code) != CONFIRMATION_CODE_LENGTH:
+        raise ConfirmationCodeError(INVALID_CODE_TEXT)
+    try:
+        raw = base64.b32decode(code.upper() + "======")
+    except ValueError:
+        raise ConfirmationCodeError(INVALID_CODE_TEXT)
+    payload, tag = raw[:_CODE_PAYLOAD.size], raw[_CODE_PAYLOAD.size:]
+    if not hmac.compare_digest(tag, _code_tag(payload)):
+        raise ConfirmationCodeError(INVALID_CODE_TEXT)
+    request_id, expires_hour = _CODE_PAYLOAD.unpack(payload)
+    if expires_hour * 3600 < time.time():
+        raise ConfirmationCodeError("Срок действия кода истёк. Обратитесь к администратору.")
+    return request_id
+
+
+def load_request_by_code(db, code: str) -> UserRequest:
+    """
+    Заявка по коду из /accept или /decline. Код должен совпадать с сохранённым
+    в заявке: после использования или отказа он стирается и больше не действует.
+    """
+    if LEGACY_CODE_RE.fullmatch(code.lower()):
+        req = db.query(UserRequest).filter_by(confirmation_code=code.lower()).first()
+    else:
+        req = db.get(UserRequest, verify_confirmation_code(code))
+        if req is not None and req.confirmation_code != code.upper():
+            req = None
+    if req is None:
+        raise ConfirmationCodeError(INVALID_CODE_TEXT)
+    return req
+
+
+# -------------------------------------------------------
+# СМЕНА СТАТУСА ЗАЯВКИ
+# -------------------------------------------------------
+STATUS_CONFLICTS = METRICS.counter(
+    "bot_request_status_conflicts_total",
+    "Смена статуса не состоялась: заявку уже обработал другой админ", ["action"])
+
+
+def approved_rules_text(rules_text: str) -> str:
+    return (
+        "🎉 <b>Ваша заявка одобрена!</b>\n\n"
+        "📋 <b>Правила группы:</b>\n"
+        f"   <b>{rules_text}</b>\n\n"
+    )
+
+
+def third_party_rules_text(rules_text: str, code: str) -> str:
+    return (
+        "🎉 <b>Ваша заявка одобрена!</b>\n\n"
+        "📋 <b>Правила группы:</b>\n"
+        f"  <b>{rules_text}</b>\n\n"
+        "✅ <b>Что бы принять или отклонить правила, отправьте команды боту @hrclubrtbot:</b>\n"
+        "✅ <b>Принять правила:</b>\n"
+        f"Отправьте команду:  <code>/accept {code}</code>\n\n"
+        "❌ <b>Отклонить правила:</b>\n"
+        f"Отправьте команду:  <code>/decline {code}</code>"
+    )
+
+
+def rejection_text(reason: str) -> str:
+    return (
+        "❌ <b>Ваша заявка отклонена.</b>\n\n"
+        f"📝 <b>Причина:</b> <i>{reason}</i>\n\n"
+        " <b>Что делать дальше?</b>\n"
+        "Вы можете подать новую заявку, исправив указанные ошибки.\n"
+        "Для этого используйте команду /new."
+    )
+
+
+def transition_requests(conn, request_ids: list, from_status: str, **values) -> list:
+    """
+    Атомарно переводит заявки из from_status: UPDATE ... WHERE id IN (...) AND
+    status = from_status, version + 1. Проверять статус в Python заранее не нужно:
+    из двух одновременных попыток строку изменит только одна, заявки «проигравшей»
+    в результат не попадут. Возвращает изменённые строки (все колонки, новые значения).
+    """
+    table = UserRequest.__table__
+    changes = dict(values, version=table.c.version + 1)
+    if conn.dialect.update_returning:
+        return conn.execute(
+            table.update()
+            .where(table.c.id.in_(request_ids), table.c.status == from_status)
+            .values(**changes)
+            .returning(*table.c)
+        ).all()
+
+    # SQLite < 3.35 без RETURNING: по одной заявке, победителя показывает rowcount
+    won = [
+        req_id for req_id in request_ids
+        if conn.execute(
+            table.update().where(table.c.id == req_id, table.c.status == from_status).values(**changes)
+        ).rowcount == 1
+    ]
+    return conn.execute(table.select().where(table.c.id.in_(won))).all() if won else []
+
+
+def approve_requests(request_ids: list, admin_id: int) -> list:
+    """
+    Одобряет заявки одной транзакцией; уже обработанные другим админом пропускаются.
+    Возвращает [(id, chat_id, person_type, username, confirmation_code)] одобренных.
+    """
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    table = UserRequest.__table__
+    with engine.begin() as conn:
+        rows = transition_requests(
+            conn, request_ids, "pending",
+            status="approved", approved_by=admin_id, approved_at=current_time,
+        )
+        rollup = AnalyticsRollup()
+        approved, codes = [], []
+        for row in rows:
+            code = row.confirmation_code
+            # Код для третьего лица — только у победителя, поэтому он всегда один
+            if row.person_type == "third_party" and row.username:
+                code = make_confirmation_code(row.id)
+                codes.append({"req_id": row.id, "code": code})
+            rollup.add_event("approved", current_time, row)
+            approved.append((row.id, row.chat_id, row.person_type, row.username, code))
+        if codes:
+            conn.execute(
+                table.update().where(table.c.id == bindparam("req_id"))
+                .values(confirmation_code=bindparam("code")),
+                codes,
+            )
+        rollup.flush(conn)
+    if len(approved) < len(request_ids):
+        STATUS_CONFLICTS.inc("approve", value=len(request_ids) - len(approved))
+    return approved
+
+
+def reject_requests(request_ids: list, admin_id: Optional[int], reason: str,
+                    from_status: str = "pending", **values) -> list:
+    """
+    Отклоняет заявки одной транзакцией; возвращает [(id, chat_id)] отклонённых.
+    from_status="approved" — пользователь сам отказался от правил.
+    """
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    with engine.begin() as conn:
+        rows = transition_requests(
+            conn, request_ids, from_status,
+            status="rejected", rejection_reason=reason, rejected_by=admin_id,
+            rejected_at=current_time, **values,
+        )
+        rollup = AnalyticsRollup()
+        for row in rows:
+            rollup.add_event("rejected", current_time, row)
+        rollup.flush(conn)
+    if len(rows) < len(request_ids):
+        STATUS_CONFLICTS.inc("reject", value=len(request_ids) - len(rows))
+    return [(row.id, row.chat_id) for row in rows]
+
+
+# -------------------------------------------------------
+# МАССОВАЯ ОБРАБОТКА ЗАЯВОК
+# -------------------------------------------------------
+BULK_MESSAGES = METRICS.counter(
+    "bot_bulk_messages_total", "Сообщения фоновой рассылки после массовых действий", ["result"])
+
+
+class BulkJob:
+    """Одна массовая операция: счётчики рассылки и сообщение админа с прогрессом."""
+
+    def __init__(self, title: str, total: int, chat_id: int, message_id: Optional[int] = None):
+        self.title = title
+        self.total = total
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.sent = 0
+        self.failed = 0
+        self.reported_at = 0.0
+
+    @property
+    def done(self) -> bool:
+        return self.sent + self.failed >= self.total
+
+    def progress_text(self) -> str:
+        text = f"{self.title}\n\n📨 Разослано: {self.sent} из {self.total}"
+        if self.failed:
+            text += f"\n⚠️ Не доставлено: {self.failed}"
+        if self.done:
+            text += "\n\n✅ Рассылка завершена."
+        return text
+
+
+class BulkSender:
+    """
+    Фоновая рассылка после массовых действий: не чаще rate сообщений в секунду
+    (у Bot API общий лимит около 30 сообщений/с на бота), при 429 — пауза
+    retry_after и повтор. Прогресс операции — одно сообщение админа, которое
+    редактируется не чаще раза в progress_interval секунд.
+    """
+
+    def __init__(self, bot: Bot, rate: float = 20.0, progress_interval: float = 2.0):
+        self.bot = bot
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.progress_interval = progress_interval
+        self._queue = asyncio.Queue()
+        self._task = None
+
+    def submit(self, job: BulkJob, sends: list):
+        """sends — функции без аргументов, возвращающие корутину отправки (False — не доставлено)."""
+        for send in sends:
+            self._queue.put_nowait((job, send))
+        SCHEDULER_QUEUE_DEPTH.set("bulk_sender", value=self._queue.qsize())
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    @staticmethod
+    async def _send(send) -> bool:
+        for attempt in range(3):
+            try:
+                return await send() is not False
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+            except Exception as e:
+                logging.error(f"Ошибка массовой рассылки: {e}")
+                return False
+        return False
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_at = loop.time()
+        while True:
+            job, send = await self._queue.get()
+            try:
+                delay = next_at - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                next_at = loop.time() + self.interval
+
+                if await self._send(send):
+                    job.sent += 1
+                    BULK_MESSAGES.inc("sent")
+                else:
+                    job.failed += 1
+                    BULK_MESSAGES.inc("failed")
+                SCHEDULER_QUEUE_DEPTH.set("bulk_sender", value=self._queue.qsize())
+                if job.done or loop.time() - job.reported_at >= self.progress_interval:
+                    await self.report(job)
+            finally:
+                self._queue.task_done()
+
+    async def report(self, job: BulkJob):
+        """Обновляет сообщение с прогрессом; ошибки не мешают рассылке."""
+        job.reported_at = asyncio.get_running_loop().time()
+        if job.message_id is None:
+            return
+        try:
+            await self.bot.edit_message_text(
+                job.progress_text(), chat_id=job.chat_id, message_id=job.message_id
+            )
+        except TelegramAPIError as e:
+            # В том числе 429: прогресс обновится при следующем сообщении
+            logging.warning(f"Не удалось обновить прогресс рассылки: {e}")
+
+    async def close(self, timeout: float = 30.0):
+        """Дорассылает очередь при остановке бота, но не дольше timeout секунд."""
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Массовая рассылка прервана, не отправлено: {self._queue.qsize()}")
+        self._task.cancel()
+
+
+def create_bot() -> Bot:
+    """Bot с метриками сессии; TELEGRAM_API_URL позволяет указать свой сервер Bot API."""
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    else:
+        session = AiohttpSession()
+    bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode="HTML"))
+    bot.session.middleware(BotApiMetricsMiddleware())
+    return bot
+
+
+def build_dispatcher(bot: Bot) -> Dispatcher:
+    """Создаёт Dispatcher и регистрирует все обработчики бота."""
+    dp = Dispatcher(storage=create_storage())
+    dp.update.outer_middleware(UpdateTimingMiddleware(
+        SLOW_UPDATE_THRESHOLD, PROFILE_SAMPLE_RATE, PROFILE_DIR
+    ))
+    dp.message.middleware(HandlerNameMiddleware())
+    dp.callback_query.middleware(HandlerNameMiddleware())
+
+    # Все callback-кнопки идут через одну таблицу маршрутов (см. CallbackRouter)
+    callbacks = CallbackRouter()
+    dp.callback_query.register(callbacks.dispatch)
+    dp["callback_router"] = callbacks
+
     # Глобальный обработчик ошибок
     @dp.errors()
     async def errors_handler(update: types.Update, exception: Exception):
@@ -783,18 +3901,6 @@ async def main():
             logging.error(f"Error in error handler: {e}")
             logging.exception("Full error handler traceback:")
     
-    # Устанавливаем команды
-    await set_bot_commands(bot)
-    
-    # Запускаем проверку pending заявок в отдельной таске
-    asyncio.create_task(check_pending_requests(bot))
-    
-    # Запускаем проверку отложенных ссылок в отдельной таске
-    asyncio.create_task(check_pending_invites(bot))
-    
-    # Запускаем проверку отложенных уведомлений о входе в отдельной таске
-    asyncio.create_task(check_pending_join_notifications(bot))
-
     # Функция проверки, является ли пользователь админом
     def check_is_admin(user_id: int) -> bool:
         with get_db() as db:
@@ -862,7 +3968,7 @@ async def main():
         await message.answer("Кого вы хотите добавить в заявку?", reply_markup=kb.as_markup())
         await state.set_state(RequestFSM.Choice)
 
-    @dp.callback_query(F.data.in_({"person_self", "person_third"}), RequestFSM.Choice)
+    @callbacks.exact("person_self", "person_third", states=[RequestFSM.Choice])
     async def person_choice(callback: CallbackQuery, state: FSMContext):
         p_type = "self" if callback.data == "person_self" else "third_party"
         
@@ -885,11 +3991,8 @@ async def main():
             
             # Затем проверяем наличие активной заявки
             with get_db() as db:
-                existing_self_request = db.query(UserRequest).filter(
-                    UserRequest.chat_id == callback.from_user.id,
-                    UserRequest.person_type == "self",
-                    UserRequest.status.in_(["pending", "approved"])
-                ).first()
+                existing_self_request = find_active_duplicate(
+                    db, chat_id=callback.from_user.id, person_type="self")
                 
                 if existing_self_request:
                     status_text = "рассматривается" if existing_self_request.status == "pending" else "одобрена"
@@ -908,7 +4011,7 @@ async def main():
             reply_markup=get_back_cancel_kb("back_to_choice").as_markup()
         )
 
-    @dp.callback_query(F.data == "back_to_choice", RequestFSM.FullName)
+    @callbacks.exact("back_to_choice", states=[RequestFSM.FullName])
     async def back_to_choice_cb(callback: CallbackQuery, state: FSMContext):
         await state.set_state(RequestFSM.Choice)
         kb = InlineKeyboardBuilder()
@@ -917,7 +4020,7 @@ async def main():
         kb.adjust(1)
         await callback.message.edit_text("Кого вы хотите добавить в заявку?", reply_markup=kb.as_markup())
 
-    @dp.callback_query(F.data == "cancel")
+    @callbacks.exact("cancel")
     async def cancel_request(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         await callback.message.edit_text("Заявка отменена пользователем.")
@@ -926,7 +4029,7 @@ async def main():
     # ---- Ввод ФИО ----
     @dp.message(RequestFSM.FullName)
     async def enter_fullname(message: Message, state: FSMContext):
-        fio = message.text.strip()
+        fio = " ".join(message.text.split())
         pattern = r"^[А-Яа-яЁё\s]+$"
         if not re.match(pattern, fio):
             await message.answer("ФИО должно содержать только русские буквы (и пробелы). Повторите ввод.")
@@ -938,11 +4041,8 @@ async def main():
         # Проверка существующих заявок по имени только для "self", для "third_party" проверка по username
         if not is_editing and data.get("person_type") == "self":
             with get_db() as db:
-                existing_self_request = db.query(UserRequest).filter(
-                    UserRequest.full_name == fio,
-                    UserRequest.person_type == "self",
-                    UserRequest.status.in_(["pending", "approved"])
-                ).first()
+                existing_self_request = find_active_duplicate(
+                    db, name_key=name_key(fio), person_type="self")
                 
                 if existing_self_request:
                     status_text = "рассматривается" if existing_self_request.status == "pending" else "одобрена"
@@ -963,16 +4063,20 @@ async def main():
         else:
             await state.set_state(RequestFSM.Phone)
             await message.answer(
-                "Введите номер телефона (начинается с 7, всего 11 цифр). После ввода нажмите Enter:",
+                "Введите номер телефона (например, +7 999 123-45-67 или 89991234567). После ввода нажмите Enter:",
                 reply_markup=get_back_cancel_kb("back_to_choice").as_markup()
             )
 
     # ---- Ввод телефона ----
     @dp.message(RequestFSM.Phone)
     async def enter_phone(message: Message, state: FSMContext):
-        phone = message.text.strip()
-        if not (phone.startswith("7") and len(phone) == 11 and phone.isdigit()):
-            await message.answer("Телефон должен начинаться с '7' и содержать ровно 11 цифр. Попробуйте снова.")
+        # +7 (999) 123-45-67, 89991234567 и т.п. приводятся к 7XXXXXXXXXX
+        phone = normalize_phone(message.text)
+        if not phone:
+            await message.answer(
+                "Не удалось распознать номер. Подойдёт российский номер в любом из форматов: "
+                "+7 999 123-45-67, 8 (999) 123-45-67, 79991234567 или 9991234567. Попробуйте снова."
+            )
             return
 
         data = await state.get_data()
@@ -1035,7 +4139,7 @@ async def main():
                 await state.set_state(RequestFSM.Confirm)
                 await show_confirmation(message, state)
 
-    @dp.callback_query(F.data == "back_to_workplace", RequestFSM.Position)
+    @callbacks.exact("back_to_workplace", states=[RequestFSM.Position])
     async def back_to_workplace_cb(callback: CallbackQuery, state: FSMContext):
         await state.set_state(RequestFSM.Workplace)
         await callback.message.edit_text(
@@ -1043,7 +4147,7 @@ async def main():
             reply_markup=get_back_cancel_kb("back_to_choice").as_markup()
         )
 
-    @dp.callback_query(F.data == "back_to_position", RequestFSM.Username)
+    @callbacks.exact("back_to_position", states=[RequestFSM.Username])
     async def back_to_position_cb(callback: CallbackQuery, state: FSMContext):
         await state.set_state(RequestFSM.Position)
         await callback.message.edit_text(
@@ -1066,10 +4170,7 @@ async def main():
         if not is_editing:
             # 1. Проверка существующих заявок с таким же username
             with get_db() as db:
-                existing_username_request = db.query(UserRequest).filter(
-                    UserRequest.username == usern,
-                    UserRequest.status.in_(["pending", "approved"])
-                ).first()
+                existing_username_request = find_active_duplicate(db, username_key=username_key(usern))
                 
                 if existing_username_request:
                     status_text = "рассматривается" if existing_username_request.status == "pending" else "одобрена"
@@ -1087,13 +4188,14 @@ async def main():
                 clean_username = usern[1:] if usern.startswith('@') else usern
                 
                 # Пробуем получить пользователя через Telethon
-                if not telethon_client.is_connected():
-                    await telethon_client.connect()
+                client = get_telethon_client()
+                if not client.is_connected():
+                    await client.connect()
                     
                 # Получаем сущность пользователя по username
                 user_entity = None
                 try:
-                    user_entity = await telethon_client.get_entity(clean_username)
+                    user_entity = await telethon_call("get_entity", client.get_entity(clean_username))
                 except Exception as e:
                     logging.error(f"Не удалось получить информацию о пользователе {clean_username}: {e}")
                 
@@ -1125,9 +4227,10 @@ async def main():
             await show_confirmation(message, state)
 
     # ---- Подтверждение заявки (запись в БД) ----
-    @dp.callback_query(F.data == "confirm_yes", RequestFSM.Confirm)
+    @callbacks.exact("confirm_yes", states=[RequestFSM.Confirm], once=True)
     async def confirm_request(callback: CallbackQuery, state: FSMContext):
         data = await state.get_data()
+        saved = False
         try:
             current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
             
@@ -1148,17 +4251,22 @@ async def main():
                     status="pending",
                     created_at=current_time
                 )
+                for column, value in request_keys(new_req.full_name, new_req.phone, new_req.username).items():
+                    setattr(new_req, column, value)
                 db.add(new_req)
+                record_analytics(db, "created", new_req, current_time)
                 with safe_commit(db):
                     pass
+                saved = True
+                duplicates_text = await asyncio.to_thread(duplicates_warning, new_req.id)
 
                 # Уведомление админов с кнопками
                 admins = db.query(AdminUser).all()
                 for admin in admins:
                     try:
                         kb = InlineKeyboardBuilder()
-                        kb.button(text="✅ Одобрить", callback_data=f"approve_{new_req.id}")
-                        kb.button(text="❌ Отклонить", callback_data=f"reject_{new_req.id}")
+                        kb.button(text="✅ Одобрить", callback_data=callbacks.pack("approve", new_req.id))
+                        kb.button(text="❌ Отклонить", callback_data=callbacks.pack("reject", new_req.id))
                         kb.adjust(2)
                         
                         await callback.message.bot.send_message(
@@ -1171,7 +4279,8 @@ async def main():
                                 f"🏢 <b>Место работы:</b> {new_req.workplace}\n"
                                 f"💼 <b>Должность:</b> {new_req.position}\n"
                                 f"👥 <b>Username:</b> {new_req.username if new_req.username else '—'}\n"
-                                f"📅 <b>Дата создания:</b> {current_time}\n\n"
+                                f"📅 <b>Дата создания:</b> {current_time}"
+                                f"{duplicates_text}\n\n"
                                 "⚠️ <i>Не забудьте проверить заявку!</i>"
                             ),
                             reply_markup=kb.as_markup(),
@@ -1197,10 +4306,13 @@ async def main():
             await callback.answer("Заявка успешно подтверждена.", show_alert=False)
         except Exception as e:
             logging.error(f"Ошибка при сохранении заявки: {e}")
+            if not saved:
+                # Заявка не записана — пусть пользователь сможет нажать ещё раз
+                await callbacks.forget(callback)
             await callback.answer("Ошибка при сохранении заявки.", show_alert=True)
 
     # ---- «Исправить» ----
-    @dp.callback_query(F.data == "edit_data", RequestFSM.Confirm)
+    @callbacks.exact("edit_data", states=[RequestFSM.Confirm])
     async def edit_data(callback: CallbackQuery, state: FSMContext):
         data = await state.get_data()
         kb = InlineKeyboardBuilder()
@@ -1215,9 +4327,8 @@ async def main():
         await callback.message.edit_text("Выберите поле для исправления:", reply_markup=kb.as_markup())
         await callback.answer()
 
-    @dp.callback_query(F.data.startswith("edit_"), RequestFSM.Confirm)
-    async def edit_field(callback: CallbackQuery, state: FSMContext):
-        field = callback.data.split("_")[1]
+    @callbacks.prefix("edit", str, states=[RequestFSM.Confirm])
+    async def edit_field(callback: CallbackQuery, state: FSMContext, field: str):
         field_map = {
             "fullname": ("Введите новое ФИО:", RequestFSM.FullName),
             "phone": ("Введите новый номер телефона:", RequestFSM.Phone),
@@ -1235,7 +4346,7 @@ async def main():
             )
             await callback.answer()
 
-    @dp.callback_query(F.data == "back_to_confirmation")
+    @callbacks.exact("back_to_confirmation")
     async def back_to_confirmation_cb(callback: CallbackQuery, state: FSMContext):
         await state.update_data(editing=False)
         await state.set_state(RequestFSM.Confirm)
@@ -1269,7 +4380,7 @@ async def main():
         )
         await state.set_state(RulesFSM.WaitingText)
 
-    @dp.callback_query(F.data == "cancel_setrules", RulesFSM.WaitingText)
+    @callbacks.exact("cancel_setrules", states=[RulesFSM.WaitingText])
     async def cancel_setrules_cb(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         await callback.message.edit_text("Изменение правил отменено.")
@@ -1304,7 +4415,7 @@ async def main():
         await message.answer("Введите ФИО нового админа:", reply_markup=kb.as_markup())
         await state.set_state(AddAdminFSM.WaitingFullName)
 
-    @dp.callback_query(F.data == "cancel_addadmin", AddAdminFSM.WaitingFullName)
+    @callbacks.exact("cancel_addadmin", states=[AddAdminFSM.WaitingFullName])
     async def cancel_addadmin_fullname_cb(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         await callback.message.edit_text("Добавление админа отменено.")
@@ -1324,7 +4435,7 @@ async def main():
         )
         await state.set_state(AddAdminFSM.WaitingID)
 
-    @dp.callback_query(F.data == "cancel_addadmin_id", AddAdminFSM.WaitingID)
+    @callbacks.exact("cancel_addadmin_id", states=[AddAdminFSM.WaitingID])
     async def cancel_addadmin_id_cb(callback: CallbackQuery, state: FSMContext):
         await state.clear()
         await callback.message.edit_text("Добавление админа отменено (на стадии ID).")
@@ -1352,7 +4463,7 @@ async def main():
                     pass
                 await message.answer(f"Админ {admin_fullname} (id={new_tid}) добавлен.")
         await state.clear()
-        await set_bot_commands(bot)
+        await set_bot_commands(bot, chat_ids=[new_tid])
 
     # ---- Удаление админа (только root) ----
     @dp.message(Command("deladmin"))
@@ -1392,7 +4503,7 @@ async def main():
                 return
 
         kb = InlineKeyboardBuilder()
-        kb.button(text="Удалить", callback_data=f"deladm_{adm_user.id}")
+        kb.button(text="Удалить", callback_data=callbacks.pack("deladm", adm_user.id))
         if idx > 0:
             kb.button(text="⬅️ Назад", callback_data="prev_deladmin")
         if idx < len(ids) - 1:
@@ -1410,7 +4521,7 @@ async def main():
         else:
             await message.answer(text, reply_markup=kb.as_markup())
 
-    @dp.callback_query(F.data == "prev_deladmin", DeleteAdminFSM.Listing)
+    @callbacks.exact("prev_deladmin", states=[DeleteAdminFSM.Listing])
     async def prev_deladmin_cb(callback: CallbackQuery, state: FSMContext):
         data = await state.get_data()
         idx = data.get("deladmin_index", 0)
@@ -1420,7 +4531,7 @@ async def main():
         await callback.answer()
         await show_admin_list_to_delete(callback.message, state)
 
-    @dp.callback_query(F.data == "next_deladmin", DeleteAdminFSM.Listing)
+    @callbacks.exact("next_deladmin", states=[DeleteAdminFSM.Listing])
     async def next_deladmin_cb(callback: CallbackQuery, state: FSMContext):
         data = await state.get_data()
         idx = data.get("deladmin_index", 0)
@@ -1429,10 +4540,9 @@ async def main():
         await callback.answer()
         await show_admin_list_to_delete(callback.message, state)
 
-    @dp.callback_query(F.data.startswith("deladm_"), DeleteAdminFSM.Listing)
-    async def delete_admin_confirm(callback: CallbackQuery, state: FSMContext):
-        # удаляем админа
-        adm_id = int(callback.data.split("_")[1])  # это колонка "id" в таблице admin_users
+    @callbacks.prefix("deladm", int, states=[DeleteAdminFSM.Listing])
+    async def delete_admin_confirm(callback: CallbackQuery, state: FSMContext, adm_id: int):
+        # удаляем админа (adm_id — это колонка "id" в таблице admin_users)
         with get_db() as db:
             adm_user = db.get(AdminUser, adm_id)
             if not adm_user:
@@ -1462,18 +4572,9 @@ async def main():
 
         # Меняем команды у удалённого админа (теперь он не админ)
         try:
-            # только юзерские команды
-            user_commands = [
-                BotCommand(command="start", description="Начать работу"),
-                BotCommand(command="help", description="Помощь"),
-                BotCommand(command="new", description="Создать новую заявку"),
-            ]
-            await callback.message.bot.set_my_commands(
-                user_commands,
-                scope=BotCommandScopeChat(chat_id=del_telegram_id)
-            )
-        except:
-            pass  # возможно, user не общался с ботом
+            await set_bot_commands(callback.message.bot, chat_ids=[del_telegram_id])
+        except Exception as e:
+            logging.warning(f"Не удалось обновить команды удалённого админа {del_telegram_id}: {e}")
 
         # Переходим к следующему, если остался
         if idx >= 0 and idx < len(ids):
@@ -1490,10 +4591,13 @@ async def main():
             return
 
         with get_db() as db:
-            total_req = db.query(UserRequest).count()
-            pending_req = db.query(UserRequest).filter_by(status="pending").count()
-            approved_req = db.query(UserRequest).filter_by(status="approved").count()
-            rejected_req = db.query(UserRequest).filter_by(status="rejected").count()
+            # Рабочая таблица и архив: по индексу status в каждой
+            counts = dict.fromkeys(("pending", "approved", "rejected"), 0)
+            for model in REQUEST_MODELS:
+                for status, count in db.query(model.status, func.count()).group_by(model.status):
+                    counts[status] = counts.get(status, 0) + count
+            total_req = sum(counts.values())
+            pending_req, approved_req, rejected_req = counts["pending"], counts["approved"], counts["rejected"]
 
         await message.answer(
             text=(
@@ -1507,6 +4611,97 @@ async def main():
             parse_mode="HTML"
         )
 
+    # ---- Аналитика по суточным агрегатам ----
+    @dp.message(Command("analytics"))
+    async def admin_analytics(message: Message):
+        if not check_is_admin(message.from_user.id):
+            await message.answer("У вас нет прав.")
+            return
+
+        try:
+            date_from, date_to = parse_analytics_args(message.text)
+        except ValueError:
+            await message.answer(
+                "Формат: /analytics [дней] или /analytics ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]\n"
+                f"Без аргументов — последние {ANALYTICS_DEFAULT_DAYS} дней."
+            )
+            return
+
+        summary = load_analytics(date_from, date_to)
+        with get_db() as db:
+            admin_names = {admin.telegram_id: admin.full_name for admin in db.query(AdminUser)}
+        await message.answer(
+            format_analytics(summary, date_from, date_to, admin_names),
+            parse_mode="HTML",
+        )
+
+    # ---- Выгрузка заявок ----
+    @dp.message(Command("export"))
+    async def admin_export(message: Message):
+        if not check_is_admin(message.from_user.id):
+            await message.answer("У вас нет прав.")
+            return
+
+        try:
+            options = parse_export_args(message.text)
+        except ValueError:
+            await message.answer(
+                "Формат: /export [pending|approved|rejected|all] [ГГГГ-ММ-ДД [ГГГГ-ММ-ДД]] [csv|xlsx]\n"
+                "Например: /export approved 2024-01-01 2024-03-31 xlsx"
+            )
+            return
+        fmt = options.pop("fmt")
+        if fmt == "xlsx" and openpyxl is None:
+            await message.answer("XLSX недоступен (не установлен openpyxl), выгружаю в CSV.")
+            fmt = "csv"
+
+        progress = await message.answer("⏳ Готовлю выгрузку…")
+        filename = f"requests_{options['status'] or 'all'}_{datetime.now():%Y%m%d_%H%M}.{fmt}"
+        fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+        os.close(fd)
+        try:
+            started = time.perf_counter()
+            count = await asyncio.to_thread(write_export, path, fmt, **options)
+            elapsed = time.perf_counter() - started
+            if not count:
+                await progress.edit_text("Заявок по этим условиям нет.")
+                return
+            if os.path.getsize(path) > EXPORT_MAX_BYTES:
+                await progress.edit_text(
+                    f"Выгрузка ({count} заявок) больше 50 МБ — Telegram её не примет. "
+                    "Сузьте период или выберите статус."
+                )
+                return
+            await message.answer_document(
+                FSInputFile(path, filename=filename),
+                caption=f"Заявок: {count} (выгрузка за {elapsed:.1f} с)",
+            )
+            await progress.delete()
+        finally:
+            os.remove(path)
+
+    # ---- Резервная копия базы (только root) ----
+    @dp.message(Command("backup"))
+    async def admin_backup(message: Message):
+        if not is_root_admin(message.from_user.id):
+            await message.answer("Только главный админ может снимать резервные копии.")
+            return
+        if backup_lock.locked():
+            await message.answer("Резервная копия уже снимается, дождитесь окончания.")
+            return
+
+        progress = await message.answer("⏳ Снимаю резервную копию…")
+        try:
+            stats = await run_backup()
+        except Exception as e:
+            logging.exception("Ошибка резервного копирования")
+            await progress.edit_text(f"Не удалось снять резервную копию: {e}")
+            return
+        await progress.edit_text(
+            f"✅ {format_backup_stats(stats)}\n"
+            f"Копий в {BACKUP_DIR}: {len(list_backups())}"
+        )
+
     @dp.message(Command("check"))
     async def admin_check(message: Message, state: FSMContext):
         if not check_is_admin(message.from_user.id):
@@ -1532,52 +4727,318 @@ async def main():
             return
 
         with get_db() as db:
-            req = db.get(UserRequest, p_ids[idx])
-        if not req:
-            await message.answer("Заявка не найдена.")
-            return
+            req = db.get(UserRequest, p_ids[idx])
+        if not req:
+            await message.answer("Заявка не найдена.")
+            return
+        duplicates_text = await asyncio.to_thread(duplicates_warning, req.id)
+
+        kb = InlineKeyboardBuilder()
+        kb.button(text="✅ Одобрить", callback_data=callbacks.pack("approve", req.id))
+        kb.button(text="❌ Отклонить", callback_data=callbacks.pack("reject", req.id))
+        if idx > 0:
+            kb.button(text="⬅️ Назад", callback_data="prev_request")
+        if idx < len(p_ids) - 1:
+            kb.button(text="➡️ Далее", callback_data="next_request")
+        if len(p_ids) > 1:
+            kb.button(text="☑️ Выбрать несколько", callback_data="bulk_start")
+        kb.adjust(2)
+
+        text = (
+            f"🆕 <b>Новая заявка</b> #{req.id}\n\n"
+            f"📝 <b>Тип:</b> {'Своя' if req.person_type == 'self' else 'Третье лицо'}\n"
+            f"👤 <b>ФИО:</b> {req.full_name}\n"
+            f"📞 <b>Телефон:</b> <code>{req.phone}</code>\n"
+            f"🏢 <b>Место работы:</b> {req.workplace}\n"
+            f"💼 <b>Должность:</b> {req.position}\n"
+            f"👥 <b>Username:</b> {req.username if req.username else '—'}\n"
+            f"📅 <b>Дата создания:</b> {req.created_at}\n"
+            f"Статус: {req.status}"
+            f"{duplicates_text}"
+        )
+
+        if edit:
+            await message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+        else:
+            await message.answer(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+
+    @callbacks.exact("next_request")
+    async def next_request_cb(callback: CallbackQuery, state: FSMContext):
+        data = await state.get_data()
+        idx = data.get("current_index", 0)
+        await state.update_data(current_index=idx + 1)
+        await callback.answer()
+        await show_request_to_admin(callback.message, state)
+
+    @callbacks.exact("prev_request")
+    async def prev_request_cb(callback: CallbackQuery, state: FSMContext):
+        data = await state.get_data()
+        idx = data.get("current_index", 0)
+        await state.update_data(current_index=idx - 1)
+        await callback.answer()
+        await show_request_to_admin(callback.message, state)
+
+    # ---- Массовая обработка в /check ----
+    bulk_sender = BulkSender(bot, BULK_SEND_RATE, BULK_PROGRESS_INTERVAL)
+    dp.shutdown.register(bulk_sender.close)
+    dp["bulk_sender"] = bulk_sender
+
+    def pending_request_ids(workplace: Optional[str] = None) -> list:
+        with get_db() as db:
+            query = db.query(UserRequest.id).filter(UserRequest.status == "pending")
+            if workplace is not None:
+                query = query.filter(UserRequest.workplace == workplace)
+            return [req_id for (req_id,) in query.order_by(UserRequest.id.desc())]
+
+    async def show_bulk_page(message: Message, state: FSMContext):
+        data = await state.get_data()
+        ids, selected = data["bulk_ids"], set(data["bulk_selected"])
+        pages = max(1, -(-len(ids) // BULK_PAGE_SIZE))
+        page = min(data.get("bulk_page", 0), pages - 1)
+        page_ids = ids[page * BULK_PAGE_SIZE:(page + 1) * BULK_PAGE_SIZE]
+
+        with get_db() as db:
+            rows = {
+                req_id: (full_name, workplace)
+                for req_id, full_name, workplace in db.query(
+                    UserRequest.id, UserRequest.full_name, UserRequest.workplace
+                ).filter(UserRequest.id.in_(page_ids))
+            }
+
+        kb = InlineKeyboardBuilder()
+        for req_id in page_ids:
+            full_name, workplace = rows.get(req_id, ("—", "—"))
+            mark = "☑️" if req_id in selected else "⬜"
+            kb.button(
+                text=f"{mark} #{req_id} {full_name} · {workplace}"[:64],
+                callback_data=callbacks.pack("bulk_toggle", req_id),
+            )
+        nav = 0
+        if page > 0:
+            kb.button(text="⬅️", callback_data=callbacks.pack("bulk_page", page - 1))
+            nav += 1
+        if page < pages - 1:
+            kb.button(text="➡️", callback_data=callbacks.pack("bulk_page", page + 1))
+            nav += 1
+        kb.button(text="Выбрать страницу", callback_data="bulk_select_page")
+        kb.button(text="🏢 По месту работы", callback_data="bulk_workplaces")
+        kb.button(text=f"✅ Одобрить ({len(selected)})", callback_data="bulk_approve")
+        kb.button(text=f"❌ Отклонить ({len(selected)})", callback_data="bulk_reject")
+        kb.button(text="Снять выбор", callback_data="bulk_clear")
+        kb.button(text="↩️ По одной", callback_data="bulk_cancel")
+        kb.adjust(*([1] * len(page_ids)), *([nav] if nav else []), 2, 2, 2)
+
+        await message.edit_text(
+            "☑️ <b>Массовая обработка заявок</b>\n\n"
+            f"В ожидании: {len(ids)} · выбрано: {len(selected)}\n"
+            f"Страница {page + 1} из {pages}",
+            reply_markup=kb.as_markup(),
+            parse_mode="HTML",
+        )
+
+    @callbacks.exact("bulk_start")
+    async def bulk_start_cb(callback: CallbackQuery, state: FSMContext):
+        if not check_is_admin(callback.from_user.id):
+            await callback.answer("Вы не админ!", show_alert=True)
+            return
+        ids = pending_request_ids()
+        if not ids:
+            await callback.answer("Нет заявок со статусом 'pending'.", show_alert=True)
+            return
+        await state.set_state(BulkFSM.Selecting)
+        await state.update_data(bulk_ids=ids, bulk_selected=[], bulk_page=0)
+        # Режим открывается в том же сообщении: «Одобрить» из прошлого выбора не должно блокировать новое
+        await callbacks.forget(callback, "bulk_approve")
+        await callback.answer()
+        await show_bulk_page(callback.message, state)
+
+    @callbacks.prefix("bulk_toggle", int, states=[BulkFSM.Selecting])
+    async def bulk_toggle_cb(callback: CallbackQuery, state: FSMContext, req_id: int):
+        selected = (await state.get_data())["bulk_selected"]
+        if req_id in selected:
+            selected.remove(req_id)
+        else:
+            selected.append(req_id)
+        await state.update_data(bulk_selected=selected)
+        await callback.answer()
+        await show_bulk_page(callback.message, state)
+
+    @callbacks.prefix("bulk_page", int, states=[BulkFSM.Selecting])
+    async def bulk_page_cb(callback: CallbackQuery, state: FSMContext, page: int):
+        await state.update_data(bulk_page=page)
+        await callback.answer()
+        await show_bulk_page(callback.message, state)
+
+    @callbacks.exact("bulk_select_page", states=[BulkFSM.Selecting])
+    async def bulk_select_page_cb(callback: CallbackQuery, state: FSMContext):
+        data = await state.get_data()
+        page = data.get("bulk_page", 0)
+        page_ids = data["bulk_ids"][page * BULK_PAGE_SIZE:(page + 1) * BULK_PAGE_SIZE]
+        selected = data["bulk_selected"]
+        selected.extend(req_id for req_id in page_ids if req_id not in selected)
+        await state.update_data(bulk_selected=selected)
+        await callback.answer()
+        await show_bulk_page(callback.message, state)
+
+    @callbacks.exact("bulk_clear", states=[BulkFSM.Selecting])
+    async def bulk_clear_cb(callback: CallbackQuery, state: FSMContext):
+        await state.update_data(bulk_selected=[])
+        await callback.answer()
+        await show_bulk_page(callback.message, state)
+
+    @callbacks.exact("bulk_workplaces", states=[BulkFSM.Selecting])
+    async def bulk_workplaces_cb(callback: CallbackQuery, state: FSMContext):
+        with get_db() as db:
+            workplaces = (
+                db.query(UserRequest.workplace, func.count(UserRequest.id))
+                .filter(UserRequest.status == "pending")
+                .group_by(UserRequest.workplace)
+                .order_by(func.count(UserRequest.id).desc())
+                .limit(20)
+                .all()
+            )
+        # В callback_data — только индекс: название может не влезть в 64 байта
+        await state.update_data(bulk_workplaces=[workplace for workplace, _ in workplaces])
+        kb = InlineKeyboardBuilder()
+        for index, (workplace, count) in enumerate(workplaces):
+            kb.button(text=f"{workplace or '—'} ({count})"[:64], callback_data=callbacks.pack("bulk_wp", index))
+        kb.button(text="↩️ Назад", callback_data=callbacks.pack("bulk_page", (await state.get_data()).get("bulk_page", 0)))
+        kb.adjust(1)
+        await callback.answer()
+        await callback.message.edit_text(
+            "🏢 Выберите место работы — в выбор добавятся все его заявки в ожидании:",
+            reply_markup=kb.as_markup(),
+        )
+
+    @callbacks.prefix("bulk_wp", int, states=[BulkFSM.Selecting])
+    async def bulk_workplace_cb(callback: CallbackQuery, state: FSMContext, index: int):
+        data = await state.get_data()
+        workplaces = data.get("bulk_workplaces", [])
+        if index >= len(workplaces):
+            await callback.answer("Список устарел, откройте его заново.", show_alert=True)
+            return
+        ids = pending_request_ids(workplaces[index])
+        selected = data["bulk_selected"]
+        selected.extend(req_id for req_id in ids if req_id not in selected)
+        # Заявки могли появиться после открытия режима
+        known = set(data["bulk_ids"])
+        bulk_ids = data["bulk_ids"] + [req_id for req_id in ids if req_id not in known]
+        await state.update_data(bulk_selected=selected, bulk_ids=bulk_ids)
+        await callback.answer(f"Добавлено заявок: {len(ids)}")
+        await show_bulk_page(callback.message, state)
+
+    @callbacks.exact("bulk_cancel", states=[BulkFSM.Selecting])
+    async def bulk_cancel_cb(callback: CallbackQuery, state: FSMContext):
+        await state.set_state(None)
+        await state.update_data(pending_ids=pending_request_ids(), current_index=0)
+        await callback.answer()
+        await show_request_to_admin(callback.message, state)
+
+    async def notify_other_admins(bot: Bot, admin_id: int, text: str):
+        with get_db() as db:
+            admin_ids = [a.telegram_id for a in db.query(AdminUser) if a.telegram_id != admin_id]
+        for other_id in admin_ids:
+            try:
+                await bot.send_message(chat_id=other_id, text=text)
+            except Exception as e:
+                logging.warning(f"Не удалось уведомить админа {other_id}: {e}")
 
-        kb = InlineKeyboardBuilder()
-        kb.button(text="✅ Одобрить", callback_data=f"approve_{req.id}")
-        kb.button(text="❌ Отклонить", callback_data=f"reject_{req.id}")
-        if idx > 0:
-            kb.button(text="⬅️ Назад", callback_data="prev_request")
-        if idx < len(p_ids) - 1:
-            kb.button(text="➡️ Далее", callback_data="next_request")
-        kb.adjust(2)
+    def admin_display_name(admin_id: int) -> str:
+        with get_db() as db:
+            admin_user = db.query(AdminUser).filter_by(telegram_id=admin_id).first()
+            return admin_user.full_name if admin_user else str(admin_id)
 
-        text = (
-            f"🆕 <b>Новая заявка</b> #{req.id}\n\n"
-            f"📝 <b>Тип:</b> {'Своя' if req.person_type == 'self' else 'Третье лицо'}\n"
-            f"👤 <b>ФИО:</b> {req.full_name}\n"
-            f"📞 <b>Телефон:</b> <code>{req.phone}</code>\n"
-            f"🏢 <b>Место работы:</b> {req.workplace}\n"
-            f"💼 <b>Должность:</b> {req.position}\n"
-            f"👥 <b>Username:</b> {req.username if req.username else '—'}\n"
-            f"📅 <b>Дата создания:</b> {req.created_at}\n"
-            f"Статус: {req.status}"
-        )
+    def format_request_ids(ids: list, limit: int = 50) -> str:
+        text = ", ".join(f"#{req_id}" for req_id in ids[:limit])
+        return text + (f" и ещё {len(ids) - limit}" if len(ids) > limit else "")
 
-        if edit:
-            await message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
-        else:
-            await message.answer(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+    @callbacks.exact("bulk_approve", states=[BulkFSM.Selecting], once=True)
+    async def bulk_approve_cb(callback: CallbackQuery, state: FSMContext):
+        admin_id = callback.from_user.id
+        if not check_is_admin(admin_id):
+            await callback.answer("Вы не админ!", show_alert=True)
+            return False
+        selected = (await state.get_data())["bulk_selected"]
+        if not selected:
+            await callback.answer("Ничего не выбрано.", show_alert=True)
+            return False
 
-    @dp.callback_query(F.data == "next_request")
-    async def next_request_cb(callback: CallbackQuery, state: FSMContext):
-        data = await state.get_data()
-        idx = data.get("current_index", 0)
-        await state.update_data(current_index=idx + 1)
+        approved = approve_requests(selected, admin_id)
+        await state.clear()
+        with get_db() as db:
+            rules_obj = db.query(GroupRules).first()
+            rules_text = rules_obj.text if rules_obj else "Правила пока не заданы."
+
+        sends = []
+        for req_id, chat_id, person_type, username, code in approved:
+            if person_type == "third_party" and username:
+                sends.append(partial(send_message_as_user, username, third_party_rules_text(rules_text, code)))
+            else:
+                kb = InlineKeyboardBuilder()
+                kb.button(text="✅ Принять", callback_data=callbacks.pack("accept_rules", req_id))
+                kb.button(text="❌ Отклонить", callback_data=callbacks.pack("decline_rules", req_id))
+                kb.adjust(2)
+                sends.append(partial(
+                    bot.send_message, chat_id=chat_id, text=approved_rules_text(rules_text),
+                    reply_markup=kb.as_markup(),
+                ))
+
+        title = f"✅ Одобрено заявок: {len(approved)}"
+        if len(approved) < len(selected):
+            title += f"\nПропущено (уже обработаны): {len(selected) - len(approved)}"
+        job = BulkJob(title, len(sends), callback.message.chat.id, callback.message.message_id)
         await callback.answer()
-        await show_request_to_admin(callback.message, state)
+        await bulk_sender.report(job)
+        if sends:
+            bulk_sender.submit(job, sends)
+            await notify_other_admins(
+                bot, admin_id,
+                f"Админ {admin_display_name(admin_id)} одобрил заявки: "
+                f"{format_request_ids([row[0] for row in approved])}",
+            )
 
-    @dp.callback_query(F.data == "prev_request")
-    async def prev_request_cb(callback: CallbackQuery, state: FSMContext):
-        data = await state.get_data()
-        idx = data.get("current_index", 0)
-        await state.update_data(current_index=idx - 1)
+    @callbacks.exact("bulk_reject", states=[BulkFSM.Selecting])
+    async def bulk_reject_cb(callback: CallbackQuery, state: FSMContext):
+        selected = (await state.get_data())["bulk_selected"]
+        if not selected:
+            await callback.answer("Ничего не выбрано.", show_alert=True)
+            return
+        await state.set_state(BulkFSM.RejectionReason)
         await callback.answer()
-        await show_request_to_admin(callback.message, state)
+        await callback.message.edit_text(f"Укажите причину отказа для выбранных заявок ({len(selected)}):")
+
+    @dp.message(StateFilter(BulkFSM.RejectionReason))
+    async def bulk_rejection_reason(message: Message, state: FSMContext):
+        admin_id = message.from_user.id
+        if not check_is_admin(admin_id):
+            await state.clear()
+            return
+        reason = (message.text or "").strip()
+        if not reason:
+            await message.answer("Причина не может быть пустой.")
+            return
+
+        selected = (await state.get_data())["bulk_selected"]
+        rejected = reject_requests(selected, admin_id, reason)
+        await state.clear()
+
+        title = f"❌ Отклонено заявок: {len(rejected)}"
+        if len(rejected) < len(selected):
+            title += f"\nПропущено (уже обработаны): {len(selected) - len(rejected)}"
+        job = BulkJob(title, len(rejected), message.chat.id)
+        progress = await message.answer(job.progress_text())
+        job.message_id = progress.message_id
+        if rejected:
+            text = rejection_text(reason)
+            bulk_sender.submit(job, [
+                partial(bot.send_message, chat_id=chat_id, text=text, parse_mode="HTML")
+                for _, chat_id in rejected
+            ])
+            await notify_other_admins(
+                bot, admin_id,
+                f"Админ {admin_display_name(admin_id)} отклонил заявки: "
+                f"{format_request_ids([req_id for req_id, _ in rejected])}. Причина: {reason}",
+            )
 
     @dp.message(Command("approved"))
     async def admin_approved(message: Message, state: FSMContext):
@@ -1585,12 +5046,12 @@ async def main():
             await message.answer("У вас нет прав.")
             return
         with get_db() as db:
-            app_list = db.query(UserRequest).filter_by(status="approved").all()
-            if not app_list:
-                await message.answer("Нет одобренных заявок.")
-                return
-            await state.update_data(approved_ids=[r.id for r in app_list], approved_index=0)
-            await show_approved_request(message, state, edit=False)
+            app_ids = request_ids_by_status(db, "approved")
+        if not app_ids:
+            await message.answer("Нет одобренных заявок.")
+            return
+        await state.update_data(approved_ids=app_ids, approved_index=0)
+        await show_approved_request(message, state, edit=False)
 
     async def show_approved_request(message: Message, state: FSMContext, edit: bool = True):
         data = await state.get_data()
@@ -1602,7 +5063,7 @@ async def main():
             return
 
         with get_db() as db:
-            req = db.get(UserRequest, a_ids[idx])
+            req = get_any_request(db, a_ids[idx])
         if not req:
             await message.answer("Заявка не найдена.")
             return
@@ -1632,13 +5093,14 @@ async def main():
             f"📅 <b>Дата одобрения:</b> {req.approved_at}\n"
             f"👤 <b>Одобрил:</b> {admin_name}\n"
             f"✅ <b>Правила приняты:</b> {req.rules_accepted_at or '—'}\n"
+            f"{archived_line(req)}"
         )
         if edit:
             await message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
         else:
             await message.answer(text, reply_markup=kb.as_markup(), parse_mode="HTML")
 
-    @dp.callback_query(F.data == "next_approved")
+    @callbacks.exact("next_approved")
     async def next_approved_cb(callback: CallbackQuery, state: FSMContext):
         data = await state.get_data()
         idx = data.get("approved_index", 0)
@@ -1646,7 +5108,7 @@ async def main():
         await callback.answer()
         await show_approved_request(callback.message, state)
 
-    @dp.callback_query(F.data == "prev_approved")
+    @callbacks.exact("prev_approved")
     async def prev_approved_cb(callback: CallbackQuery, state: FSMContext):
         data = await state.get_data()
         idx = data.get("approved_index", 0)
@@ -1660,12 +5122,12 @@ async def main():
             await message.answer("У вас нет прав.")
             return
         with get_db() as db:
-            rej_list = db.query(UserRequest).filter_by(status="rejected").all()
-            if not rej_list:
-                await message.answer("Нет отклонённых заявок.")
-                return
-            await state.update_data(rejected_ids=[r.id for r in rej_list], rejected_index=0)
-            await show_rejected_request(message, state, edit=False)
+            rej_ids = request_ids_by_status(db, "rejected")
+        if not rej_ids:
+            await message.answer("Нет отклонённых заявок.")
+            return
+        await state.update_data(rejected_ids=rej_ids, rejected_index=0)
+        await show_rejected_request(message, state, edit=False)
 
     async def show_rejected_request(message: Message, state: FSMContext, edit: bool = True):
         data = await state.get_data()
@@ -1677,7 +5139,7 @@ async def main():
             return
 
         with get_db() as db:
-            req = db.get(UserRequest, r_ids[idx])
+            req = get_any_request(db, r_ids[idx])
         if not req:
             await message.answer("Заявка не найдена.")
             return
@@ -1707,13 +5169,14 @@ async def main():
             f"📅 <b>Дата отклонения:</b> {req.rejected_at}\n"
             f"👤 <b>Отклонил:</b> {admin_name}\n"
             f"❌ <b>Причина отказа:</b> {req.rejection_reason or '—'}\n"
+            f"{archived_line(req)}"
         )
         if edit:
             await message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
         else:
             await message.answer(text, reply_markup=kb.as_markup(), parse_mode="HTML")
 
-    @dp.callback_query(F.data == "next_rejected")
+    @callbacks.exact("next_rejected")
     async def next_rejected_cb(callback: CallbackQuery, state: FSMContext):
         data = await state.get_data()
         idx = data.get("rejected_index", 0)
@@ -1721,7 +5184,7 @@ async def main():
         await callback.answer()
         await show_rejected_request(callback.message, state)
 
-    @dp.callback_query(F.data == "prev_rejected")
+    @callbacks.exact("prev_rejected")
     async def prev_rejected_cb(callback: CallbackQuery, state: FSMContext):
         data = await state.get_data()
         idx = data.get("rejected_index", 0)
@@ -1729,6 +5192,72 @@ async def main():
         await callback.answer()
         await show_rejected_request(callback.message, state)
 
+    # ---- Поиск по заявкам ----
+    @dp.message(Command("find"))
+    async def admin_find(message: Message, state: FSMContext):
+        if not check_is_admin(message.from_user.id):
+            await message.answer("У вас нет прав.")
+            return
+        query = message.text.partition(" ")[2].strip()
+        match = build_search_query(query) if query else None
+        if not match:
+            await message.answer(
+                "Формат: /find <текст>\n"
+                "Ищет по ФИО, месту работы, должности, username и телефону, например:\n"
+                "/find иванов\n/find ромашка менеджер\n/find +7 900 123-45-67"
+            )
+            return
+        if not search_available():
+            await message.answer("Поиск недоступен: SQLite собран без FTS5.")
+            return
+
+        total = await asyncio.to_thread(count_search_results, match)
+        if not total:
+            await message.answer(f"По запросу «{query}» ничего не найдено.")
+            return
+        # Курсоры страниц: cursors[i] — [rank, id] последней строки страницы i - 1
+        await state.update_data(find_query=query, find_match=match, find_total=total,
+                                find_cursors=[None], find_page=0)
+        await show_find_page(message, state, edit=False)
+
+    async def show_find_page(message: Message, state: FSMContext, edit: bool = True):
+        data = await state.get_data()
+        match = data.get("find_match")
+        if not match:
+            await message.answer("Поиск устарел, повторите /find.")
+            return
+        page, cursors = data.get("find_page", 0), data.get("find_cursors", [None])
+        rows = await asyncio.to_thread(
+            search_requests, match, cursors[page], FIND_PAGE_SIZE + 1,
+            data.get("find_total", 0) <= SEARCH_RANK_LIMIT,
+        )
+        has_next = len(rows) > FIND_PAGE_SIZE
+        rows = rows[:FIND_PAGE_SIZE]
+        if has_next and len(cursors) == page + 1:
+            cursors.append([rows[-1].rank, rows[-1].id])
+            await state.update_data(find_cursors=cursors)
+
+        kb = InlineKeyboardBuilder()
+        if page > 0:
+            kb.button(text="⬅️ Назад", callback_data="find_prev")
+        if has_next:
+            kb.button(text="➡️ Далее", callback_data="find_next")
+        kb.adjust(2)
+
+        text = format_search_results(rows, data.get("find_total", 0), page, data.get("find_query", ""))
+        if edit:
+            await message.edit_text(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+        else:
+            await message.answer(text, reply_markup=kb.as_markup(), parse_mode="HTML")
+
+    @callbacks.exact("find_next", "find_prev")
+    async def find_page_cb(callback: CallbackQuery, state: FSMContext):
+        data = await state.get_data()
+        page = data.get("find_page", 0) + (1 if callback.data == "find_next" else -1)
+        await state.update_data(find_page=max(0, min(page, len(data.get("find_cursors", [None])) - 1)))
+        await callback.answer()
+        await show_find_page(callback.message, state)
+
     # ---- Одобрить заявку (approve_) ----
     async def send_message_as_user(username: str, message: str, parse_mode: str = 'html') -> bool:
         """
@@ -1742,11 +5271,12 @@ async def main():
         Returns:
             bool: True если сообщение отправлено успешно, False если произошла ошибка
         """
+        client = get_telethon_client()
         try:
-            if not telethon_client.is_connected():
-                await telethon_client.connect()
+            if not client.is_connected():
+                await client.connect()
                 
-            if not await telethon_client.is_user_authorized():
+            if not await client.is_user_authorized():
                 logging.error("Telethon не авторизован")
                 return False
                 
@@ -1755,16 +5285,16 @@ async def main():
             
             try:
                 # Получаем сущность пользователя
-                user = await telethon_client.get_entity(clean_username)
+                user = await telethon_call("get_entity", client.get_entity(clean_username))
                 
                 # Отправляем сообщение
-                await telethon_client.send_message(
+                await telethon_call("send_message", client.send_message(
                     user,
                     message,
                     parse_mode=parse_mode
-                )
+                ))
                 
-                me = await telethon_client.get_me()
+                me = await telethon_call("get_me", client.get_me())
                 logging.info(f"Сообщение отправлено пользователю {clean_username} от {me.first_name} (@{me.username})")
                 return True
                 
@@ -1777,31 +5307,16 @@ async def main():
             return False
 
     # Изменяем обработчик approve_request для использования новой функции
-    @dp.callback_query(F.data.startswith("approve_"))
-    async def approve_request(callback: CallbackQuery, state: FSMContext):
+    @callbacks.prefix("approve", int, once=True)
+    async def approve_request(callback: CallbackQuery, state: FSMContext, req_id: int):
         admin_id = callback.from_user.id
-        current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        with get_db() as db:
-            admin_user = db.query(AdminUser).filter_by(telegram_id=admin_id).first()
-            admin_name = admin_user.full_name if admin_user else str(admin_id)
-
-            req_id = int(callback.data.split("_")[1])
-            req = db.get(UserRequest, req_id)
-            if not req or req.status in ["approved", "rejected"]:
-                await callback.answer("Заявка не найдена или уже обработана!", show_alert=True)
-                return
 
-            # Помечаем заявку одобренной
-            req.status = "approved"
-            req.approved_by = admin_id
-            req.approved_at = current_time
-
-            # Генерируем код для третьего лица, если нужно
-            if req.person_type == "third_party" and req.username:
-                req.confirmation_code = str(uuid.uuid4())[:8]
-
-            db.commit()
+        # Условный UPDATE: если другой админ успел раньше, заявка сюда не вернётся
+        approved = approve_requests([req_id], admin_id)
+        if not approved:
+            await callback.answer("Заявка не найдена или уже обработана!", show_alert=True)
+            return
+        _, c_id, p_type, uname, code = approved[0]
 
         # Уведомление админу об успешном одобрении
         await callback.message.bot.send_message(
@@ -1814,24 +5329,9 @@ async def main():
             rules_obj = db.query(GroupRules).first()
             rules_text = rules_obj.text if rules_obj else "Правила пока не заданы."
 
-            req = db.get(UserRequest, req_id)
-            c_id = req.chat_id
-            p_type = req.person_type
-            code = req.confirmation_code
-            uname = req.username
-
         if p_type == "third_party" and uname:
             # Правила отправляем через Telethon в ЛС третьему лицу
-            text_for_third = (
-                 "🎉 <b>Ваша заявка одобрена!</b>\n\n"
-                 "📋 <b>Правила группы:</b>\n"
-                  f"  <b>{rules_text}</b>\n\n"
-                "✅ <b>Что бы принять или отклонить правила, отправьте команды боту @hrclubrtbot:</b>\n"
-                "✅ <b>Принять правила:</b>\n"
-                 f"Отправьте команду:  <code>/accept {code}</code>\n\n"
-                 "❌ <b>Отклонить правила:</b>\n"
-                f"Отправьте команду:  <code>/decline {code}</code>"
-            )
+            text_for_third = third_party_rules_text(rules_text, code)
 
             # Отправляем через Telethon
             success = await send_message_as_user(uname, text_for_third)
@@ -1842,14 +5342,10 @@ async def main():
                 
         else:
             # Если заявка «за себя» — отправляем правила в ЛС самому пользователю бота
-            rules_text_formatted = (
-                "🎉 <b>Ваша заявка одобрена!</b>\n\n"
-                "📋 <b>Правила группы:</b>\n"
-                f"   <b>{rules_text}</b>\n\n"
-            )
+            rules_text_formatted = approved_rules_text(rules_text)
             kb = InlineKeyboardBuilder()
-            kb.button(text="✅ Принять", callback_data=f"accept_rules_{req_id}")
-            kb.button(text="❌ Отклонить", callback_data=f"decline_rules_{req_id}")
+            kb.button(text="✅ Принять", callback_data=callbacks.pack("accept_rules", req_id))
+            kb.button(text="❌ Отклонить", callback_data=callbacks.pack("decline_rules", req_id))
             kb.adjust(2)
 
             try:
@@ -1880,14 +5376,13 @@ async def main():
                     await callback.message.edit_text("Все заявки обработаны.")
 
     # ---- Отклонить заявку (reject_) ----
-    @dp.callback_query(F.data.startswith("reject_"))
-    async def reject_request_cb(callback: CallbackQuery, state: FSMContext):
+    @callbacks.prefix("reject", int)
+    async def reject_request_cb(callback: CallbackQuery, state: FSMContext, req_id: int):
         admin_id = callback.from_user.id
         if not check_is_admin(admin_id):
             await callback.answer("Вы не админ!", show_alert=True)
             return
 
-        req_id = int(callback.data.split("_")[1])
         with get_db() as db:
             req = db.get(UserRequest, req_id)
             if not req:
@@ -1909,36 +5404,22 @@ async def main():
         admin_id = message.from_user.id
 
         if req_id:
-            with get_db() as db:
-                req = db.get(UserRequest, req_id)
-                if not req:
-                    await message.answer("Заявка не найдена.")
-                    await state.clear()
-                    return
-                if req.status in ["approved", "rejected"]:
-                    await message.answer("Эта заявка уже обработана другим админом.")
-                    await state.clear()
-                    return
-
-                # Отмечаем заявку как отклонённую
-                req.status = "rejected"
-                req.rejection_reason = reason
-                req.rejected_by = admin_id
-                with safe_commit(db):
-                    pass
-
-                c_id = req.chat_id
+            # Отмечаем заявку как отклонённую, если её не обработали, пока вводилась причина
+            rejected = reject_requests([req_id], admin_id, reason)
+            if not rejected:
+                with get_db() as db:
+                    exists = db.get(UserRequest, req_id) is not None
+                await message.answer(
+                    "Эта заявка уже обработана другим админом." if exists else "Заявка не найдена."
+                )
+                await state.clear()
+                return
+            c_id = rejected[0][1]
 
             # Уведомляем самого пользователя об отказе
             await message.bot.send_message(
                 chat_id=c_id,
-                text=(
-                    "❌ <b>Ваша заявка отклонена.</b>\n\n"
-                    f"📝 <b>Причина:</b> <i>{reason}</i>\n\n"
-                    " <b>Что делать дальше?</b>\n"
-                    "Вы можете подать новую заявку, исправив указанные ошибки.\n"
-                    "Для этого используйте команду /new."
-                ),
+                text=rejection_text(reason),
                 parse_mode="HTML"
             )
             await message.answer("Заявка отклонена. Причина сохранена.")
@@ -1977,9 +5458,8 @@ async def main():
         await state.clear()
 
     # ---- Принять правила (для "self") ----
-    @dp.callback_query(F.data.startswith("accept_rules_"))
-    async def accept_rules_bot(callback: CallbackQuery):
-        req_id = int(callback.data.split("_")[2])
+    @callbacks.prefix("accept_rules", int, once=True)
+    async def accept_rules_bot(callback: CallbackQuery, req_id: int):
         
         # Проверяем, рабочее ли сейчас время
         if not is_work_time():
@@ -1988,6 +5468,8 @@ async def main():
             with get_db() as db:
                 req = db.get(UserRequest, req_id)
                 if req:
+                    if not req.rules_accepted_at:
+                        record_analytics(db, "rules_accepted", req, current_time)
                     req.rules_accepted_at = current_time
                     
                     # Создаем запись для отложенной отправки
@@ -2022,6 +5504,8 @@ async def main():
             with get_db() as db:
                 req = db.get(UserRequest, req_id)
                 if req:
+                    if not req.rules_accepted_at:
+                        record_analytics(db, "rules_accepted", req, current_time)
                     req.rules_accepted_at = current_time
                     db.commit()
                     
@@ -2045,18 +5529,13 @@ async def main():
             await callback.answer()
         except Exception as e:
             logging.error(f"Ошибка при создании ссылки: {e}")
+            await callbacks.forget(callback)
             await callback.answer("Ошибка при создании ссылки.", show_alert=True)
 
     # ---- Отклонить правила (для "self") ----
-    @dp.callback_query(F.data.startswith("decline_rules_"))
-    async def decline_rules_bot(callback: CallbackQuery):
-        req_id = int(callback.data.split("_")[2])
-        with get_db() as db:
-            req = db.get(UserRequest, req_id)
-            if req and req.status == "approved":
-                req.status = "rejected"
-                req.rejection_reason = "Пользователь не принял правила"
-                db.commit()
+    @callbacks.prefix("decline_rules", int, once=True)
+    async def decline_rules_bot(callback: CallbackQuery, req_id: int):
+        reject_requests([req_id], None, "Пользователь не принял правила", from_status="approved")
         await callback.message.edit_text("Вы отклонили правила. Доступ в группу не предоставлен.")
         await callback.answer()
 
@@ -2068,43 +5547,43 @@ async def main():
             await message.answer("Использование: /accept <код>")
             return
         code = parts[1]
-        
+
         with get_db() as db:
-            req = db.query(UserRequest).filter_by(confirmation_code=code).first()
-            if not req:
-                await message.answer("Некорректный код. Заявка не найдена.")
+            # Подпись и срок проверяются в памяти, заявка читается по первичному ключу
+            try:
+                req = load_request_by_code(db, code)
+            except ConfirmationCodeError as e:
+                await message.answer(str(e))
                 return
             if req.status != "approved":
                 await message.answer("Заявка не в статусе 'approved'.")
                 return
-        
-        # Проверяем, рабочее ли сейчас время
-        if not is_work_time():
-            # Сохраняем дату принятия правил
-            current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            with get_db() as db:
-                req = db.query(UserRequest).filter_by(confirmation_code=code).first()
+
+            # Проверяем, рабочее ли сейчас время
+            if not is_work_time():
+                # Сохраняем дату принятия правил
+                current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                if not req.rules_accepted_at:
+                    record_analytics(db, "rules_accepted", req, current_time)
                 req.rules_accepted_at = current_time
-                
+
                 # Создаем запись для отложенной отправки
                 new_pending = PendingInvite(
                     request_id=req.id,
                     chat_id=message.from_user.id,
                     created_at=current_time,
                     is_third_party=1,
-                    confirmation_code=code
+                    confirmation_code=req.confirmation_code
                 )
                 db.add(new_pending)
                 db.commit()
-            
-            await message.answer(
-                "Спасибо! Вы приняли правила.\n\n"
-                "⚠️ Ссылка на беседу будет отправлена автоматически в рабочее время (с 8:00 до 20:00 в будние дни)."
-            )
-            return
-        
-        # Остальной код остается без изменений
-        with get_db() as db:
+
+                await message.answer(
+                    "Спасибо! Вы приняли правила.\n\n"
+                    "⚠️ Ссылка на беседу будет отправлена автоматически в рабочее время (с 8:00 до 20:00 в будние дни)."
+                )
+                return
+
             try:
                 # Для третьих лиц:
                 link = await message.bot.create_chat_invite_link(
@@ -2114,6 +5593,8 @@ async def main():
                 
                 # Сохраняем дату принятия правил
                 current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+                if not req.rules_accepted_at:
+                    record_analytics(db, "rules_accepted", req, current_time)
                 req.rules_accepted_at = current_time
                 db.commit()
 
@@ -2149,67 +5630,43 @@ async def main():
             return
         code = parts[1]
         with get_db() as db:
-            req = db.query(UserRequest).filter_by(confirmation_code=code).first()
-            if not req:
-                await message.answer("Некорректный код. Заявка не найдена.")
+            try:
+                req = load_request_by_code(db, code)
+            except ConfirmationCodeError as e:
+                await message.answer(str(e))
                 return
             if req.status != "approved":
                 await message.answer("Заявка не в статусе 'approved'.")
                 return
+            req_id = req.id
 
-            req.status = "rejected"
-            req.rejection_reason = "Третье лицо не приняло правила"
-            req.confirmation_code = None
-            with safe_commit(db):
-                pass
-
+        if not reject_requests(
+            [req_id], None, "Третье лицо не приняло правила",
+            from_status="approved", confirmation_code=None,
+        ):
+            await message.answer("Заявка не в статусе 'approved'.")
+            return
         await message.answer("Вы отклонили правила. Доступ в группу не предоставлен.")
 
     # ---- Обработчик входа пользователя в группу ----
+    join_batcher = JoinBatcher(bot, JOIN_BATCH_WINDOW, JOIN_GREETINGS_PER_MESSAGE)
+    dp.shutdown.register(join_batcher.close)
+    dp["join_batcher"] = join_batcher
+
     @dp.message(F.new_chat_members)
     async def on_user_join(message: Message):
-        for new_member in message.new_chat_members:
-            with get_db() as db:
-                # Ищем самую последнюю заявку от этого пользователя
-                req = db.query(UserRequest).filter_by(
-                    chat_id=new_member.id
-                ).order_by(
-                    UserRequest.id.desc()  # сортируем по id в обратном порядке
-                ).first()  # берем первую (самую новую)
-                
-                if req:
-                    # Проверяем, рабочее ли сейчас время
-                    if not is_work_time():
-                        # Сохраняем информацию для отложенной отправки
-                        new_notification = PendingJoinNotification(
-                            user_id=new_member.id,
-                            chat_id=message.chat.id,
-                            full_name=req.full_name,
-                            workplace=req.workplace,
-                            position=req.position,
-                            created_at=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        )
-                        db.add(new_notification)
-                        with safe_commit(db):
-                            pass
-                    else:
-                        # Если рабочее время, отправляем сразу
-                        await message.answer(
-                            f"👋 Добро пожаловать, {req.full_name}!\n"
-                            f"🏢 Место работы: {req.workplace}\n"
-                            f"💼 Должность: {req.position}\n"
-                        )
+        await join_batcher.add(message.chat.id, [member.id for member in message.new_chat_members])
 
     # ---- Контроль времени сообщений в группе ----
+    off_hours_guard = OffHoursGuard(
+        bot, OFF_HOURS_REPLY_WINDOW, OFF_HOURS_NOTICE_MODE == "batch", OFF_HOURS_NOTICE_INTERVAL
+    )
+    dp.shutdown.register(off_hours_guard.close)
+
     @dp.message(F.chat.type.in_({"group", "supergroup"}))
     async def check_message_time(message: Message):
-        now = datetime.now()       
-        is_weekday = now.weekday() < 5
-        is_work_hours = 8 <= now.hour < 20
-        if not is_weekday or not is_work_hours:
-            await message.reply(
-                "Согласно правилам группы - писать только с 8 до 20 часов в будние дни"
-            )
+        if not is_work_time():
+            await off_hours_guard.handle(message)
 
     @dp.message(Command("test_errors"))
     async def cmd_test_errors(message: Message):
@@ -2231,11 +5688,10 @@ async def main():
             reply_markup=kb.as_markup()
         )
 
-    @dp.callback_query(F.data.startswith("test_"))
-    async def test_error_callback(callback: CallbackQuery):
+    @callbacks.prefix("test", str)
+    async def test_error_callback(callback: CallbackQuery, error_type: str):
         """Обработчик для тестирования разных ошибок"""
         try:
-            error_type = callback.data.replace("test_", "")
             
             if error_type == "type_error":
                 # Вызываем TypeError
@@ -2297,36 +5753,436 @@ async def main():
         except Exception as e:
             logging.error(f"Error in error handler: {e}")
 
-    # Добавляем глобальный перехватчик для Telethon
-    @telethon_client.on(events.Raw)
-    async def telethon_error_handler(event):
-        """Глобальный обработчик событий и ошибок Telethon"""
-        try:
-            # Логирование служебных уведомлений
-            if isinstance(event, tl_types.UpdateServiceNotification):
-                logging.info(f"Telethon service notification: {event.message}")
-            # Игнорирование обновлений статуса пользователя
-            elif isinstance(event, tl_types.UpdateUserStatus):
+    return dp
+
+
+UPDATE_SHARD_DEPTH = METRICS.gauge(
+    "bot_update_shard_queue_depth", "Апдейтов в очереди шарда", ["shard"])
+UPDATE_SHARD_WAIT = METRICS.histogram(
+    "bot_update_shard_wait_seconds", "Ожидание апдейта в очереди шарда до начала обработки", ["shard"])
+POLLING_BACKPRESSURE = METRICS.counter(
+    "bot_polling_backpressure_total", "Сколько раз polling ждал места в заполненном шарде", ["shard"])
+
+
+def update_chat_id(update: types.Update) -> int:
+    """Чат, к которому относится апдейт (для callback без сообщения — пользователь)."""
+    event = update.event
+    chat = getattr(event, "chat", None)
+    if chat is None and isinstance(event, CallbackQuery) and event.message:
+        chat = event.message.chat
+    if chat is not None:
+        return chat.id
+    user = getattr(event, "from_user", None)
+    return user.id if user else 0
+
+
+class UpdateScheduler:
+    """
+    Polling с шардированием по chat_id вместо задачи на каждый апдейт.
+
+    Апдейт попадает в очередь шарда chat_id % shards, у каждого шарда один
+    обработчик: диалог одного заявителя (RequestFSM) идёт строго по порядку,
+    разные чаты — параллельно, но не больше shards одновременно. Когда очередь
+    шарда заполнена, put() ждёт — следующий getUpdates не уходит, пока не
+    освободится место (offset не сдвигается, Telegram придержит апдейты у себя).
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, shards: int = 32, queue_size: int = 100,
+                 polling_timeout: int = 30, handle_signals: bool = True, close_bot_session: bool = True):
+        self.dp = dp
+        self.bot = bot
+        self.polling_timeout = polling_timeout
+        # Как у dp.start_polling: SIGTERM/SIGINT ведут к штатной остановке с emit_shutdown
+        self.handle_signals = handle_signals
+        self.close_bot_session = close_bot_session
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in range(shards)]
+        self._workers = []
+        self._stopped = asyncio.Event()
+
+    async def put(self, update: types.Update):
+        shard = update_chat_id(update) % len(self.queues)
+        queue = self.queues[shard]
+        if queue.full():
+            POLLING_BACKPRESSURE.inc(str(shard))
+        await queue.put((update, time.perf_counter()))
+        UPDATE_SHARD_DEPTH.set(str(shard), value=queue.qsize())
+
+    async def _work(self, shard: int):
+        queue = self.queues[shard]
+        label = str(shard)
+        while True:
+            update, queued_at = await queue.get()
+            UPDATE_SHARD_WAIT.observe(time.perf_counter() - queued_at, label)
+            UPDATE_SHARD_DEPTH.set(label, value=queue.qsize())
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                # Ошибки обработчиков уже прошли через errors_handler
+                logging.error(f"Апдейт {update.update_id} (шард {shard}) завершился ошибкой: {e}")
+            finally:
+                queue.task_done()
+
+    async def _poll(self):
+        backoff = Backoff(config=DEFAULT_BACKOFF_CONFIG)
+        get_updates = GetUpdates(
+            timeout=self.polling_timeout,
+            allowed_updates=self.dp.resolve_used_update_types(),
+        )
+        request_timeout = int(self.bot.session.timeout + self.polling_timeout)
+        while not self._stopped.is_set():
+            try:
+                updates = await self.bot(get_updates, request_timeout=request_timeout)
+            except Exception as e:
+                logging.error(f"Не удалось получить апдейты: {type(e).__name__}: {e}")
+                await backoff.asleep()
+                continue
+            backoff.reset()
+            for update in updates:
+                await self.put(update)
+                get_updates.offset = update.update_id + 1
+
+    async def run(self):
+        """
+        Работает до stop() или SIGTERM/SIGINT; при остановке дожидается уже принятых
+        апдейтов и вызывает emit_shutdown (сброс FSM, JoinBatcher, массовых рассылок).
+        """
+        loop = asyncio.get_running_loop()
+        signals = (signal.SIGTERM, signal.SIGINT) if self.handle_signals else ()
+        for sig in signals:
+            try:
+                loop.add_signal_handler(sig, self.stop)
+            except NotImplementedError:
+                # Windows: SIGINT приходит как KeyboardInterrupt
                 pass
-            else:
-                logging.debug(f"Получено необработанное событие Telethon: {type(event)}")
+        self._workers = [asyncio.create_task(self._work(i)) for i in range(len(self.queues))]
+        await self.dp.emit_startup(bot=self.bot, **self.dp.workflow_data)
+        logging.info(f"Polling: {len(self.queues)} шардов по chat_id, очередь до {self.queues[0].maxsize}")
+        poller = asyncio.create_task(self._poll())
+        try:
+            await self._stopped.wait()
+            logging.info("Polling остановлен, дообрабатываю очереди шардов")
+        finally:
+            poller.cancel()
+            try:
+                await asyncio.wait_for(asyncio.gather(*(q.join() for q in self.queues)), timeout=10)
+            except asyncio.TimeoutError:
+                logging.warning("Не все апдейты из очередей обработаны до остановки")
+            for worker in self._workers:
+                worker.cancel()
+            try:
+                await self.dp.emit_shutdown(bot=self.bot, **self.dp.workflow_data)
+            finally:
+                for sig in signals:
+                    try:
+                        loop.remove_signal_handler(sig)
+                    except NotImplementedError:
+                        pass
+                if self.close_bot_session:
+                    await self.bot.session.close()
+
+    def stop(self):
+        self._stopped.set()
+
+
+def validate_config():
+    required = [
+        ("BOT_TOKEN", BOT_TOKEN),
+        ("ROOT_ADMIN_ID", ROOT_ADMIN_ID),
+        ("PRIVATE_GROUP_ID", PRIVATE_GROUP_ID),
+    ]
+    if BOT_MODE == "webhook":
+        required.append(("WEBHOOK_URL", WEBHOOK_URL))
+    missing = [name for name, value in required if not value]
+    if missing:
+        raise RuntimeError(f"Не заданы переменные окружения: {', '.join(missing)}")
+
+
+class BotApplication:
+    """
+    Запуск бота по фазам. Независимые шаги (схема БД, Telethon, deleteWebhook,
+    сервер метрик) выполняются параллельно, меню команд ставится в фоне уже
+    во время polling. Время каждой фазы пишется в лог.
+
+    В режиме webhook (BOT_MODE=webhook) апдейты принимает встроенный aiohttp-сервер.
+    Воркеров может быть несколько (WEBHOOK_WORKERS): они слушают один порт через
+    SO_REUSEPORT и делят БД и FSM-хранилище. Вебхук, меню команд, heartbeat и
+    фоновые задачи ведёт только воркер 0.
+    """
+
+    def __init__(self, worker_index: int = 0, workers: int = 1):
+        self.worker_index = worker_index
+        self.workers = workers
+        self.primary = worker_index == 0
+        self.bot: Optional[Bot] = None
+        self.dp: Optional[Dispatcher] = None
+        self.timings = {}
+        self._tasks = []
+
+    async def _timed(self, name: str, awaitable):
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.timings[name] = time.perf_counter() - started
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.append(task)
+        return task
+
+    async def _sync_commands(self):
+        try:
+            await self._timed("commands", set_bot_commands(self.bot, force=COMMANDS_FORCE_SYNC))
+            logging.info(f"Команды бота установлены за {self.timings['commands'] * 1000:.0f} мс")
         except Exception as e:
-            logging.error(f"Ошибка в обработчике Telethon: {e}")
+            logging.error(f"Не удалось установить команды бота: {e}")
+
+    def _register_telethon_handlers(self):
+        client = get_telethon_client()
+
+        # Добавляем глобальный перехватчик для Telethon
+        @client.on(events.Raw)
+        async def telethon_error_handler(event):
+            """Глобальный обработчик событий и ошибок Telethon"""
+            try:
+                # Логирование служебных уведомлений
+                if isinstance(event, tl_types.UpdateServiceNotification):
+                    logging.info(f"Telethon service notification: {event.message}")
+                # Игнорирование обновлений статуса пользователя
+                elif isinstance(event, tl_types.UpdateUserStatus):
+                    pass
+                else:
+                    logging.debug(f"Получено необработанное событие Telethon: {type(event)}")
+            except Exception as e:
+                logging.error(f"Ошибка в обработчике Telethon: {e}")
+
+    async def _setup_webhook(self):
+        if BOT_MODE == "webhook":
+            if self.primary:
+                await self.bot.set_webhook(
+                    f"{WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}",
+                    secret_token=WEBHOOK_SECRET,
+                    allowed_updates=self.dp.resolve_used_update_types(),
+                    max_connections=min(100, 40 * self.workers),
+                )
+        else:
+            await self.bot.delete_webhook(drop_pending_updates=True)
+
+    async def start(self) -> bool:
+        started = time.perf_counter()
+        validate_config()
+        if self.worker_index:
+            use_worker_telethon_session(self.worker_index)
+
+        self.bot = create_bot()
+        self.dp = build_dispatcher(self.bot)
+        if BOT_MODE == "webhook":
+            self.dp.update.outer_middleware(UpdateDedupMiddleware())
+        self.timings["build"] = time.perf_counter() - started
+
+        metrics_port = METRICS_PORT + self.worker_index if METRICS_PORT else 0
+        telethon_ok, *_ = await asyncio.gather(
+            # Авторизуемся в Telethon перед запуском бота
+            self._timed("telethon", authorize_user()),
+            self._timed("database", asyncio.to_thread(init_db)),
+            self._timed("webhook", self._setup_webhook()),
+            # Сервер метрик (если включён); у каждого воркера свой порт
+            self._timed("metrics", start_metrics_server(metrics_port)),
+        )
+        if not telethon_ok:
+            logging.error("Не удалось авторизоваться в Telethon. Бот не может быть запущен.")
+            return False
+        self._register_telethon_handlers()
+
+        # Контроль задержки event loop
+        self._tasks.append(loop_watchdog.start())
+        if LOOP_DEBUG:
+            loop = asyncio.get_running_loop()
+            loop.set_debug(True)
+            loop.slow_callback_duration = LOOP_STALL_THRESHOLD
+
+        if self.primary:
+            # Запускаем задачу heartbeat
+            self._spawn(heartbeat_task())
+            # Команды меню не нужны для приёма апдейтов — ставим в фоне
+            self._spawn(self._sync_commands())
+            # Проверка pending заявок, отложенных ссылок и уведомлений о входе
+            self._spawn(check_pending_requests(self.bot))
+            self._spawn(check_pending_invites(self.bot))
+            self._spawn(check_pending_join_notifications(self.bot))
+            self._spawn(apply_retention_periodically())
+            if ARCHIVE_AFTER_DAYS > 0:
+                self._spawn(archive_requests_periodically())
+            if BACKUP_INTERVAL > 0 and engine.dialect.name == "sqlite":
+                self._spawn(backup_periodically())
+
+        total = time.perf_counter() - started
+        since_import = time.perf_counter() - IMPORT_STARTED
+        logging.info(
+            f"Запуск за {total * 1000:.0f} мс (с начала импорта {since_import * 1000:.0f} мс): "
+            + ", ".join(f"{name}={value * 1000:.0f} мс" for name, value in self.timings.items())
+        )
+        return True
+
+    async def _serve_webhook(self):
+        app = web.Application()
+        SimpleRequestHandler(
+            dispatcher=self.dp, bot=self.bot, secret_token=WEBHOOK_SECRET
+        ).register(app, path=WEBHOOK_PATH)
+        setup_application(app, self.dp, bot=self.bot)
+
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, reuse_port=self.workers > 1)
+        await site.start()
+        logging.info(
+            f"Воркер {self.worker_index}/{self.workers}: webhook на "
+            f"http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+        )
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+
+    async def run(self):
+        if not await self.start():
+            return
+        try:
+            # ---- Запуск бота ----
+            if BOT_MODE == "webhook":
+                await self._serve_webhook()
+            elif UPDATE_SHARDS:
+                await UpdateScheduler(self.dp, self.bot, UPDATE_SHARDS, UPDATE_SHARD_QUEUE_SIZE).run()
+            else:
+                await self.dp.start_polling(self.bot)
+        finally:
+            loop_watchdog.stop()
+            for task in self._tasks:
+                task.cancel()
 
-     
 
+def worker_telethon_session(worker_index: int) -> str:
+    if not worker_index:
+        return TELETHON_MAIN_SESSION
+    base, ext = os.path.splitext(TELETHON_MAIN_SESSION)
+    return f"{base}.worker{worker_index}{ext}"
+
+
+def use_worker_telethon_session(worker_index: int):
+    """
+    У каждого воркера webhook своя авторизованная сессия Telethon. Копия одной сессии
+    не годится: ключ авторизации, с которым одновременно подключаются несколько
+    процессов, Telegram считает дублированным (AuthKeyDuplicatedError) и может отозвать
+    сессию. Сессии воркеров авторизует run_cluster.
+    """
+    global TELETHON_SESSION
+    TELETHON_SESSION = worker_telethon_session(worker_index)
+    reset_telethon_client()
 
-    
 
-    # ---- Запуск бота ----
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+def session_auth_key(path: str) -> Optional[bytes]:
+    """Ключ авторизации из файла сессии Telethon (SQLite); None, если его нет."""
+    if not os.path.exists(path):
+        return None
+    conn = sqlite3.connect(path)
+    try:
+        row = conn.execute("SELECT auth_key FROM sessions").fetchone()
+    except sqlite3.Error:
+        return None
+    finally:
+        conn.close()
+    return row[0] or None if row else None
+
+
+def run_worker(worker_index: int, workers: int):
+    """Точка входа процесса-воркера webhook."""
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(BotApplication(worker_index, workers).run())
+    except KeyboardInterrupt:
+        pass
+
+
+async def run_cluster():
+    """
+    Родительский процесс для WEBHOOK_WORKERS > 1: один раз готовит схему и
+    авторизует сессии Telethon всех воркеров (для ещё не авторизованных спросит
+    телефон и код), затем запускает воркеры.
+    """
+    validate_config()
+    await asyncio.to_thread(init_db)
+    main_key = None
+    for index in range(WEBHOOK_WORKERS):
+        use_worker_telethon_session(index)
+        session_file = telethon_session_file()
+        if index and main_key and session_auth_key(session_file) == main_key:
+            # Копия сессии воркера 0 (так делали раньше) — тот же ключ, нужна своя авторизация
+            os.remove(session_file)
+            logging.warning(f"Сессия Telethon воркера {index} была копией основной и удалена")
+        if index:
+            print(f"Telethon: сессия воркера {index} ({os.path.basename(session_file)})")
+        if not await authorize_user():
+            logging.error("Не удалось авторизоваться в Telethon. Бот не может быть запущен.")
+            return
+        await get_telethon_client().disconnect()
+        if not index:
+            main_key = session_auth_key(session_file)
+    use_worker_telethon_session(0)
+
+    context = multiprocessing.get_context("spawn")
+    processes = [
+        context.Process(target=run_worker, args=(index, WEBHOOK_WORKERS), name=f"hrbot-worker-{index}")
+        for index in range(WEBHOOK_WORKERS)
+    ]
+    for process in processes:
+        process.start()
+    logging.info(f"Запущено воркеров webhook: {len(processes)}")
+    try:
+        for process in processes:
+            await asyncio.to_thread(process.join)
+    finally:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
 
 
+async def main():
+    logging.basicConfig(level=logging.INFO)
+    if MULTI_WORKER:
+        await run_cluster()
+    else:
+        await BotApplication().run()
 
-   
 
 if __name__ == "__main__":
+    if sys.argv[1:] == ["backfill-analytics"]:
+        # Пересчёт агрегатов /analytics, например после ручной правки user_requests
+        logging.basicConfig(level=logging.INFO)
+        init_db()
+        with engine.begin() as conn:
+            logging.info(f"Аналитика пересчитана по {backfill_analytics(conn)} заявкам")
+        sys.exit(0)
+    if sys.argv[1:] == ["archive"]:
+        # Разовый перенос завершённых заявок в архив (тот же, что делает бот по расписанию)
+        logging.basicConfig(level=logging.INFO)
+        init_db()
+        logging.info(format_archive_stats(archive_finished_requests()))
+        sys.exit(0)
+    if sys.argv[1:] == ["backup"]:
+        # Разовая копия на работающей базе (та же, что снимает бот по расписанию)
+        logging.basicConfig(level=logging.INFO)
+        init_db()
+        logging.info(format_backup_stats(create_backup()))
+        sys.exit(0)
+    if sys.argv[1:] == ["vacuum"]:
+        # Очистка и однократный перевод базы в auto_vacuum=INCREMENTAL (бот остановлен)
+        logging.basicConfig(level=logging.INFO)
+        init_db()
+        logging.info(format_retention_stats(apply_retention()))
+        pages = enable_incremental_vacuum()
+        logging.info(f"VACUUM: файл БД {pages['pages'] * pages['page_size'] / 1024 / 1024:.1f} МБ, "
+                     f"auto_vacuum={pages['auto_vacuum']}")
+        sys.exit(0)
     try:
         asyncio.run(main())
     except Exception as e:
@@ -0,0 +1,365 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Загрузка исторических заявок и админов в базу бота из CSV.
+
+    python import_data.py requests members.csv --rejects rejected.csv
+    python import_data.py admins admins.csv
+
+Заголовки — имена колонок модели (full_name, phone, ...) или русские
+заголовки выгрузки /export, так что её файл можно загрузить обратно.
+Разделитель («;» или «,») определяется автоматически.
+
+Каждая строка нормализуется и проверяется (ФИО, телефон 7XXXXXXXXXX, статус,
+даты; статус и дата подачи обязательны). Дубликат — та же заявка: тот же
+телефон (без телефона — chat_id), ФИО и время подачи; ключи те же, что у бота
+(телефон E.164, ФИО без регистра). Повторная заявка того же человека, например
+после отказа, дубликатом не считается. Дубликаты ищутся среди уже загруженных
+заявок и архива, а также внутри самого файла. Вставка идёт через
+executemany транзакциями по --batch-size строк. В конце печатается
+скорость и причины отказов; отклонённые строки можно сохранить в --rejects.
+
+База берётся из DATABASE_URL (.env), схема обновляется через init_db().
+"""
+
+import argparse
+import csv
+import logging
+import os
+import re
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from functools import lru_cache
+from types import SimpleNamespace
+
+from sqlalchemy import insert
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BASE_DIR)
+
+import bot as hrbot  # noqa: E402
+
+FULL_NAME_RE = re.compile(r"^[А-Яа-яЁё\s]+$")
+USERNAME_RE = re.compile(r"^[A-Za-z0-9_]{5,32}$")
+# ГГГГ-ММ-ДД[ ЧЧ:ММ[:СС]] и ДД.ММ.ГГГГ[ ЧЧ:ММ[:СС]]; strptime на сотнях тысяч строк слишком медленный
+ISO_DATE_RE = re.compile(r"^(\d{4})-(\d{1,2})-(\d{1,2})(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}))?)?$")
+RU_DATE_RE = re.compile(r"^(\d{1,2})\.(\d{1,2})\.(\d{4})(?: (\d{1,2}):(\d{2})(?::(\d{2}))?)?$")
+
+STATUS_ALIASES = {
+    "approved": "approved", "одобрена": "approved", "одобрено": "approved",
+    "rejected": "rejected", "отклонена": "rejected", "отклонено": "rejected",
+    "pending": "pending", "ожидает": "pending", "в ожидании": "pending",
+}
+PERSON_TYPE_ALIASES = {
+    "self": "self", "своя": "self", "с": "self",
+    "third_party": "third_party", "третье лицо": "third_party", "тп": "third_party",
+}
+
+# Русские заголовки /export → имена колонок
+HEADER_ALIASES = {header.lower(): name for name, header in hrbot.EXPORT_COLUMNS}
+HEADER_ALIASES.update({"telegramid": "telegram_id", "telegram id": "telegram_id"})
+
+
+class RowError(ValueError):
+    """Строка не прошла проверку; текст — причина отказа."""
+
+
+# -------------------------------------------------------
+# НОРМАЛИЗАЦИЯ
+# -------------------------------------------------------
+def normalize_full_name(value: str) -> str:
+    name = " ".join(value.split())
+    if not name:
+        raise RowError("нет ФИО")
+    if not FULL_NAME_RE.match(name):
+        raise RowError("ФИО не русскими буквами")
+    return " ".join(part.capitalize() for part in name.split())
+
+
+def normalize_phone(value: str) -> str:
+    """Формат бота: 7 и ещё 10 цифр (8XXXXXXXXXX и 9XXXXXXXXX приводятся), как при вводе в боте."""
+    digits = hrbot.normalize_phone(value)
+    if digits is None:
+        raise RowError("некорректный телефон")
+    return digits
+
+
+@lru_cache(maxsize=65536)
+def normalize_date(value: str):
+    """Дата в формат бота «ГГГГ-ММ-ДД ЧЧ:ММ:СС»; в истории одни и те же даты повторяются — кешируем."""
+    value = value.strip()
+    if not value:
+        return None
+    match = ISO_DATE_RE.match(value)
+    if match:
+        year, month, day, hour, minute, second = match.groups()
+    else:
+        match = RU_DATE_RE.match(value)
+        if not match:
+            raise RowError("некорректная дата")
+        day, month, year, hour, minute, second = match.groups()
+    try:
+        parsed = datetime(int(year), int(month), int(day), int(hour or 0), int(minute or 0), int(second or 0))
+    except ValueError:
+        raise RowError("некорректная дата")
+    return parsed.strftime("%Y-%m-%d %H:%M:%S")
+
+
+def normalize_int(value: str, field: str, required: bool = False):
+    value = value.strip()
+    if not value:
+        if required:
+            raise RowError(f"нет {field}")
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise RowError(f"{field} не число")
+
+
+def normalize_request(raw: dict) -> dict:
+    values = {name: (value or "").strip() for name, value in raw.items()}
+    get = lambda name: values.get(name, "")  # noqa: E731
+
+    if not get("status"):
+        raise RowError("нет статуса")
+    status = STATUS_ALIASES.get(get("status").lower())
+    if status is None:
+        raise RowError("неизвестный статус")
+    person_type = PERSON_TYPE_ALIASES.get(get("person_type").lower() or "self")
+    if person_type is None:
+        raise RowError("неизвестный тип заявки")
+
+    # «—» бот пишет тем, у кого нет username (и так же выгружает в /export)
+    username = get("username").lstrip("@")
+    username = username if username and username != "—" else None
+    if username and not USERNAME_RE.match(username):
+        raise RowError("некорректный username")
+
+    created_at = normalize_date(get("created_at"))
+    if not created_at:
+        # Время подачи входит в ключ дубликата — без него заявку не отличить от повторной
+        raise RowError("нет даты подачи")
+
+    row = {
+        "chat_id": normalize_int(get("chat_id"), "chat_id", required=True),
+        "person_type": person_type,
+        "full_name": normalize_full_name(get("full_name")),
+        "phone": normalize_phone(get("phone")) if get("phone") else None,
+        "workplace": " ".join(get("workplace").split()) or None,
+        "position": " ".join(get("position").split()) or None,
+        "username": username,
+        "status": status,
+        "rejection_reason": get("rejection_reason") or None,
+        "created_at": created_at,
+        "approved_at": normalize_date(get("approved_at")),
+        "approved_by": normalize_int(get("approved_by"), "approved_by"),
+        "rejected_at": normalize_date(get("rejected_at")),
+        "rejected_by": normalize_int(get("rejected_by"), "rejected_by"),
+        "rules_accepted_at": normalize_date(get("rules_accepted_at")),
+    }
+    if status == "approved" and not row["approved_at"]:
+        row["approved_at"] = row["created_at"]
+    row.update(hrbot.request_keys(row["full_name"], row["phone"], username))
+    return row
+
+
+def application_key(row: dict) -> tuple:
+    """Одна и та же заявка: телефон (без него — chat_id), ФИО и время подачи."""
+    return (row["phone_key"] or row["chat_id"], row["name_key"], row["created_at"])
+
+
+def normalize_admin(raw: dict) -> dict:
+    full_name = " ".join((raw.get("full_name") or "").split()) or None
+    return {
+        "telegram_id": normalize_int(raw.get("telegram_id") or "", "telegram_id", required=True),
+        "full_name": full_name,
+    }
+
+
+# -------------------------------------------------------
+# ЧТЕНИЕ
+# -------------------------------------------------------
+def read_rows(path: str):
+    """(номер строки, словарь с нормализованными заголовками, исходная строка)."""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        sample = f.read(4096)
+        f.seek(0)
+        dialect = csv.Sniffer().sniff(sample, delimiters=";,\t")
+        reader = csv.reader(f, dialect)
+        headers = [h.strip().lower() for h in next(reader)]
+        fields = [HEADER_ALIASES.get(h, h) for h in headers]
+        for line_no, values in enumerate(reader, start=2):
+            if not any(v.strip() for v in values):
+                continue
+            yield line_no, dict(zip(fields, values)), values
+
+
+def batched(iterable, size: int):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# -------------------------------------------------------
+# ИМПОРТ
+# -------------------------------------------------------
+class ImportReport:
+    def __init__(self, kind: str):
+        self.kind = kind
+        self.read = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.rejects = Counter()
+        self.rejected_rows = []
+        self.started = time.perf_counter()
+
+    def reject(self, line_no: int, values: list, reason: str):
+        self.rejects[reason] += 1
+        self.rejected_rows.append([line_no, reason] + list(values))
+
+    def print(self):
+        elapsed = time.perf_counter() - self.started
+        print(
+            f"{self.kind}: прочитано {self.read}, добавлено {self.inserted}, "
+            f"дубликатов {self.duplicates}, отклонено {sum(self.rejects.values())} "
+            f"за {elapsed:.2f} с ({self.read / elapsed if elapsed else 0:.0f} строк/с)"
+        )
+        for reason, count in self.rejects.most_common():
+            print(f"  {reason}: {count}")
+
+    def save_rejects(self, path: str):
+        with open(path, "w", newline="", encoding="utf-8-sig") as f:
+            writer = csv.writer(f, delimiter=";")
+            writer.writerow(["Строка", "Причина"])
+            writer.writerows(self.rejected_rows)
+
+
+def import_requests(path: str, batch_size: int = 5000, dry_run: bool = False) -> ImportReport:
+    report = ImportReport("Заявки")
+    seen = set()
+    UserRequest = hrbot.UserRequest
+
+    for batch in batched(read_rows(path), batch_size):
+        valid = []
+        for line_no, raw, values in batch:
+            report.read += 1
+            try:
+                valid.append((line_no, normalize_request(raw), values))
+            except RowError as e:
+                report.reject(line_no, values, str(e))
+
+        with hrbot.engine.begin() as conn:
+            # Дубликаты в базе — по индексам phone_key и chat_id, одним запросом на пачку;
+            # ключи те же, что пишет бот, так что «+7 (999)…» и «8999…» — один телефон
+            phones = {row["phone_key"] for _, row, _ in valid if row["phone_key"]}
+            chat_ids = {row["chat_id"] for _, row, _ in valid if not row["phone_key"]}
+            existing = set()
+            # Старые заявки могли уйти в архив — он проверяется так же
+            for model in hrbot.REQUEST_MODELS:
+                if phones:
+                    existing.update(tuple(key) for key in conn.execute(
+                        model.__table__.select()
+                        .with_only_columns(model.phone_key, model.name_key, model.created_at)
+                        .where(model.phone_key.in_(phones))
+                    ))
+                if chat_ids:
+                    existing.update(tuple(key) for key in conn.execute(
+                        model.__table__.select()
+                        .with_only_columns(model.chat_id, model.name_key, model.created_at)
+                        .where(model.chat_id.in_(chat_ids))
+                    ))
+
+            rows = []
+            for line_no, row, values in valid:
+                key = application_key(row)
+                if key in existing or key in seen:
+                    report.duplicates += 1
+                    continue
+                seen.add(key)
+                rows.append(row)
+
+            if rows and not dry_run:
+                conn.execute(insert(UserRequest), rows)
+                # Агрегаты /analytics — в той же транзакции, что и заявки
+                rollup = hrbot.AnalyticsRollup()
+                for row in rows:
+                    rollup.add_request(SimpleNamespace(**row))
+                rollup.flush(conn)
+            report.inserted += len(rows)
+    return report
+
+
+def import_admins(path: str, batch_size: int = 5000, dry_run: bool = False) -> ImportReport:
+    report = ImportReport("Админы")
+    seen = set()
+    AdminUser = hrbot.AdminUser
+
+    for batch in batched(read_rows(path), batch_size):
+        valid = []
+        for line_no, raw, values in batch:
+            report.read += 1
+            try:
+                valid.append(normalize_admin(raw))
+            except RowError as e:
+                report.reject(line_no, values, str(e))
+
+        with hrbot.engine.begin() as conn:
+            ids = {row["telegram_id"] for row in valid}
+            existing = {
+                telegram_id for (telegram_id,) in conn.execute(
+                    AdminUser.__table__.select().with_only_columns(AdminUser.telegram_id)
+                    .where(AdminUser.telegram_id.in_(ids))
+                )
+            } if ids else set()
+            rows = []
+            for row in valid:
+                if row["telegram_id"] in existing or row["telegram_id"] in seen:
+                    report.duplicates += 1
+                    continue
+                seen.add(row["telegram_id"])
+                rows.append(row)
+            if rows and not dry_run:
+                conn.execute(insert(AdminUser), rows)
+            report.inserted += len(rows)
+    return report
+
+
+IMPORTERS = {
+    "requests": import_requests,
+    "admins": import_admins,
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Импорт заявок и админов из CSV в базу бота")
+    parser.add_argument("kind", choices=sorted(IMPORTERS), help="что загружаем")
+    parser.add_argument("path", help="CSV-файл")
+    parser.add_argument("--batch-size", type=int, default=5000, help="строк в одной транзакции")
+    parser.add_argument("--rejects", help="куда сохранить отклонённые строки (CSV)")
+    parser.add_argument("--dry-run", action="store_true", help="только проверка, без записи")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+    hrbot.init_db()
+    report = IMPORTERS[args.kind](args.path, args.batch_size, args.dry_run)
+    report.print()
+    if args.rejects and report.rejected_rows:
+        report.save_rejects(args.rejects)
+        print(f"Отклонённые строки: {args.rejects}")
+    if args.kind == "admins" and report.inserted and not args.dry_run:
+        print("Меню команд новых админов обновится при следующем запуске бота.")
+
+
+if __name__ == "__main__":
+    main()